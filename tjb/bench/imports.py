@@ -0,0 +1,95 @@
+#
+# Startup cost of the core modules, each measured in a fresh interpreter
+#
+#   cd tjb
+#   python -m bench.imports --runs 5
+#
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+CORE = [
+    'pipeline.injest',
+    'uglc.smlc',
+    'uglc.mmlc',
+    'uglc.stringlc',
+    'pipeline.pipeline',
+    'pipeline.driver',
+    'pipeline.batch',
+    'pipeline.spill',
+    'pipeline.checkpoint',
+    'pipeline.cache',
+    'pipeline.monitor',
+    'pipeline.threaded',
+    'pipeline.fusedlc',
+    'pipeline.engines',
+    'pipeline.shadow',
+    'pipeline.adaptive',
+    'pipeline.output',
+    'pipeline.util',
+    'trigger.majority',
+    'trigger.eventbuilder',
+]
+
+BACKENDS = [
+    'pipeline.i3reader',
+]
+
+PROBE = '''
+import sys, time
+t0 = time.perf_counter()
+import {module}
+print(time.perf_counter() - t0, 'icecube' in sys.modules)
+'''
+
+
+def measure(module, runs):
+    ''' returns (median seconds, loads icetray) or None if the module does not import '''
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    icetray = False
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, '-c', PROBE.format(module=module)],
+                              cwd=here, capture_output=True, text=True)
+        if proc.returncode != 0:
+            return None
+        seconds, loaded = proc.stdout.split()
+        times.append(float(seconds))
+        icetray = loaded == 'True'
+    return statistics.median(times), icetray
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='module import time')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--out', help='write results as JSON')
+    args = parser.parse_args(argv)
+
+    results = []
+    failures = 0
+    for module in CORE + BACKENDS:
+        m = measure(module, args.runs)
+        if m is None:
+            print(f'{module:>20}: not importable here')
+            results.append({'module': module, 'seconds': None, 'icetray': None})
+            if module in CORE:
+                failures += 1
+            continue
+        seconds, icetray = m
+        print(f'{module:>20}: {seconds*1e3:8.2f} ms  icetray loaded: {icetray}')
+        results.append({'module': module, 'seconds': seconds, 'icetray': icetray})
+        if module in CORE and icetray:
+            failures += 1
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
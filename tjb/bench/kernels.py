@@ -0,0 +1,86 @@
+#
+# Streaming Pipeline vs kernel-backed BatchPipeline on upgrade-like noise frames
+#
+# Checks that both engines flag identical hits and reports the speedup. Run with and
+# without numba installed to compare the compiled kernels against the python fallback.
+#
+#   cd tjb
+#   python -m bench.kernels --frames 5 --frame-len 1e7
+#
+import argparse
+import sys
+import time
+
+from bench.stages import NullSink
+from bench.stages import quiet
+from pipeline.batch import BatchPipeline
+from pipeline.injest import Injest
+from pipeline.injest import Population
+from pipeline.pipeline import Pipeline
+from pipeline.synthetic import SyntheticSource
+from uglc.kernels import HAVE_NUMBA
+
+
+def flagsOf(hits):
+    ''' (omkey, raw time) -> (smlc, mmlc) '''
+    return {(h.omkey, h.rawTime()): (h.smlc, h.mmlc) for h in hits}
+
+
+def runEngine(engine_cls, frame, omkeys):
+    ''' returns (seconds, hits) for one frame, construction excluded '''
+    hits = list(frame.hits())
+    with quiet():
+        engine = engine_cls(NullSink(), omkeys)
+    t0 = time.perf_counter()
+    for h in hits:
+        engine.enque(h)
+    with quiet():
+        engine.eos()
+    return time.perf_counter() - t0, hits
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='streaming vs kernel engine')
+    parser.add_argument('--frames', type=int, default=3)
+    parser.add_argument('--frame-len', type=float, default=1e7, help='ns')
+    parser.add_argument('--degg-rate', type=float, default=1000.0, help='Hz per PMT')
+    parser.add_argument('--mdom-rate', type=float, default=300.0, help='Hz per PMT')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    config = SyntheticSource.NoiseConfig(frame_len=args.frame_len, degg_rate=args.degg_rate,
+                                         mdom_rate=args.mdom_rate, burst_rate=100.0)
+    source = SyntheticSource(config, args.seed, args.frames)
+    print(f'kernels: {"numba" if HAVE_NUMBA else "python fallback"}')
+
+    mismatches = 0
+    t_stream = 0.0
+    t_batch = 0.0
+    n_hits = 0
+
+    # warm up the JIT outside of the timed frames
+    for frame in Injest(source.files(1), source).upgradePulseFrames():
+        runEngine(BatchPipeline, frame, Population.extractPopulation(frame.rpsm))
+        break
+
+    for frame in Injest(source.files(1), source).upgradePulseFrames():
+        omkeys = Population.extractPopulation(frame.rpsm)
+        ts, stream_hits = runEngine(Pipeline, frame, omkeys)
+        tb, batch_hits = runEngine(BatchPipeline, frame, omkeys)
+        expected = flagsOf(stream_hits)
+        got = flagsOf(batch_hits)
+        bad = sum(1 for k, v in expected.items() if got.get(k) != v)
+        mismatches += bad
+        t_stream += ts
+        t_batch += tb
+        n_hits += len(stream_hits)
+        print(f'{frame.frame_id}: hits: {len(stream_hits)} stream: {ts*1e9/len(stream_hits):.0f} ns/hit '
+              f'batch: {tb*1e9/len(batch_hits):.0f} ns/hit  speedup: x{ts/tb:.1f}  flag mismatches: {bad}')
+
+    print(f'total hits: {n_hits} stream: {n_hits/t_stream:.0f} hits/s batch: {n_hits/t_batch:.0f} hits/s '
+          f'speedup: x{t_stream/t_batch:.1f} flag mismatches: {mismatches}')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,474 @@
+#
+# Stage-level microbenchmarks driven by synthetic hit streams
+#
+# Each stage is timed over pre-built hit lists (hit construction is not measured) while
+# sweeping one axis at a time around a base configuration, producing scaling curves.
+#
+#   cd tjb
+#   python -m bench.stages --out bench.json                      # run, write results
+#   python -m bench.stages --save-baseline baseline.json         # store a baseline
+#   python -m bench.stages --baseline baseline.json              # flag regressions vs baseline
+#
+import argparse
+import contextlib
+import io
+import json
+import platform
+import random
+import sys
+import time
+
+from pipeline.injest import Frame
+from pipeline.injest import Geometry
+from pipeline.injest import Grouping
+from pipeline.injest import MyHit
+from pipeline.injest import Population
+from pipeline.batch import BatchPipeline
+from pipeline.driver import Accumulator
+from pipeline.fusedlc import FusedLCPipeline
+from pipeline.monitor import RateMonitor
+from pipeline.pipeline import OMKEYDemuxer
+from pipeline.pipeline import PairHeapSorter
+from pipeline.pipeline import Pipeline
+from pipeline.pipeline import Sorter
+from pipeline.pipeline import StringDemuxer
+from pipeline.synthetic import SyntheticSource
+from pipeline.synthetic import SynthOMKey
+from pipeline.synthetic import SynthPulse
+from pipeline.threaded import ThreadedPipeline
+from pipeline.threaded import gilEnabled
+from trigger.majority import MajorityTrigger
+from uglc.mmlc import MMLC
+from uglc.slidingwindow import SlidingWindow
+from uglc.smlc import SMLC
+
+
+#
+# sweep axes, each benchmark varies the axes relevant to it one at a time
+#
+BASE = {
+    'noise_rate': 1000.0,           # Hz per PMT
+    'pmts_per_module': 24,
+    'modules_per_string': 10,
+    'fan_in': 16,                   # input streams into a sorter/demuxer
+    'strings': 2,
+    'frame_len': 100000000.0,       # ns, long "frames" so each stage sees a few thousand hits at noise rates
+}
+
+AXES = {
+    'noise_rate': [300.0, 1000.0, 3000.0, 10000.0],
+    'pmts_per_module': [4, 8, 16, 24],
+    'modules_per_string': [5, 10, 20, 40],
+    'fan_in': [2, 8, 32, 128],
+    'strings': [1, 2, 4, 7],
+    'frame_len': [10000000.0, 100000000.0, 300000000.0],
+}
+
+QUICK_AXES = {
+    'noise_rate': [1000.0, 3000.0],
+    'pmts_per_module': [8, 24],
+    'modules_per_string': [5, 10],
+    'fan_in': [4, 16],
+    'strings': [2, 4],
+    'frame_len': [1000000.0, 10000000.0],
+}
+
+QUICK_BASE = dict(BASE, frame_len=10000000.0)
+
+
+class NullSink:
+    ''' terminal node that only counts '''
+
+    def __init__(self):
+        self.cnt = 0
+
+    def enque(self, hit):
+        self.cnt += 1
+
+    def eos(self):
+        pass
+
+
+class NullConsumer:
+    ''' frame consumer that discards the frames '''
+
+    def consume(self, frame):
+        pass
+
+
+class Gauge:
+    ''' taps on either side of a stage, tracks the peak number of hits buffered in between '''
+
+    class Tap:
+        def __init__(self, gauge, sink, delta):
+            self.gauge = gauge
+            self.sink = sink
+            self.delta = delta
+
+        def enque(self, hit):
+            self.gauge.held += self.delta
+            if self.gauge.held > self.gauge.peak:
+                self.gauge.peak = self.gauge.held
+            self.sink.enque(hit)
+
+        def eos(self):
+            self.sink.eos()
+
+    def __init__(self):
+        self.held = 0
+        self.peak = 0
+
+    def inputTap(self, sink):
+        return Gauge.Tap(self, sink, 1)
+
+    def outputTap(self, sink):
+        return Gauge.Tap(self, sink, -1)
+
+
+#
+# synthetic hit streams
+#
+def channelStreams(fan_in, rate, frame_len, seed=0, pmts_per_module=24, string=87):
+    ''' fan_in independent time ordered channel streams, {omkey: [MyHit]} '''
+    rng = random.Random(seed)
+    group = Grouping('bench:0', 0)
+    per_ns = rate * 1e-9
+    streams = {}
+    for ch in range(fan_in):
+        omkey = SynthOMKey(string, 1 + ch // pmts_per_module, ch % pmts_per_module)
+        device_type = Geometry.DeviceType.MDOM if pmts_per_module > 2 else Geometry.DeviceType.DEGG
+        hits = []
+        t = rng.expovariate(per_ns)
+        while t < frame_len:
+            hits.append(MyHit(group, omkey, device_type, SynthPulse(t, 1.0, 5.0)))
+            t += rng.expovariate(per_ns)
+        streams[omkey] = hits
+    return streams
+
+
+def timeOrdered(streams):
+    ''' merge channel streams into one time ordered list '''
+    hits = [h for hits in streams.values() for h in hits]
+    hits.sort(key=lambda h: h.resolveTime())
+    return hits
+
+
+def depthFirst(streams):
+    ''' channel after channel, the order Frame.hits() emits '''
+    return [h for hits in streams.values() for h in hits]
+
+
+def noiseFrames(params, n_frames=1, seed=0):
+    ''' synthetic frames for the pipeline level benchmarks '''
+    config = SyntheticSource.NoiseConfig(strings=tuple(range(87, 87 + params['strings'])),
+                                         modules_per_string=params['modules_per_string'],
+                                         mdom_pmts=params['pmts_per_module'],
+                                         degg_rate=params['noise_rate'],
+                                         mdom_rate=params['noise_rate'],
+                                         frame_len=params['frame_len'])
+    source = SyntheticSource(config, seed, n_frames)
+    frames = []
+    for cnt, rpsm in enumerate(source.daqPulseMaps('bench')):
+        group = Grouping(f'bench:{cnt}', 0)
+        geometry = Geometry.deduceGeometry(Population.extractPopulation(rpsm))
+        frames.append(Frame(geometry, group, rpsm))
+    return frames
+
+
+#
+# benchmarks, each returns (hits, seconds, peak_buffered, extra)
+#
+def quiet():
+    ''' the LC stages print their configuration on construction '''
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def timeit(build, feed, repeat):
+    ''' best of repeat, build is excluded from the timing '''
+    best = None
+    for _ in range(repeat):
+        with quiet():
+            stage = build()
+        t0 = time.perf_counter()
+        feed(stage)
+        elapsed = time.perf_counter() - t0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def feedAll(hits):
+    def feed(stage):
+        for h in hits:
+            stage.enque(h)
+        stage.eos()
+    return feed
+
+
+def benchSlidingWindow(params, repeat):
+    streams = channelStreams(params['pmts_per_module'], params['noise_rate'], params['frame_len'])
+    hits = timeOrdered(streams)
+    t = timeit(lambda: SlidingWindow(NullSink(), 100), feedAll(hits), repeat)
+    gauge = Gauge()
+    feedAll(hits)(gauge.inputTap(SlidingWindow(gauge.outputTap(NullSink()), 100)))
+    return len(hits), t, gauge.peak, {}
+
+
+def benchSMLC(params, repeat):
+    streams = channelStreams(params['pmts_per_module'], params['noise_rate'], params['frame_len'])
+    hits = timeOrdered(streams)
+    cfg = SMLC.SMLCConfig.lookup(Geometry.DeviceType.MDOM)
+    mkey = SynthOMKey(87, 1, 0)
+    t = timeit(lambda: SMLC(mkey, cfg, NullSink()), feedAll(hits), repeat)
+    gauge = Gauge()
+    feedAll(hits)(gauge.inputTap(SMLC(mkey, cfg, gauge.outputTap(NullSink()))))
+    return len(hits), t, gauge.peak, {}
+
+
+def benchMMLC(params, repeat):
+    fan_in = params['modules_per_string'] * params['pmts_per_module']
+    streams = channelStreams(fan_in, params['noise_rate'], params['frame_len'], pmts_per_module=params['pmts_per_module'])
+    hits = timeOrdered(streams)
+    t = timeit(lambda: MMLC(87, MMLC.MMLCConfig(87), NullSink()), feedAll(hits), repeat)
+    gauge = Gauge()
+    with quiet():
+        stage = MMLC(87, MMLC.MMLCConfig(87), gauge.outputTap(NullSink()))
+    feedAll(hits)(gauge.inputTap(stage))
+    return len(hits), t, gauge.peak, {}
+
+
+def benchSorter(sorter_cls):
+    def bench(params, repeat):
+        streams = channelStreams(params['fan_in'], params['noise_rate'], params['frame_len'])
+        hits = depthFirst(streams)
+
+        def build():
+            sorter = sorter_cls(streams.keys(), NullSink())
+            return (sorter, {k: sorter.inputFor(k) for k in streams.keys()})
+
+        def feed(stage):
+            _, inputs = stage
+            for h in hits:
+                inputs[h.omkey].enque(h)
+            for node in inputs.values():
+                node.eos()
+
+        t = timeit(build, feed, repeat)
+        gauge = Gauge()
+        sorter = sorter_cls(streams.keys(), gauge.outputTap(NullSink()))
+        inputs = {k: gauge.inputTap(sorter.inputFor(k)) for k in streams.keys()}
+        feed((sorter, inputs))
+        return len(hits), t, gauge.peak, {}
+    return bench
+
+
+def benchOMKEYDemuxer(params, repeat):
+    streams = channelStreams(params['fan_in'], params['noise_rate'], params['frame_len'])
+    hits = timeOrdered(streams)
+    t = timeit(lambda: OMKEYDemuxer({k: NullSink() for k in streams.keys()}), feedAll(hits), repeat)
+    return len(hits), t, 0, {}
+
+
+def benchStringDemuxer(params, repeat):
+    streams = {}
+    for s in range(params['fan_in']):
+        streams.update(channelStreams(params['pmts_per_module'], params['noise_rate'], params['frame_len'], seed=s, string=s))
+    hits = timeOrdered(streams)
+    strings = {k.string for k in streams.keys()}
+    t = timeit(lambda: StringDemuxer({s: NullSink() for s in strings}), feedAll(hits), repeat)
+    return len(hits), t, 0, {}
+
+
+def benchAccumulator(params, repeat):
+    frame = noiseFrames(params)[0]
+    hits = sorted(frame.hits(), key=lambda h: h.resolveTime())
+
+    def build():
+        acc = Accumulator(NullConsumer())
+        acc.expectFrame(frame.frame_id, frame.rpsm)
+        return acc
+
+    def feed(acc):
+        for h in hits:
+            acc.enque(h)
+        with quiet():
+            acc.eos()
+
+    t = timeit(build, feed, repeat)
+    return len(hits), t, 0, {}
+
+
+def benchPipeline(engine_cls):
+    def bench(params, repeat):
+        frame = noiseFrames(params)[0]
+        omkeys = Population.extractPopulation(frame.rpsm)
+        hits = list(frame.hits())
+
+        sw_setup = time.perf_counter()
+        with quiet():
+            engine_cls(NullSink(), omkeys)
+        setup = time.perf_counter() - sw_setup
+
+        t = timeit(lambda: engine_cls(NullSink(), omkeys), feedAll(hits), repeat)
+        gauge = Gauge()
+        with quiet():
+            stage = engine_cls(gauge.outputTap(NullSink()), omkeys)
+        feedAll(hits)(gauge.inputTap(stage))
+        extra = {'setup_s': setup, 'channels': len(omkeys)}
+        if hasattr(stage, 'reset'):
+            sw_reset = time.perf_counter()
+            stage.reset(omkeys, frame.geometry)
+            extra['reset_s'] = time.perf_counter() - sw_reset
+        return len(hits), t, gauge.peak, extra
+    return bench
+
+
+def benchThreaded(params, repeat):
+    ''' ThreadedPipeline against Pipeline on the same frame, speedup per string count '''
+    frame = noiseFrames(params)[0]
+    omkeys = Population.extractPopulation(frame.rpsm)
+    hits = list(frame.hits())
+
+    def feed(stage):
+        feedAll(hits)(stage)
+        stage.close()
+
+    serial = timeit(lambda: Pipeline(NullSink(), omkeys), feedAll(hits), repeat)
+    t = timeit(lambda: ThreadedPipeline(NullSink(), omkeys), feed, repeat)
+    return len(hits), t, 0, {'serial_s': serial, 'speedup': serial / t, 'threads': params['strings'], 'gil': gilEnabled()}
+
+
+def lcOutput(params):
+    ''' the LC flagged output of a Pipeline run at the params' noise rates, and its population '''
+    frame = noiseFrames(params)[0]
+    omkeys = Population.extractPopulation(frame.rpsm)
+    hits = []
+    collect = NullSink()
+    collect.enque = hits.append
+    with quiet():
+        pipeline = Pipeline(collect, omkeys, frame.geometry)
+        feedAll(list(frame.hits()))(pipeline)
+    return hits, omkeys
+
+
+def benchTrigger(params, repeat):
+    hits, _ = lcOutput(params)
+    configs = {'string': MajorityTrigger.TriggerConfig.lookup('string')}
+    t = timeit(lambda: MajorityTrigger(NullSink(), configs), feedAll(hits), repeat)
+    trigger = MajorityTrigger(NullSink(), configs)
+    feedAll(hits)(trigger)
+    return len(hits), t, 0, {'lc_hits': trigger.counted, 'triggers': len(trigger.records.records)}
+
+
+def benchRateMonitor(params, repeat):
+    hits, omkeys = lcOutput(params)
+    interval = params['frame_len'] / 100
+    t = timeit(lambda: RateMonitor(NullSink(), omkeys, interval=interval), feedAll(hits), repeat)
+    monitor = RateMonitor(NullSink(), omkeys, interval=interval)
+    feedAll(hits)(monitor)
+    return len(hits), t, 0, {'channels': len(monitor.index), 'intervals': monitor.intervals}
+
+
+BENCHMARKS = {
+    'SlidingWindow': (benchSlidingWindow, ['noise_rate', 'pmts_per_module', 'frame_len']),
+    'SMLC': (benchSMLC, ['noise_rate', 'pmts_per_module', 'frame_len']),
+    'MMLC': (benchMMLC, ['noise_rate', 'pmts_per_module', 'modules_per_string', 'frame_len']),
+    'PairHeapSorter': (benchSorter(PairHeapSorter), ['noise_rate', 'fan_in', 'frame_len']),
+    'Sorter': (benchSorter(Sorter), ['noise_rate', 'fan_in']),
+    'OMKEYDemuxer': (benchOMKEYDemuxer, ['fan_in']),
+    'StringDemuxer': (benchStringDemuxer, ['fan_in']),
+    'Accumulator': (benchAccumulator, ['noise_rate', 'frame_len']),
+    'Pipeline': (benchPipeline(Pipeline), ['noise_rate', 'pmts_per_module', 'modules_per_string', 'frame_len']),
+    'BatchPipeline': (benchPipeline(BatchPipeline), ['noise_rate', 'pmts_per_module', 'modules_per_string', 'frame_len']),
+    'FusedLCPipeline': (benchPipeline(FusedLCPipeline), ['noise_rate', 'pmts_per_module', 'modules_per_string', 'frame_len']),
+    'ThreadedPipeline': (benchThreaded, ['strings', 'noise_rate']),
+    'MajorityTrigger': (benchTrigger, ['noise_rate', 'modules_per_string', 'frame_len']),
+    'RateMonitor': (benchRateMonitor, ['noise_rate', 'modules_per_string', 'frame_len']),
+}
+
+
+def runAll(names=None, axes=AXES, base=BASE, repeat=3, log=print):
+    ''' run the sweeps, returns a list of result records '''
+    results = []
+    for name, (bench, bench_axes) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        for axis in bench_axes:
+            for value in axes[axis]:
+                params = dict(base)
+                params[axis] = value
+                hits, seconds, peak, extra = bench(params, repeat)
+                record = {
+                    'bench': name,
+                    'axis': axis,
+                    'value': value,
+                    'hits': hits,
+                    'seconds': seconds,
+                    'hits_per_s': hits / seconds if seconds > 0 else None,
+                    'ns_per_hit': seconds * 1e9 / hits if hits > 0 else None,
+                    'peak_buffered': peak,
+                }
+                record.update(extra)
+                results.append(record)
+                log(f'{name:>16} {axis:>18}={value:<10g} hits: {hits:>8} {format(record["hits_per_s"] or 0, ".0f"):>10} hits/s '
+                    f'{format(record["ns_per_hit"] or 0, ".0f"):>7} ns/hit  peak buffered: {peak}')
+    return results
+
+
+def compare(results, baseline, tolerance):
+    ''' flag records whose per-hit cost grew beyond tolerance relative to the baseline '''
+    reference = {(r['bench'], r['axis'], r['value']): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        ref = reference.get((r['bench'], r['axis'], r['value']))
+        if ref is None or not ref['ns_per_hit'] or not r['ns_per_hit']:
+            continue
+        ratio = r['ns_per_hit'] / ref['ns_per_hit']
+        if ratio > 1.0 + tolerance:
+            regressions.append((r, ref, ratio))
+    return regressions
+
+
+def report(results, base=BASE):
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'base': base,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pipeline stage microbenchmarks')
+    parser.add_argument('--bench', action='append', help=f'benchmark to run, repeatable, one of {list(BENCHMARKS)}')
+    parser.add_argument('--quick', action='store_true', help='reduced sweep')
+    parser.add_argument('--repeat', type=int, default=3, help='timing repeats, best is kept')
+    parser.add_argument('--out', help='write results as JSON')
+    parser.add_argument('--save-baseline', help='write results as a baseline JSON')
+    parser.add_argument('--baseline', help='compare against a stored baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed per-hit slowdown vs baseline')
+    args = parser.parse_args(argv)
+
+    base = QUICK_BASE if args.quick else BASE
+    results = runAll(args.bench, QUICK_AXES if args.quick else AXES, base, args.repeat)
+    doc = report(results, base)
+
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(doc, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for r, ref, ratio in regressions:
+            print(f'REGRESSION {r["bench"]} {r["axis"]}={r["value"]}: {ref["ns_per_hit"]:.0f} -> {r["ns_per_hit"]:.0f} ns/hit (x{ratio:.2f})')
+        print(f'{len(regressions)} regressions vs {args.baseline}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
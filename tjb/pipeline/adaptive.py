@@ -0,0 +1,172 @@
+#
+# Per-frame engine choice for isolated frames
+#
+# Sparse frames are cheapest hit by hit in the streaming Pipeline, dense ones in the
+# array kernels of the BatchPipeline, whose per-module and per-string set-up only pays
+# off with enough hits to share it. The Driver asks an EngineChooser for the engine of
+# each frame given the frame's FrameStats, taken from the pulse map at ingest. A frame
+# goes to the batch engine when all of
+#
+#   hits >= min_hits
+#   hits per active channel >= min_occupancy
+#   hits per us >= min_density
+#
+# hold. tune() calibrates the thresholds: both engines process a set of frames of
+# varied size and density (synthetic noise by default) through reused pipelines, as
+# the Driver runs them, and the thresholds giving the least total time over the set
+# are kept. When the kept thresholds send every frame of the set to the same engine they
+# do not separate the engines, tune() marks the chooser degenerate and report() says so,
+# tjb.py then does not save the calibration. There are no built-in thresholds, the crossover depends on the machine and
+# on numba being installed, the Driver tunes an uncalibrated chooser before the run.
+# save()/load() carry a calibration across runs.
+#
+import contextlib
+import io
+import json
+import time
+
+from itertools import product
+
+from pipeline.engines import Engine
+from pipeline.engines import REFERENCE
+from pipeline.injest import Injest
+from pipeline.injest import Population
+from pipeline.pipeline import PipelineTemplate
+from pipeline.shadow import Collect
+
+
+class EngineChooser:
+    ''' picks the streaming or the batch engine per frame from its FrameStats
+
+        streaming, batch: engine names, see engines.Engine
+        log: optional path, a line per frame with its stats, engine and processing time
+    '''
+
+    THRESHOLDS = ('min_hits', 'min_occupancy', 'min_density')
+
+    def __init__(self, streaming=REFERENCE, batch='batch', min_hits=None, min_occupancy=None, min_density=None, log=None):
+        self.streaming = Engine.lookup(streaming).name
+        self.batch = Engine.lookup(batch).name
+        self.min_hits = min_hits
+        self.min_occupancy = min_occupancy
+        self.min_density = min_density
+        self.log = open(log, 'w') if log is not None else None
+        self.frames = {self.streaming: 0, self.batch: 0}
+        self.hits = {self.streaming: 0, self.batch: 0}
+        self.seconds = {self.streaming: 0.0, self.batch: 0.0}
+        self.tuned = None           # (frames, seconds of the tuned choices, streaming only, batch only)
+        self.degenerate = None      # the engine tune() gave every tuning frame to
+
+    def engines(self):
+        return [self.streaming, self.batch]
+
+    def calibrated(self):
+        return all(getattr(self, k) is not None for k in EngineChooser.THRESHOLDS)
+
+    def choose(self, stats):
+        ''' the engine name for a frame '''
+        if not self.calibrated():
+            raise RuntimeError('engine choice is not calibrated, tune() or load() it first')
+        if stats.hits >= self.min_hits and stats.occupancy() >= self.min_occupancy and stats.density() >= self.min_density:
+            return self.batch
+        return self.streaming
+
+    def record(self, frame_id, stats, engine, seconds):
+        ''' a frame was processed by engine in seconds '''
+        self.frames[engine] += 1
+        self.hits[engine] += stats.hits
+        self.seconds[engine] += seconds
+        if self.log is not None:
+            self.log.write(f'{frame_id} {engine} hits: {stats.hits} channels: {stats.channels} span: {stats.span:.0f} '
+                           f'occupancy: {stats.occupancy():.2f} density: {stats.density():.3f} seconds: {seconds:.6f}\n')
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def tune(self, frames=None, repeat=2, ticks=False):
+        ''' calibrate the thresholds on frames (default EngineChooser.tuningFrames()), returns self '''
+        frames = list(frames) if frames is not None else EngineChooser.tuningFrames(ticks)
+        stats = [frame.stats() for frame in frames]
+        streaming = self.time(self.streaming, frames, repeat, ticks)
+        batch = self.time(self.batch, frames, repeat, ticks)
+
+        candidates = [
+            sorted({0} | {s.hits for s in stats}),
+            sorted({0.0} | {s.occupancy() for s in stats}),
+            sorted({0.0} | {s.density() for s in stats}),
+        ]
+        best = None
+        for thresholds in product(*candidates):
+            min_hits, min_occupancy, min_density = thresholds
+            total = sum(b if s.hits >= min_hits and s.occupancy() >= min_occupancy and s.density() >= min_density else t
+                        for s, t, b in zip(stats, streaming, batch))
+            if best is None or total < best[0]:
+                best = (total, thresholds)
+        self.min_hits, self.min_occupancy, self.min_density = best[1]
+        self.tuned = (len(frames), best[0], sum(streaming), sum(batch))
+        chosen = {self.choose(s) for s in stats}
+        self.degenerate = chosen.pop() if len(chosen) == 1 else None
+        return self
+
+    def time(self, engine, frames, repeat, ticks):
+        ''' best of repeat seconds per frame through a reused pipeline, set-up excluded '''
+        template = PipelineTemplate(Collect(), None, None, ticks, Engine.lookup(engine).build)
+        populations = [Population.extractPopulation(frame.rpsm) for frame in frames]
+        with contextlib.redirect_stdout(io.StringIO()):     # the stages print their configuration
+            template.pipelineFor(set().union(*populations))
+        seconds = []
+        for frame, omkeys in zip(frames, populations):
+            best = None
+            for _ in range(repeat):
+                hits = list(frame.hits())
+                template.sink.hits.clear()
+                t0 = time.perf_counter()
+                pipeline = template.pipelineFor(omkeys, frame.geometry)
+                for hit in hits:
+                    pipeline.enque(hit)
+                pipeline.eos()
+                elapsed = time.perf_counter() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            seconds.append(best)
+        template.close()
+        return seconds
+
+    def tuningFrames(ticks=False, seed=0):
+        ''' synthetic noise frames from 1 to 7 strings, 10 us to 10 ms long, at 0.3 to 3 times the nominal
+            rates, and sparse frames of a string, 1 to 100 us long, at 0.01 and 0.1 times the nominal rates
+        '''
+        from pipeline.synthetic import SyntheticSource     # deferred, only for tuning
+        frames = []
+        sparse = product((1,), (1e3, 1e4, 1e5), (0.01, 0.1))
+        for strings, frame_len, scale in list(product((1, 7), (1e4, 1e5, 1e6, 1e7), (0.3, 3.0))) + list(sparse):
+            config = SyntheticSource.NoiseConfig(strings=range(87, 87 + strings), frame_len=frame_len,
+                                                 degg_rate=1000.0 * scale, mdom_rate=300.0 * scale, burst_rate=100.0 * scale)
+            source = SyntheticSource(config, seed, 1)
+            frames.extend(frame for frame in Injest(source.files(1, f'tune-{strings}-{frame_len:g}-{scale:g}'), source, ticks=ticks).upgradePulseFrames()
+                          if frame.stats().hits > 0)
+        return frames
+
+    def settings(self):
+        return {'streaming': self.streaming, 'batch': self.batch, **{k: getattr(self, k) for k in EngineChooser.THRESHOLDS}}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.settings(), f, indent=1)
+
+    def load(path, log=None):
+        ''' a chooser with the settings saved by EngineChooser.save '''
+        with open(path) as f:
+            return EngineChooser(**json.load(f), log=log)
+
+    def report(self):
+        lines = [f'engine choice: batch ({self.batch}) when hits >= {self.min_hits}, occupancy >= {self.min_occupancy:.2f}/channel, '
+                 f'density >= {self.min_density:.3f}/us']
+        if self.tuned is not None:
+            n, chosen, streaming, batch = self.tuned
+            lines.append(f'  tuned on {n} frames: chosen {chosen:.3f} s, {self.streaming} only {streaming:.3f} s, {self.batch} only {batch:.3f} s')
+        if self.degenerate is not None:
+            lines.append(f'  degenerate: every tuning frame went to {self.degenerate}, the thresholds do not separate the engines')
+        for engine in self.engines():
+            lines.append(f'  {engine:>10}: frames: {self.frames[engine]} hits: {self.hits[engine]} seconds: {self.seconds[engine]:.3f}')
+        return lines
@@ -0,0 +1,148 @@
+#
+# Batch engine: buffers a unit of hits, runs the SMLC/MMLC kernels over array-backed
+# copies of the per-module and per-string streams and releases the marked hits in
+# time order at eos.
+#
+# Same sink interface and flags as Pipeline, but it holds the whole unit (a frame in
+# isolated mode) so it is suited to dense frames rather than long joined streams.
+#
+from array import array
+
+from pipeline.injest import Geometry
+from pipeline.injest import Population
+from pipeline.pipeline import Pipeline
+from pipeline.pipeline import Topology
+from uglc.kernels import HitArrays
+from uglc.kernels import MMLC_BIT
+from uglc.kernels import SMLC_BIT
+from uglc.kernels import asKernelArray
+from uglc.kernels import mmlcFlags
+from uglc.kernels import smlcFlags
+from uglc.mmlc import MMLC
+
+
+def byTime(hit):
+    return hit.resolveTime()
+
+
+class BatchPipeline(Pipeline):
+    '''Marks UGLC status with array kernels, drop-in for Pipeline
+
+        The topology's input and output taps and its trigger, event builder and monitor
+        are built as in Pipeline. The per-module and per-string boundaries do not exist,
+        taps there and the merger choices are ignored. The unit is held in memory until
+        eos, a budget does not apply and watermarks release nothing.
+    '''
+
+    class Unit:
+        ''' buffers the hits per channel until eos, then has the pipeline mark and release them '''
+
+        def __init__(self, pipeline, sink):
+            self.pipeline = pipeline
+            self.sink = sink
+            self.by_channel = {omk: [] for omk in pipeline.om_keys}
+
+        def enque(self, hit):
+            ''' per-channel time order is all that is required '''
+            self.by_channel[hit.omkey].append(hit)
+
+        def eos(self):
+            for hit in self.pipeline.mark(self.by_channel):
+                self.sink.enque(hit)
+            self.reset()
+            self.sink.eos()
+
+        def watermark(self, t):
+            pass            # everything is held until eos
+
+        def reset(self):
+            for hits in self.by_channel.values():
+                hits.clear()
+
+    def __init__(self, sink, all_omkeys, geometry=None, topology=None, budget=None, ticks=False):
+        self.sink = sink
+        self.om_keys = all_omkeys
+        self.ticks = ticks          # hits timed in int64 DAQ ticks
+        self.budget = budget
+        self.nodes = []
+        self.taps = {}
+        self.trigger = None
+        self.events = None
+        self.monitor = None
+        topo = topology if topology is not None else Topology()
+        self.topology = topo.withTaps({b: specs for b, specs in topo.taps.items() if b in ('input', 'output')})
+
+        # dynamically learning the geometry
+        # this should come from a static source
+        if geometry is None:
+            geometry = Geometry.deduceGeometry(all_omkeys)
+        self.by_module = Population.byModule(self.om_keys)
+        self.byString = Population.byString(self.om_keys)
+
+        self.device_type = {k: geometry.lookup(k) for k in self.by_module.keys()}
+        self.smlc_cfg = {k: self.smlcConfig(device_type) for k, device_type in self.device_type.items()}
+        self.mmlc_cfg = {k: MMLC.MMLCConfig(k) for k in self.byString.keys()}
+        if ticks:
+            self.mmlc_cfg = {k: c.inTicks() for k, c in self.mmlc_cfg.items()}
+
+        self.unit = self.add(BatchPipeline.Unit(self, self.buildOutput(sink)))
+        self.input_node = self.topology.tapped(self, 'input', None, self.unit)
+        if self.topology.fuse:
+            self.enque = self.input_node.enque
+
+    def reset(self, omkeys=None, geometry=None):
+        ''' ready for another unit, modules deduced as another device type are reconfigured '''
+        self.resetStages()
+        if geometry is not None:
+            for k, device_type in geometry.table.items():
+                if k in self.smlc_cfg and self.device_type[k] != device_type:
+                    self.device_type[k] = device_type
+                    self.smlc_cfg[k] = self.smlcConfig(device_type)
+
+    def mark(self, by_channel):
+        ''' mark the buffered hits, returns them in time order '''
+        by_string = {k: [] for k in self.byString.keys()}
+        for module_key, omkeys in self.by_module.items():
+            hits = [h for omk in omkeys for h in by_channel[omk]]
+            if not hits:
+                continue
+            hits.sort(key=byTime)
+            self.smlc(module_key, HitArrays(hits, self.ticks))
+            by_string[module_key.string].extend(hits)
+
+        released = []
+        for string, hits in by_string.items():
+            if not hits:
+                continue
+            hits.sort(key=byTime)
+            self.mmlc(string, HitArrays(hits, self.ticks))
+            released.extend(hits)
+
+        released.sort(key=byTime)
+        return released
+
+    def smlc(self, module_key, buf):
+        cfg = self.smlc_cfg[module_key]
+        flags = buf.newFlags()
+        smlcFlags(asKernelArray(buf.times), cfg.window_len, cfg.multiplicity, asKernelArray(flags))
+        for hit, f in zip(buf.hits, flags):
+            if f & SMLC_BIT:
+                hit.markSMLC()
+
+    def mmlc(self, string, buf):
+        cfg = self.mmlc_cfg[string]
+        by_device = {Geometry.DeviceType.DEGG: cfg.degg_cfg, Geometry.DeviceType.MDOM: cfg.mdom_cfg}
+        try:
+            module_cfgs = [by_device[hit.device_type] for hit in buf.hits]
+        except KeyError as e:
+            raise RuntimeError(f'Unsupported device: {e}');
+        t_back = array(buf.times.typecode, [c.t_back for c in module_cfgs])
+        t_fwd = array(buf.times.typecode, [c.t_fwd for c in module_cfgs])
+        multiplicity = array('q', [c.multiplicity for c in module_cfgs])
+
+        flags = buf.newFlags()
+        mmlcFlags(asKernelArray(buf.times), asKernelArray(buf.oms), asKernelArray(t_back),
+                  asKernelArray(t_fwd), asKernelArray(multiplicity), asKernelArray(flags))
+        for hit, f in zip(buf.hits, flags):
+            if f & MMLC_BIT:
+                hit.markMMLC()
@@ -0,0 +1,249 @@
+#
+# On-disk cache of processing results, so re-running a notebook or rebuilding plots over
+# the same files does not re-ingest and re-process them.
+#
+# An entry holds the FrameResults of one unit of work: a file in isolated mode, the
+# whole file list in joined mode (every frame depends on the ones before it). It is
+# keyed by the input content hash, mode, selection, the SMLC/MMLC configuration values
+# and the engine version; inside it frames are kept by frame id with their counts and
+# per-hit channel, time and flags.
+#
+# Entries are evicted least recently used first once the cache exceeds its size bound.
+#
+import contextlib
+import hashlib
+import io
+import os
+import pickle
+
+from array import array
+from collections import namedtuple
+
+from pipeline.injest import Geometry
+from pipeline.injest import toTicks
+from uglc.kernels import MMLC_BIT
+from uglc.kernels import SMLC_BIT
+from uglc.mmlc import MMLC
+from uglc.smlc import SMLC
+
+
+# bump whenever a change to the LC logic or to the hit order would change results
+ENGINE_VERSION = 3      # 2: joined-mode frames are laid end to end, no doubling of last_pit
+                        # 3: records keep the ticks time base of their run
+
+
+# channel of a served hit, the original OMKey objects are not kept
+CachedKey = namedtuple('CachedKey', ['string', 'om', 'pmt'])
+
+
+class CachedHit:
+    ''' a processed hit served from the cache '''
+
+    __slots__ = ('omkey', 'time', 't_offset', 'smlc', 'mmlc', 'ticks')
+
+    def __init__(self, omkey, time, t_offset, smlc, mmlc, ticks=False):
+        self.omkey = omkey
+        self.time = time
+        self.t_offset = t_offset
+        self.smlc = smlc
+        self.mmlc = mmlc
+        self.ticks = ticks
+
+    def resolveTime(self):
+        ''' in DAQ ticks for a ticks run, like injest.TickHit '''
+        if self.ticks:
+            return toTicks(self.time) + toTicks(self.t_offset)
+        return self.time + self.t_offset
+
+    def rawTime(self):
+        return self.time
+
+
+class FrameRecord:
+    ''' compact form of a FrameResult '''
+
+    def __init__(self, result):
+        self.frame_id = result.frame_id
+        self.t_start = result.t_start
+        self.t_end = result.t_end
+        self.t_offset = result.t_offset
+        self.ticks = result.ticks
+        self.smlc_cnt = result.smlc_cnt
+        self.mmlc_cnt = result.mmlc_cnt
+
+        channels = {}
+        self.channels = []
+        self.channel = array('I')
+        self.times = array('d')
+        self.flags = bytearray()
+        for hit in result.hits:
+            key = (hit.omkey.string, hit.omkey.om, hit.omkey.pmt)
+            index = channels.get(key)
+            if index is None:
+                index = channels[key] = len(self.channels)
+                self.channels.append(key)
+            self.channel.append(index)
+            self.times.append(hit.rawTime())
+            self.flags.append((SMLC_BIT if hit.smlc else 0) | (MMLC_BIT if hit.mmlc else 0))
+
+    def hits(self):
+        keys = [CachedKey(*k) for k in self.channels]
+        return [CachedHit(keys[c], t, self.t_offset, bool(f & SMLC_BIT), bool(f & MMLC_BIT), self.ticks)
+                for c, t, f in zip(self.channel, self.times, self.flags)]
+
+
+def contentHash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def configSignature():
+    ''' the LC configuration values results depend on '''
+    smlc = {d.name: (c.window_len, c.multiplicity)
+            for d in Geometry.DeviceType for c in [SMLC.SMLCConfig.lookup(d)]}
+    with contextlib.redirect_stdout(io.StringIO()):     # MMLCConfig logs its values
+        cfg = MMLC.MMLCConfig(None)
+    mmlc = {name: (c.t_back, c.t_fwd, c.span_up, c.span_down, c.multiplicity)
+            for name, c in (('DEGG', cfg.degg_cfg), ('MDOM', cfg.mdom_cfg))}
+    return repr((sorted(smlc.items()), sorted(mmlc.items()), cfg.MAX_WINDOW))
+
+
+class ResultCache:
+    ''' size-bounded LRU cache of FrameResults on disk
+
+        path:      cache directory, created if missing
+        max_bytes: entries are evicted least recently used first beyond this size
+    '''
+
+    def __init__(self, path, max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.config = configSignature()
+        self.__fingerprints = None      # (path, size, mtime) -> content hash, saves re-hashing unchanged files
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+        self.__evict()                  # the bound may have been lowered since the last run
+
+    def fingerprint(self, reader, fname):
+        ''' content hash of an input, from the reader when it can tell (synthetic data) '''
+        if hasattr(reader, 'fingerprint'):
+            return reader.fingerprint(fname)
+
+        st = os.stat(fname)
+        stat_key = (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+        memo = self.__loadFingerprints()
+        if stat_key not in memo:
+            memo[stat_key] = contentHash(fname)
+            self.__atomicWrite(os.path.join(self.path, 'fingerprints.pkl'), memo)
+        return memo[stat_key]
+
+    def key(self, fingerprints, mode, selection=None, engine='Pipeline'):
+        ''' entry key of a unit of work over inputs with the given fingerprints '''
+        parts = repr((list(fingerprints), mode, repr(selection), self.config, engine, ENGINE_VERSION))
+        return hashlib.sha256(parts.encode()).hexdigest()
+
+    def get(self, key):
+        ''' the FrameRecords of an entry, in delivery order, or None '''
+        entry = self.__entryPath(key)
+        try:
+            with open(entry, 'rb') as f:
+                records = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+        os.utime(entry)                 # mtime orders the LRU
+        self.hits += 1
+        return records
+
+    def put(self, key, results):
+        ''' store the FrameResults of a unit of work '''
+        self.__atomicWrite(self.__entryPath(key), [FrameRecord(r) for r in results])
+        self.stores += 1
+        self.__evict()
+
+    def size(self):
+        return sum(size for _, size, _ in self.__entries())
+
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = f'{self.hits / lookups:.0%}' if lookups else '-'
+        return [f'result cache {self.path}: hits: {self.hits} misses: {self.misses} hit rate: {rate} '
+                f'stores: {self.stores} evictions: {self.evictions} size: {self.size()} of {self.max_bytes} bytes']
+
+    def __entryPath(self, key):
+        return os.path.join(self.path, f'{key}.result')
+
+    def __entries(self):
+        ''' (path, size, mtime) of the entries '''
+        for name in os.listdir(self.path):
+            if name.endswith('.result'):
+                p = os.path.join(self.path, name)
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:
+                    continue
+                yield (p, st.st_size, st.st_mtime_ns)
+
+    def __evict(self):
+        entries = sorted(self.__entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for p, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def __loadFingerprints(self):
+        if self.__fingerprints is None:
+            try:
+                with open(os.path.join(self.path, 'fingerprints.pkl'), 'rb') as f:
+                    self.__fingerprints = pickle.load(f)
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                self.__fingerprints = {}
+        return self.__fingerprints
+
+    def __atomicWrite(self, path, obj):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+
+class ResultRecorder:
+    ''' consumer wrapper that keeps the delivered FrameResults for storing in the cache '''
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.results = []
+        self.complete = True        # False once a resume skipped frames delivered earlier
+
+    def consume(self, result):
+        self.results.append(result)
+        self.consumer.consume(result)
+
+    def resume(self, delivered):
+        if delivered > 0:
+            self.complete = False
+        if hasattr(self.consumer, 'resume'):
+            self.consumer.resume(delivered)
+
+    def byFile(self):
+        ''' results grouped by the file part of their frame id '''
+        by_file = {}
+        for result in self.results:
+            fname, _, _ = result.frame_id.rpartition(':')
+            by_file.setdefault(fname, []).append(result)
+        return by_file
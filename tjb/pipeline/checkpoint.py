@@ -0,0 +1,48 @@
+#
+# Checkpoints of joined-mode runs, taken at frame boundaries.
+#
+# The whole in-flight state is pickled in one go, so objects shared between the
+# pipeline, the budget and the accumulator keep their identity: sorter buffers,
+# SlidingWindow contents, MMLC held/pending windows, the Accumulator's pending frames
+# (without its consumer) and the Injest position including the running last_pit.
+#
+import os
+import pickle
+
+
+class Checkpoint:
+    ''' state of a joined run after a frame
+
+        files:    the run's file list, a resume must be over the same files
+        position: injest.InjestPosition of the last frame pushed into the pipeline
+        pipeline: the Pipeline, its sink is the accumulator
+        acc:      the driver.Accumulator, delivered counts the frames already consumed
+    '''
+
+    VERSION = 2
+
+    def __init__(self, files, position, pipeline, acc):
+        self.version = Checkpoint.VERSION
+        self.files = list(files)
+        self.position = position
+        self.pipeline = pipeline
+        self.acc = acc
+
+    def save(self, path):
+        ''' write atomically, a crash mid-write leaves the previous checkpoint in place '''
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def load(path):
+        ''' the checkpoint at path, None if there is none '''
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if getattr(checkpoint, 'version', None) != Checkpoint.VERSION:
+            raise RuntimeError(f'Checkpoint {path} has version {getattr(checkpoint, "version", None)}, expected {Checkpoint.VERSION}')
+        return checkpoint
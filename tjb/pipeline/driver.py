@@ -1,109 +1,427 @@
+import os
+
 from collections import deque
 
+from pipeline.cache import ResultRecorder
+from pipeline.checkpoint import Checkpoint
+from pipeline.engines import Engine
+from pipeline.engines import REFERENCE
 from pipeline.pipeline import Stopwatch
 from pipeline.pipeline import Counter
-from pipeline.pipeline import Pipeline
+from pipeline.pipeline import PipelineTemplate
+from pipeline.pipeline import Topology
+from pipeline.injest import Geometry
 from pipeline.injest import Injest
 from pipeline.injest import Population
+from pipeline.injest import toTicks
+
+
+# in/out hit counts are read from counter taps at the pipeline boundaries, fused into the
+# demuxer on the way in
+COUNTED = Topology(taps={'input': ['count'], 'output': ['count']})
+
+
+def counted(topology):
+    ''' topology with the in/out counter taps added '''
+    if topology is None:
+        return COUNTED
+    taps = {b: list(specs) for b, specs in topology.taps.items()}
+    for boundary in ('input', 'output'):
+        taps[boundary] = ['count'] + taps.get(boundary, [])
+    return topology.withTaps(taps)
 
 
 class Driver: 
     ''' Sets up an UGLC processing pipline sourced from I3 files promoting processed hits to the specivied sink'''
 
-    def __init__(self, consumer, mode=0):
+    def __init__(self, consumer, mode=0, reader=None, selection=None, workers=0, budget=None, checkpoint=None, checkpoint_every=10, cache=None, ticks=False, trace=None, topology=None, engine=REFERENCE, decoders=0, shadow=None, adaptive=None):
         ''' 
         Set up an upgrade LC processing pipeline
 
             mode: 0=each frame is an independent unit of data
             mode: 1=the entire file set is a unit, pulse times will be offset to create a well ordered frame-by-frame hit stream
+            reader: pulse map source handed to Injest, None reads I3Files
+            selection: optional injest.Selection, restricts frames/channels/times before hits are built
+                       and thereby the population the pipeline is plumbed for
+            workers: isolated mode only, >0 processes frames on that many worker processes fed
+                     through a shared-memory hit ring (pipeline.shm)
+            budget: optional spill.MemoryBudget, caps the hits buffered per stage and spills
+                    the excess to disk, the per-stage high-water marks are reported at the end
+            checkpoint: joined mode only, path of a checkpoint file. The run state is saved there
+                    every checkpoint_every frames and a run finding one resumes from it. Frames
+                    delivered after the checkpoint was taken are delivered again on resume, a
+                    consumer with a resume(delivered) method is told how many frames it had
+                    when the checkpoint was taken. Removed once the run completes.
+            cache: optional cache.ResultCache, units of work (a file in isolated mode, the whole
+                    file list in joined mode) found there are served without ingest or processing,
+                    the others are stored once processed. Served units skip the pipeline, not
+                    supported with a trigger, event builder, monitor or trace that need its hits
+            ticks: carry hit times as int64 DAQ ticks (0.1 ns) from ingest on, offsets folded in
+                    at ingest, window lengths converted, all time compares exact
+            trace: optional trace.Tracer, a sample of the hits is stamped at every stage boundary
+                    and on delivery, per-stage latency histograms are reported at the end
+            topology: optional pipeline.Topology, stage choices (mergers), trigger, event builder,
+                    monitor and taps of the pipelines built, not supported with workers
+            engine: name of the engines.Engine building the pipelines, e.g. 'threaded' runs each
+                    string's SMLC/MMLC chain on its own thread, 'batch' marks with array kernels.
+                    Workers run the reference engine
+            decoders: >0 decodes the input files ahead on that many processes, frames are
+                    still delivered in file/frame order (injest.Injest)
+            shadow: optional shadow.Shadow, a sample of the frames is run through the reference
+                    and a candidate engine on the side, mismatches and speeds are reported at the end
+            adaptive: optional adaptive.EngineChooser, isolated mode only, each frame is processed by
+                    the streaming or the batch engine it picks from the frame's injest.FrameStats,
+                    the choices are logged and reported at the end, engine is then ignored
         '''
         self.consumer = consumer  # receives completed hits on a frame-by-frame basis
         self.mode = mode
+        self.reader = reader
+        self.selection = selection
+        self.workers = workers
+        self.budget = budget
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.cache = cache
+        self.ticks = ticks
+        self.trace = trace
+        if trace is not None:
+            trace.ticks = ticks
+        self.base_topology = topology
+        self.engine_spec = Engine.lookup(engine)
+        self.decoders = decoders
+        self.shadow = shadow
+        self.adaptive = adaptive
+        if shadow is not None:
+            shadow.ticks = ticks
+        self.topology = counted(topology)
+        if trace is not None:
+            self.topology = trace.topology(self.topology)
 
     def process_all_files(self, files): 
-        if self.mode == 0:
-           self.__process_isolated(files)
+        if self.checkpoint is not None and self.mode != 1:
+            raise RuntimeError('checkpoints are only supported in joined mode')
+        if self.workers > 0 and self.budget is not None:
+            raise RuntimeError('a memory budget is not supported with workers, hits in the ring cannot be spilled')
+        if self.mode == 1 and self.workers > 0:
+            raise RuntimeError('joined mode is a single stream, workers are not supported')
+        if self.workers > 0 and self.trace is not None:
+            raise RuntimeError('tracing is not supported with workers')
+        if self.workers > 0 and self.base_topology is not None:
+            raise RuntimeError('a topology is not supported with workers, they run the default pipeline')
+        if self.workers > 0 and self.engine_spec.name != REFERENCE:
+            raise RuntimeError(f'engine {self.engine_spec.name} is not supported with workers, they run the reference engine')
+        if self.adaptive is not None and (self.mode != 0 or self.workers > 0):
+            raise RuntimeError('a per-frame engine choice needs isolated frames processed in this process')
+        if self.checkpoint is not None and not self.engine_spec.checkpoints:
+            raise RuntimeError(f'engine {self.engine_spec.name} does not support checkpoints')
+        if self.cache is not None and (self.trace is not None or (self.base_topology is not None and (
+                self.base_topology.trigger is not None or self.base_topology.events is not None or self.base_topology.monitor is not None))):
+            raise RuntimeError('the result cache serves hits without running the pipeline, a trigger, event builder, monitor or trace would see none of them')
+        if self.mode == 1 and not self.engine_spec.streaming:
+            raise RuntimeError(f'engine {self.engine_spec.name} holds the whole stream until eos, it is not supported in joined mode')
+
+        if self.adaptive is not None and not self.adaptive.calibrated():
+            print('calibrating the engine choice...')
+            self.adaptive.tune(ticks=self.ticks)
+
+        if self.cache is not None:
+            self.__process_cached(files)
+        elif self.mode == 0 and self.workers > 0:
+           self.__process_isolated_parallel(files, self.consumer)
+        elif self.mode == 0:
+           self.__process_isolated(files, self.consumer)
         elif self.mode == 1:
-            self.__process_joined(files)
+            self.__process_joined(files, self.consumer)
+
+        if self.trace is not None:
+            for line in self.trace.report():
+                print(line)
+        if self.shadow is not None:
+            for line in self.shadow.report():
+                print(line)
+
+    def engine(self):
+        ''' the pipeline builder of the engine '''
+        return self.engine_spec.build
+
+    def frames(self, injest, **kwargs):
+        ''' the frames of injest, through the shadow when there is one '''
+        frames = injest.upgradePulseFrames(**kwargs)
+        return self.shadow.watch(frames) if self.shadow is not None else frames
+
+    def engineName(self):
+        ''' names what results depend on besides the inputs, keys the result cache
+
+            the engine, or the per-frame choice with its settings, and the mergers when
+            a streaming engine runs them, the batch engine has none
+        '''
+        if self.adaptive is not None:
+            name = f'adaptive{sorted(self.adaptive.settings().items())}'
+            engines = self.adaptive.engines()
+        else:
+            name = self.engine_spec.name
+            engines = [name]
+        if self.ticks:
+            name += '/ticks'
+        mergers = self.topology.mergers
+        if any(Engine.lookup(e).streaming for e in engines) and any(spec != 'pairheap' for spec in mergers.values()):
+            name += f'/{sorted(mergers.items())}'
+        return name
+
+    def __process_cached(self, files):
+        ''' serve the cached units of work, process and store the others in order '''
+        reader = self.reader
+        if reader is None:
+            from pipeline.i3reader import I3Reader     # fingerprints need no icetray, reading does
+            reader = self.reader = I3Reader()
+
+        def process(batch):
+            recorder = ResultRecorder(self.consumer)
+            names = [fname for fname, _ in batch]
+            if self.mode == 1:
+                self.__process_joined(names, recorder)
+            elif self.workers > 0:
+                self.__process_isolated_parallel(names, recorder)
+            else:
+                self.__process_isolated(names, recorder)
+            if not recorder.complete:
+                return
+            if self.mode == 1:
+                self.cache.put(batch[0][1], recorder.results)      # one entry for the run
+            else:
+                by_file = recorder.byFile()
+                for fname, key in batch:
+                    self.cache.put(key, by_file.get(fname, []))
+
+        def serve(records):
+            for record in records:
+                self.consumer.consume(FrameResult.restore(record))
+
+        if self.mode == 1:
+            key = self.cache.key([self.cache.fingerprint(reader, f) for f in files], self.mode, self.selection, self.engineName())
+            records = self.cache.get(key)
+            if records is not None:
+                print(f'serving {len(records)} joined frames from the result cache')
+                serve(records)
+            else:
+                process([(f, key) for f in files])     # all files share the run's key
+        else:
+            uncached = []      # consecutive files to process in one go
+            for fname in files:
+                key = self.cache.key([self.cache.fingerprint(reader, fname)], self.mode, self.selection, self.engineName())
+                records = self.cache.get(key)
+                if records is None:
+                    uncached.append((fname, key))
+                    continue
+                if uncached:
+                    process(uncached)
+                    uncached = []
+                print(f'serving {len(records)} frames of {fname} from the result cache')
+                serve(records)
+            if uncached:
+                process(uncached)
+
+        for line in self.cache.report():
+            print(line)
      
-    def __process_isolated(self, files): 
-        ''' each frame is an independent unit of pulses with no defined correlation to other frames '''
+    def __process_isolated(self, files, consumer): 
+        ''' each frame is an independent unit of pulses with no defined correlation to other frames
+
+            one pipeline is reset for each frame, rebuilt when a frame brings new channels,
+            one per engine when the engine is chosen per frame
+        '''
         sw = Stopwatch()
-        injest = Injest(files)
+        injest = Injest(files, self.reader, self.selection, self.ticks, self.decoders)
+        acc = Accumulator(consumer, self.ticks, self.trace)      # empty again after each frame's eos
+        templates = {}
+        for name in (self.adaptive.engines() if self.adaptive is not None else [self.engine_spec.name]):
+            engine = Engine.lookup(name)
+            # a budget caps the streaming buffers, the batch engine holds the frame regardless
+            templates[name] = PipelineTemplate(acc, self.topology, self.budget if engine.streaming else None, self.ticks, engine.build)
         cum_in=0
         cum_out=0
-        for frame in injest.upgradePulseFrames(join=False):
-            acc = Accumulator(self.consumer)
+        for frame in self.frames(injest, join=False):
             acc.expectFrame(frame.frame_id, frame.rpsm)
+            if self.trace is not None:
+                self.trace.restart()
            
             split_sw = Stopwatch()
-            print(f'processing frame {frame.frame_id}...')
+            if self.adaptive is not None:
+                name = self.adaptive.choose(frame.stats())
+                print(f'processing frame {frame.frame_id} with {name}, {frame.stats()}...')
+            else:
+                name = self.engine_spec.name
+                print(f'processing frame {frame.frame_id}...')
             omkeys = Population.extractPopulation(frame.rpsm)
-            out_counter = Counter(acc)
-            in_counter = Counter(Pipeline(out_counter, omkeys))
+            pipeline = templates[name].pipelineFor(omkeys, frame.geometry)
+            in_counter = pipeline.tap('input', Counter)
+            out_counter = pipeline.tap('output', Counter)
             for hit in frame.hits():
-                in_counter.enque(hit)
+                pipeline.enque(hit)
             print(f'eos(frame) {frame.frame_id}...')
-            in_counter.eos()
+            pipeline.eos()
             cum_in += in_counter.cnt
             cum_out += out_counter.cnt
-            print(f'Frame completed hits[ in:{in_counter.cnt} out:{out_counter.cnt} held:{in_counter.cnt - out_counter.cnt}] process time seconds {split_sw.elapsed()}')
+            elapsed = split_sw.elapsed()
+            if self.adaptive is not None:
+                self.adaptive.record(frame.frame_id, frame.stats(), name, elapsed)
+            print(f'Frame completed hits[ in:{in_counter.cnt} out:{out_counter.cnt} held:{in_counter.cnt - out_counter.cnt}] process time seconds {elapsed}')
        
         print(f'Processing completed hits[ in:{cum_in} out:{cum_out} held:{cum_in - cum_out}] process time seconds {sw.elapsed()}')
+        for template in templates.values():
+            if template.builds > 0:
+                print(template.report())
+            template.close()
+        if self.adaptive is not None:
+            self.adaptive.close()
+            for line in self.adaptive.report():
+                print(line)
+        self.__reportBudget(self.budget)
+
+    def __reportBudget(self, budget):
+        if budget is not None:
+            print('Buffered hits per stage:')
+            for line in budget.report():
+                print(line)
 
     
 
-    def __process_joined(self, files): 
-        ''' join all frames into a monotonic stream with each frame seperated by delta ticks '''
-        acc = Accumulator(self.consumer)
+    def __process_isolated_parallel(self, files, consumer):
+        ''' independent frames farmed out to worker processes, results delivered in frame order '''
+        from pipeline.shm import RingWorkers
 
         sw = Stopwatch()
+        cnt = 0
 
-        out_counter = Counter(self.sink)
-        in_counter = None; # need the first frame(s) to learn the population
-        
+        def collect(frame, hits):
+            nonlocal cnt
+            result = FrameResult(frame.frame_id, frame.rpsm)
+            for hit in sorted(hits, key=lambda h: h.resolveTime()):
+                result.add(hit)
+            cnt += len(hits)
+            consumer.consume(result)
 
-        injest = Injest(files)
-        # peek the frames to learn the population
-        peek = []
-        for frame in injest.upgradePulseFrames(join=True):
-            peek.append(frame.rpsm)
-        omkeys = Population.extractPopulation(*peek)
+        injest = Injest(files, self.reader, self.selection, self.ticks, self.decoders)
+        RingWorkers(self.workers, ticks=self.ticks).process(self.frames(injest, join=False), collect)
+        print(f'Processing completed hits[ in:{cnt} out:{cnt}] on {self.workers} workers, process time seconds {sw.elapsed()}')
 
-        for frame in injest.upgradePulseFrames(join=True):
-            acc.expectFrame(frame.frame_id, frame.rpsm)
+    def __process_joined(self, files, consumer): 
+        ''' join all frames into a monotonic stream with each frame seperated by delta ticks '''
+        sw = Stopwatch()
+
+        injest = Injest(files, self.reader, self.selection, self.ticks, self.decoders)
+
+        resumed = Checkpoint.load(self.checkpoint) if self.checkpoint is not None else None
+        if resumed is not None:
+            if resumed.files != list(files):
+                raise RuntimeError(f'checkpoint {self.checkpoint} is for a different file list')
+            print(f'resuming after frame {resumed.position}, {resumed.acc.delivered} frames delivered')
+            acc = resumed.acc
+            acc.consumer = consumer
+            acc.tracer = self.trace
+            if self.trace is not None:
+                self.trace.resume(resumed.pipeline)
+            if hasattr(consumer, 'resume'):
+                consumer.resume(acc.delivered)
+            pipeline = resumed.pipeline
+            in_counter = pipeline.tap('input', Counter)
+            out_counter = pipeline.tap('output', Counter)
+            position = resumed.position
+            resumed = None
+        else:
+            acc = Accumulator(consumer, self.ticks, self.trace)
+            pipeline = None; # need the first frame(s) to learn the population
+            position = None
+
+            # peek the frames to learn the population
+            peek = []
+            geometries = []
+            for frame in injest.upgradePulseFrames(join=True):
+                peek.append(frame.rpsm)
+                geometries.append(frame.geometry)
+            omkeys = Population.extractPopulation(*peek)
+            geometry = Geometry.merge(*geometries)
+            peek = None
+
+        since_checkpoint = 0
+        for frame in self.frames(injest, join=True, resume=position):
+            acc.expectFrame(frame.frame_id, frame.rpsm, frame.group.t_offest)
             split_sw = Stopwatch()
             print(f'processing frame {frame.frame_id}...')
             
-            if in_counter is None:
-                in_counter = Counter(Pipeline(out_counter, omkeys))
+            if pipeline is None:
+                pipeline = self.engine()(acc, omkeys, geometry, self.topology, self.budget, self.ticks)
+                in_counter = pipeline.tap('input', Counter)
+                out_counter = pipeline.tap('output', Counter)
 
             for hit in frame.hits():
-                in_counter.enque(hit)
+                pipeline.enque(hit)
                 
             print(f'Frame completed hits[ in:{in_counter.cnt} out:{out_counter.cnt} held:{in_counter.cnt - out_counter.cnt}] process time seconds {split_sw.elapsed()}')
+
+            since_checkpoint += 1
+            if self.checkpoint is not None and since_checkpoint >= self.checkpoint_every:
+                Checkpoint(files, injest.position, pipeline, acc).save(self.checkpoint)
+                print(f'checkpoint after frame {injest.position}')
+                since_checkpoint = 0
         
         print(f'eos(all files)...')
-        in_counter.eos()
+        pipeline.eos()
         print(f'Processing completed hits[ in:{in_counter.cnt} out:{out_counter.cnt} held:{in_counter.cnt - out_counter.cnt}] process time seconds {sw.elapsed()}')
+        if pipeline.budget is not None:
+            pipeline.budget.release()
+        if hasattr(pipeline, 'close'):
+            pipeline.close()
+        self.__reportBudget(pipeline.budget)
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
 
 
 
 
 class FrameResult:
     ''' holds processed hits on a frame-by-frame boundary '''
-    def __init__(self, frame_id, rpsm):
+    def __init__(self, frame_id, rpsm, t_offset=0, ticks=False):
         # set up empty pulse series map
         self.frame_id = frame_id
         self.rpsm = rpsm
         t_start, t_end = Population.extractTimeInterval(rpsm)
         self.t_start = t_start
         self.t_end = t_end
+        self.t_offset = t_offset    # joined mode offset, hits arrive at t_start + t_offset .. t_end + t_offset
+        self.ticks = ticks
+        # the same interval in the hits' time base, DAQ ticks folded like injest.TickHit
+        if ticks:
+            self.resolved_start = toTicks(t_start) + toTicks(t_offset)
+            self.resolved_end = toTicks(t_end) + toTicks(t_offset)
+        else:
+            self.resolved_start = t_start + t_offset
+            self.resolved_end = t_end + t_offset
         self.hits = []
         self.smlc_cnt = 0
         self.mmlc_cnt = 0
 
 
+    def restore(record):
+        ''' a FrameResult served from a cache.FrameRecord, no pulse map behind it '''
+        result = FrameResult.__new__(FrameResult)
+        result.frame_id = record.frame_id
+        result.rpsm = None
+        result.t_start = record.t_start
+        result.t_end = record.t_end
+        result.t_offset = record.t_offset
+        result.ticks = record.ticks
+        if record.ticks:
+            result.resolved_start = toTicks(record.t_start) + toTicks(record.t_offset)
+            result.resolved_end = toTicks(record.t_end) + toTicks(record.t_offset)
+        else:
+            result.resolved_start = record.t_start + record.t_offset
+            result.resolved_end = record.t_end + record.t_offset
+        result.hits = record.hits()
+        result.smlc_cnt = record.smlc_cnt
+        result.mmlc_cnt = record.mmlc_cnt
+        return result
+
     def add(self, hit):
         self.hits.append(hit)
         if hit.smlc:
@@ -114,22 +432,25 @@ class FrameResult:
 class Accumulator:
     '''Gathers processing output on a frame-by-frame basis'''
 
-    def __init__(self, consumer):
+    def __init__(self, consumer, ticks=False, tracer=None):
         self.consumer = consumer  # completed frames will be sent here
         self.pending =  deque()   # holder for backlog of pendig frames
+        self.delivered = 0        # frames sent to the consumer
+        self.ticks = ticks        # hits are timed in DAQ ticks
+        self.tracer = tracer      # optional trace.Tracer, stamps the sampled hits on delivery
 
-    def expectFrame(self, frame_id, rpsm):
+    def expectFrame(self, frame_id, rpsm, t_offset=0):
         ''' called by the front end when a frame is pushed into the pipeline '''
-        self.pending.append(FrameResult(frame_id, rpsm))
+        self.pending.append(FrameResult(frame_id, rpsm, t_offset, self.ticks))
 
     def enque(self, hit):
         ''' collect processed hits int frames, releasing completed frames when ready '''
-        t = hit.rawTime()
+        t = hit.resolveTime()
         while len(self.pending) > 0:
-           if t < self.pending[0].t_start:
-               raise RuntimeError(f'hit@ {t} earlier that earliest frame {self.pending[0].t_start}')
-           if t > self.pending[0].t_end:
-               self.consumer.consume(self.pending.popleft())
+           if t < self.pending[0].resolved_start:
+               raise RuntimeError(f'hit@ {t} earlier that earliest frame {self.pending[0].resolved_start}')
+           if t > self.pending[0].resolved_end:
+               self.deliver(self.pending.popleft())
                continue
            else:
                self.pending[0].add(hit)
@@ -138,10 +459,28 @@ class Accumulator:
         raise RuntimeError(f'no frame found for hit@ {t}')
 
 
+    def watermark(self, t):
+        ''' frames ending before the watermark are complete '''
+        while len(self.pending) > 1 and self.pending[0].resolved_end < t:
+            self.deliver(self.pending.popleft())
+
+    def deliver(self, result):
+        self.delivered += 1
+        if self.tracer is not None:
+            self.tracer.delivered(result.hits)
+        self.consumer.consume(result)
+
+    def __getstate__(self):
+        # checkpointed without the consumer and tracer, they are reattached on resume
+        state = self.__dict__.copy()
+        state['consumer'] = None
+        state['tracer'] = None
+        return state
+
     def eos(self):
         # print(f'eos(acc) pending {len(self.pending)}')
         if len(self.pending) == 1:
-            self.consumer.consume(self.pending.popleft())
+            self.deliver(self.pending.popleft())
         else:
             # should always end with a single in-flight fraems
             raise RuntimeError(f'eos does not match number pending frames {len(self.pending)}')
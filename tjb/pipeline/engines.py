@@ -0,0 +1,71 @@
+#
+# Engine registry: the interchangeable ways of marking a hit stream, by name
+#
+# An engine builds pipelines with the Pipeline constructor signature
+#
+#   build(sink, omkeys, geometry, topology, budget, ticks)
+#
+# same sink interface, input/output taps and SMLC/MMLC flags. 'pipeline' is the
+# reference the others are validated against, see shadow.Shadow. A new engine
+# registers itself with Engine.register and is then selectable in Driver and tjb.py.
+#
+from pipeline.pipeline import Pipeline
+
+
+def threadedPipeline(*args):
+    from pipeline.threaded import ThreadedPipeline      # deferred, starts threads
+    return ThreadedPipeline(*args)
+
+
+def fusedLCPipeline(*args):
+    from pipeline.fusedlc import FusedLCPipeline
+    return FusedLCPipeline(*args)
+
+
+def batchPipeline(*args):
+    from pipeline.batch import BatchPipeline            # deferred, may compile kernels
+    return BatchPipeline(*args)
+
+
+class Engine:
+    ''' a named pipeline builder
+
+        summary:     one line for the help and reports
+        checkpoints: its pipelines pickle mid-stream (joined mode checkpoints)
+        streaming:   releases hits as the stream advances, otherwise it holds the whole
+                     unit until eos and is not run in joined mode
+    '''
+
+    REGISTRY = {}
+
+    def __init__(self, name, build, summary, checkpoints=True, streaming=True):
+        self.name = name
+        self.build = build
+        self.summary = summary
+        self.checkpoints = checkpoints
+        self.streaming = streaming
+
+    def __repr__(self):
+        return f'Engine({self.name})'
+
+    def register(engine):
+        ''' add (or replace) an engine, returns it '''
+        Engine.REGISTRY[engine.name] = engine
+        return engine
+
+    def lookup(name):
+        engine = Engine.REGISTRY.get(name)
+        if engine is None:
+            raise RuntimeError(f'Unknown engine {name}, one of {", ".join(sorted(Engine.REGISTRY))}')
+        return engine
+
+    def names():
+        return sorted(Engine.REGISTRY)
+
+
+REFERENCE = 'pipeline'
+
+Engine.register(Engine(REFERENCE, Pipeline, 'streaming sorters, SMLC and MMLC hit by hit (reference)'))
+Engine.register(Engine('threaded', threadedPipeline, "each string's SMLC/MMLC chain on its own thread", checkpoints=False))
+Engine.register(Engine('fused', fusedLCPipeline, "each string's SMLC and MMLC in one pass over its merged channels"))
+Engine.register(Engine('batch', batchPipeline, 'array kernels over the whole unit at eos', streaming=False))
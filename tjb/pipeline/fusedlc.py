@@ -0,0 +1,83 @@
+#
+# Fused per-string LC engine
+#
+# The reference Pipeline sorts each module, runs its SMLC, merges all the modules of
+# the detector into one stream and splits that stream by string again for the MMLCs.
+# Here each string's channels are merged into one time ordered stream that goes
+# through the string's SMLC windows (uglc.stringlc.StringLC) into its MMLC, delayed
+# by the longest SMLC window so the hits reach the MMLC with final SMLC flags:
+#
+#   input -> demux(omkey) -> [string merge of channels -> SMLC marking -> MMLC] per string -> string_merge -> output
+#
+# One merge per hit instead of the module sort, detector-wide merge and string demux,
+# and no per-module SMLC release.
+#
+from pipeline.injest import Geometry
+from pipeline.injest import Population
+from pipeline.pipeline import OMKEYDemuxer
+from pipeline.pipeline import Pipeline
+from pipeline.pipeline import Topology
+from uglc.mmlc import MMLC
+from uglc.stringlc import StringLC
+
+
+class FusedLCPipeline(Pipeline):
+    ''' Pipeline with each string's SMLC and MMLC fused on the string's merged stream
+
+        Same sink interface, flags and output order as Pipeline (hits at equal times may
+        leave in another order). Taps are built at the input, mmlc and output boundaries,
+        the module_sort, smlc and merged boundaries do not exist. The per-string merge of
+        the channels is the topology's module_sort merger and draws on its budget.
+    '''
+
+    BOUNDARIES = ('input', 'mmlc', 'output')
+
+    def __init__(self, sink, all_omkeys, geometry=None, topology=None, budget=None, ticks=False):
+        if geometry is None:
+            geometry = Geometry.deduceGeometry(all_omkeys)
+
+        self.om_keys = all_omkeys
+        self.device_type = {}
+        self.smlcs = {}             # module -> StringLC.Module, reconfigured by reset()
+        self.by_module = Population.byModule(self.om_keys)
+        self.byString = Population.byString(self.om_keys)
+        self.sink = sink
+        topo = topology if topology is not None else Topology()
+        self.topology = topo.withTaps({b: specs for b, specs in topo.taps.items() if b in FusedLCPipeline.BOUNDARIES})
+        self.nodes = []
+        self.taps = {}
+        self.budget = budget
+        self.ticks = ticks
+        self.trigger = None
+        self.events = None
+        self.monitor = None
+        topo = self.topology
+
+        output = self.buildOutput(sink)
+        string_merge = topo.merger(self, 'string_merge', self.byString.keys(), output)
+
+        modules_of = {k: [] for k in self.byString.keys()}
+        for k in self.by_module.keys():
+            modules_of[k.string].append(k)
+
+        delay = max(self.smlcConfig(device_type).window_len for device_type in Geometry.DeviceType)
+        self.by_omkey_input = {}
+        for string, omkeys in self.byString.items():
+            mmlc_cfg = MMLC.MMLCConfig(string)
+            mmlc_cfg = mmlc_cfg.inTicks() if ticks else mmlc_cfg
+            mmlc = self.add(MMLC(string, mmlc_cfg, topo.tapped(self, 'mmlc', string, string_merge.inputFor(string))))
+
+            modules = {}
+            for k in modules_of[string]:
+                device_type = self.device_type[k] = geometry.lookup(k)
+                modules[k.om] = self.smlcs[k] = StringLC.Module(self.smlcConfig(device_type))
+            lc = self.add(StringLC(modules, delay, mmlc))
+
+            merge = topo.merger(self, 'module_sort', omkeys, lc)
+            for omk in omkeys:
+                self.by_omkey_input[omk] = merge.inputFor(omk)
+
+        self.demux = self.add(OMKEYDemuxer(self.by_omkey_input))
+        self.input_node = topo.tapped(self, 'input', None, self.demux)
+        if topo.fuse:
+            self.enque = self.input_node.enque
@@ -0,0 +1,28 @@
+#
+# I3File backend for Injest, with i3writer the only modules of the core that need icetray.
+# Imported on demand by Injest so loading the LC logic does not pay icetray startup.
+#
+from icecube import icetray, dataio, dataclasses, simclasses, phys_services, trigger_sim
+
+
+class I3Reader:
+    ''' Reads the DAQ frames carrying upgrade pulses from I3Files '''
+
+    def __init__(self, key='I3RecoPulseSeriesMapUpgrade'):
+        self.key = key
+
+    def daqPulseMaps(self, fname, want=None):
+        ''' iterate the RecoPulseSeriesMaps of the "upgrade" DAQ frames in a file
+
+            frames rejected by want(cnt) are yielded as None, their pulses are not deserialized
+        '''
+        f = dataio.I3File(fname)
+        cnt = 0
+        for frame in f:
+            if frame.Stop == icetray.I3Frame.DAQ:
+                if self.key in frame:
+                    if want is None or want(cnt):
+                        yield frame[self.key]
+                    else:
+                        yield None
+                    cnt += 1
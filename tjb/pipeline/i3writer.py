@@ -0,0 +1,55 @@
+#
+# I3File backend of the output, see output.FrameWriter. Needs icetray, imported on demand.
+#
+from icecube import icetray, dataio, dataclasses
+
+from pipeline.output import FrameWriter
+
+
+class I3Writer(FrameWriter):
+    ''' writes every frame of the input I3Files to one I3File, the LC keys added to the
+        upgrade DAQ frames with a result
+    '''
+
+    def __init__(self, path, files, key='I3RecoPulseSeriesMapUpgrade', style='mask'):
+        super().__init__(files, key, style)
+        self.path = path
+        self.file = dataio.I3File(path, dataio.I3File.Mode.Writing)
+
+    def frames(self, fname):
+        f = dataio.I3File(fname)
+        cnt = 0
+        try:
+            for frame in f:
+                if frame.Stop == icetray.I3Frame.DAQ and self.key in frame:
+                    yield cnt, frame
+                    cnt += 1
+                else:
+                    yield None, frame
+        finally:
+            f.close()
+
+    def write(self, frame, flags):
+        if flags is not None:
+            for i, name in enumerate((self.smlc_key, self.mmlc_key)):
+                frame[name] = self.lcKey(frame, flags, i)
+        self.file.push(frame)
+
+    def lcKey(self, frame, flags, i):
+        no = (False, False)
+        marked = lambda omkey, pulse: flags.get((omkey.string, omkey.om, omkey.pmt, pulse.time), no)[i]
+        if self.style == 'mask':
+            return dataclasses.I3RecoPulseSeriesMapMask(frame, self.key, lambda omkey, index, pulse: marked(omkey, pulse))
+        rpsm = dataclasses.I3RecoPulseSeriesMap.from_frame(frame, self.key)
+        selected = dataclasses.I3RecoPulseSeriesMap()
+        for omkey, pulses in rpsm.items():
+            series = dataclasses.I3RecoPulseSeries()
+            for pulse in pulses:
+                if marked(omkey, pulse):
+                    series.append(pulse)
+            if len(series) > 0:
+                selected[omkey] = series
+        return selected
+
+    def close(self):
+        self.file.close()
@@ -2,11 +2,26 @@
 # methods for injesting RecoPulsSeriesMap data from i3 files into pipeline domain objects.
 # There may be better performing or otherwise preferred or built-in mechanisms in icetray
 #
+# icetray is only needed to read I3Files, it is imported lazily through pipeline.i3reader
+# so the core (pipeline, sorters, SMLC/MMLC, hits, geometry) loads without it.
 #
-from icecube import icetray, dataio, dataclasses, simclasses, phys_services, trigger_sim
-
+# Files can be decoded ahead on worker processes (Injest decoders), each worker reads a
+# whole file and returns its selected pulse maps, frames are still yielded in file/frame
+# order and joined-mode offsets are computed as they are yielded.
+#
+from collections import deque
 from enum import Enum
 
+
+# pDAQ time unit, 0.1 ns. Hits can carry int64 tick times so sorting and LC windows
+# are exact integer compares however far joined-mode offsets take the timeline
+TICKS_PER_NS = 10
+
+def toTicks(ns):
+    ''' ns to the nearest DAQ tick '''
+    return round(ns * TICKS_PER_NS)
+
+
 #
 # Stand-in for geometry database
 #
@@ -51,6 +66,16 @@ class Geometry:
 
         return Geometry(module_type)
 
+    def merge(*geometries):
+        ''' union of deduced geometries, a module seen as MDOM anywhere is an MDOM '''
+        module_type = {}
+        for geometry in geometries:
+            for module_key, device_type in geometry.table.items():
+                if module_type.get(module_key) != Geometry.DeviceType.MDOM:
+                    module_type[module_key] = device_type
+
+        return Geometry(module_type)
+
 
 
 class ModuleKey:
@@ -121,6 +146,18 @@ class MyHit:
     def markMMLC(self):
         self.mmlc = True
 
+
+class TickHit(MyHit):
+    ''' MyHit with its resolved time in int64 DAQ ticks, the group offset folded in at ingest '''
+
+    def __init__(self, group, omkey, device_type, recopulse, ticks):
+        super().__init__(group, omkey, device_type, recopulse)
+        self.ticks = ticks
+
+    def resolveTime(self):
+        return self.ticks
+
+
 class Population:
     ''' Methods to characterize the data population of a ReconPulseSeriesMap '''
 
@@ -181,13 +218,56 @@ class Population:
 
 
 
+class FrameStats:
+    ''' cheap statistics of a pulse map, one pass over its series, no hits built '''
+
+    def __init__(self, hits, channels, span):
+        self.hits = hits            # pulses
+        self.channels = channels    # channels with at least one pulse
+        self.span = span            # ns, first to last pulse
+
+    def __repr__(self):
+        return f'hits: {self.hits} channels: {self.channels} span: {self.span:.0f} ns'
+
+    def occupancy(self):
+        ''' hits per active channel '''
+        return self.hits / self.channels if self.channels else 0.0
+
+    def density(self):
+        ''' hits per us '''
+        return self.hits * 1e3 / max(self.span, 1.0)
+
+    def extract(rpsm):
+        hits = 0
+        channels = 0
+        t_min = None
+        t_max = None
+        for l in rpsm.values():
+            if len(l) > 0:
+                hits += len(l)
+                channels += 1
+                if t_min is None or l[0].time < t_min:
+                    t_min = l[0].time
+                if t_max is None or l[-1].time > t_max:
+                    t_max = l[-1].time
+        return FrameStats(hits, channels, t_max - t_min if hits else 0.0)
+
+
 class Frame:
     ''' Provide RecoPulseSeriesMap iterations'''
-    def __init__(self, geometry, group, rpsm):
+    def __init__(self, geometry, group, rpsm, ticks=False):
         self.geometry = geometry
         self.frame_id = group.id
         self.group = group
         self.rpsm = rpsm
+        self.ticks = ticks          # yield TickHits
+        self.__stats = None
+
+    def stats(self):
+        ''' the FrameStats of the pulse map, extracted once '''
+        if self.__stats is None:
+            self.__stats = FrameStats.extract(self.rpsm)
+        return self.__stats
 
     def hits(self):
         ''' iterate the frame to produce a stream of MyHits '''
@@ -223,65 +303,256 @@ class Frame:
 
     def __hits_depthFirst(self):
         ''' iterate channel-by-channel'''
+        if self.ticks:
+            yield from self.__tickHits_depthFirst()
+            return
         for omkey, pulses in self.rpsm.items():
             for pulse in pulses:
                 yield MyHit(self.group, omkey, self.geometry.lookup(omkey), pulse)
+
+    def __tickHits_depthFirst(self):
+        offset = toTicks(self.group.t_offest)
+        for omkey, pulses in self.rpsm.items():
+            device_type = self.geometry.lookup(omkey)
+            for pulse in pulses:
+                yield TickHit(self.group, omkey, device_type, pulse, toTicks(pulse.time) + offset)
                
 
+class Selection:
+    ''' Predicates pushed down into Injest, applied before any MyHit is created
+
+        Every criterion is optional, None selects everything, criteria combine with AND.
+
+            frames:     per-file frame indices (the "frame" part of frame ids), e.g. range(10, 20)
+            frame_ids:  "file:frame" ids
+            strings:    string numbers
+            modules:    (string, om) pairs or ModuleKeys
+            pmts:       pmt numbers
+            t_window:   (t_min, t_max) raw pulse time interval, inclusive
+    '''
+
+    def __init__(self, frames=None, frame_ids=None, strings=None, modules=None, pmts=None, t_window=None):
+        self.frames = frames if isinstance(frames, range) or frames is None else frozenset(frames)
+        self.frame_ids = frozenset(frame_ids) if frame_ids is not None else None
+        self.strings = frozenset(strings) if strings is not None else None
+        self.modules = frozenset((m.string, m.om) if isinstance(m, ModuleKey) else tuple(m) for m in modules) if modules is not None else None
+        self.pmts = frozenset(pmts) if pmts is not None else None
+        self.t_window = t_window
+
+        # highest wanted frame index, overall and per file, lets a file be abandoned early
+        self.__last_frame = None
+        if self.frames is not None:
+            self.__last_frame = max(self.frames) if len(self.frames) > 0 else -1
+        self.__last = {}
+        if self.frame_ids is not None:
+            for frame_id in self.frame_ids:
+                fname, _, cnt = frame_id.rpartition(':')
+                self.__last[fname] = max(self.__last.get(fname, -1), int(cnt))
+
+    def __repr__(self):
+        ''' stable across runs, keys result caches '''
+        ordered = lambda s: None if s is None else s if isinstance(s, range) else sorted(s)
+        return (f'Selection(frames={ordered(self.frames)}, frame_ids={ordered(self.frame_ids)}, strings={ordered(self.strings)}, '
+                f'modules={ordered(self.modules)}, pmts={ordered(self.pmts)}, t_window={self.t_window})')
+
+    def acceptsFrame(self, fname, cnt):
+        if self.frames is not None and cnt not in self.frames:
+            return False
+        if self.frame_ids is not None and f'{fname}:{cnt}' not in self.frame_ids:
+            return False
+        return True
+
+    def doneWith(self, fname, cnt):
+        ''' True when no frame at or after index cnt of the file can be accepted '''
+        if self.__last_frame is not None and cnt > self.__last_frame:
+            return True
+        if self.frame_ids is not None and cnt > self.__last.get(fname, -1):
+            return True
+        return False
+
+    def acceptsChannel(self, omkey):
+        if self.strings is not None and omkey.string not in self.strings:
+            return False
+        if self.modules is not None and (omkey.string, omkey.om) not in self.modules:
+            return False
+        if self.pmts is not None and omkey.pmt not in self.pmts:
+            return False
+        return True
+
+    def selectsChannels(self):
+        return self.strings is not None or self.modules is not None or self.pmts is not None or self.t_window is not None
+
+    def select(self, rpsm):
+        ''' narrow a pulse series map to the selected channels and time window
+
+            returns None if no pulses remain
+        '''
+        if not self.selectsChannels():
+            return rpsm
+
+        selected = {}
+        has_pulses = False
+        for omkey, pulses in rpsm.items():
+            if not self.acceptsChannel(omkey):
+                continue
+            if self.t_window is not None:
+                t_min, t_max = self.t_window
+                pulses = [p for p in pulses if t_min <= p.time <= t_max]
+            selected[omkey] = pulses
+            has_pulses = has_pulses or len(pulses) > 0
+
+        return selected if has_pulses else None
+
+
+class InjestPosition:
+    ''' where a joined iteration stands after a frame, enough to resume it
+
+        file_index: index into Injest.files
+        cnt:        frame index within that file
+        last_pit:   the running joined-mode time base
+    '''
+
+    def __init__(self, file_index, fname, cnt, last_pit):
+        self.file_index = file_index
+        self.fname = fname
+        self.cnt = cnt
+        self.last_pit = last_pit
+
+    def __str__(self):
+        return f'{self.fname}:{self.cnt}'
+
+
 class Injest:
-    ''' Injest I3Files and produce hit streams '''
+    ''' Injest I3Files and produce hit streams
+
+        reader: source of pulse maps per file, defaults to pipeline.i3reader.I3Reader.
+                Any object implementing daqPulseMaps(fname, want) can stand in,
+                e.g. pipeline.synthetic.SyntheticSource. want(cnt) tells the reader
+                whether frame cnt of the file is needed, unwanted frames are
+                yielded as None without decoding the pulses.
+        selection: optional Selection, frames and channels outside of it are
+                dropped before hits are created
+        ticks:  frames yield TickHits, int64 DAQ tick times with the joined-mode
+                offset folded in
+        decoders: worker processes decoding files ahead, 0 decodes in line. The reader,
+                selection and pulse maps must pickle (I3Reader and I3RecoPulseSeriesMap do)
+        lookahead: files decoded or held ahead of the one being yielded, default 2 per decoder
+    '''
 
-    def __init__(self, files):
+    def __init__(self, files, reader=None, selection=None, ticks=False, decoders=0, lookahead=None):
         self.files = files
-
-    def upgradePulseFrames(self, join=False, delta=100):
-        ''' iterate the "upgrade" frames in the files'''
+        if reader is None:
+            from pipeline.i3reader import I3Reader     # deferred, pulls in icetray
+            reader = I3Reader()
+        self.reader = reader
+        self.selection = selection
+        self.ticks = ticks
+        self.decoders = decoders
+        self.lookahead = lookahead if lookahead is not None else max(1, 2 * decoders)
+        self.position = None        # InjestPosition after the last joined frame yielded
+
+    def upgradePulseFrames(self, join=False, delta=100, resume=None):
+        ''' iterate the "upgrade" frames in the files
+
+            resume: joined mode only, an InjestPosition to continue after
+        '''
         if not join:
+            if resume is not None:
+                raise RuntimeError('resume is only supported for joined frames')
             yield from self.__unjoined()
         else:
-            yield from self.__joined(delta)
+            yield from self.__joined(delta, resume)
+
 
+    def __files(self, first=0, after=-1):
+        ''' iterate (file_index, fname, pulse maps) from file first on, frames up to index
+            after of the first file are skipped
+
+            with decoders the files are decoded on worker processes, at most lookahead
+            files ahead of the one being yielded, and their pulse maps are held until
+            their turn
+        '''
+        if self.decoders == 0:
+            for file_index in range(first, len(self.files)):
+                fname = self.files[file_index]
+                yield file_index, fname, pulseMaps(self.reader, self.selection, fname, after if file_index == first else -1)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor      # deferred, only with decoders
+        pool = ProcessPoolExecutor(self.decoders)
+        try:
+            ahead = deque()         # (file_index, future), in file order
+            submit = first
+            while submit < len(self.files) or ahead:
+                while submit < len(self.files) and len(ahead) < self.lookahead:
+                    fname = self.files[submit]
+                    ahead.append((submit, pool.submit(decodeFile, self.reader, self.selection, fname, after if submit == first else -1)))
+                    submit += 1
+                file_index, future = ahead.popleft()
+                yield file_index, self.files[file_index], future.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
 
     def __unjoined(self):
         ''' iterate the "upgrade" frames in the files without joining into monotonic stream'''
-        for fname in self.files:
-            f = dataio.I3File(fname)
-            cnt = 0;
-            for frame in f:
-                if frame.Stop == icetray.I3Frame.DAQ:
-                    if 'I3RecoPulseSeriesMapUpgrade' in frame:
-                        rpsm = frame['I3RecoPulseSeriesMapUpgrade']
-                        group = Grouping(f'{fname}:{cnt}', 0)  # each frame is independent
-
-                        # dynamically learning the geometry
-                        # this should come from a static source
-                        geometry = Geometry.deduceGeometry(Population.extractPopulation(rpsm))
-
-                        yield(Frame(geometry, group, rpsm))
-                        cnt += 1
-
-    def __joined(self, delta):
+        for _, fname, maps in self.__files():
+            for cnt, rpsm, geometry in maps:
+                group = Grouping(f'{fname}:{cnt}', 0)  # each frame is independent
+                yield(Frame(geometry, group, rpsm, self.ticks))
+
+    def __joined(self, delta, resume=None):
         ''' iterate the "upgrade" frames in the files, joining into monotonic streams via the Group'''
        
         last_pit = 0;
-        for fname in self.files:
-            f = dataio.I3File(fname)
-            cnt = 0;
-            for frame in f:
-                if frame.Stop == icetray.I3Frame.DAQ:
-                    if 'I3RecoPulseSeriesMapUpgrade' in frame:
-                        rpsm = frame['I3RecoPulseSeriesMapUpgrade']
-                        t_min, t_max = Population.extractTimeInterval(rpsm);
-                        offset = (last_pit - t_min) + delta
-                        group = Grouping(f'{fname}:{cnt}', offset)  # track the inter-group time offset
-                        #print(f'DEBUG: frame {cnt} interval: [{t_min}-{t_max}] last-pit: {last_pit} time_offset: {offset} ---> interval: [{t_min + offset}-{t_max + offset}]')
-                        
-                        # dynamically learning the geometry
-                        # this should come from a static source
-                        geometry = Geometry.deduceGeometry(Population.extractPopulation(rpsm))
-
-                        yield(Frame(geometry, group, rpsm))
-                        last_pit = last_pit + (t_max + offset)
-                        cnt += 1
-
-
+        first = 0
+        if resume is not None:
+            if self.files[resume.file_index] != resume.fname:
+                raise RuntimeError(f'resume position {resume} does not match file {self.files[resume.file_index]}')
+            last_pit = resume.last_pit
+            first = resume.file_index
+        after = resume.cnt if resume is not None else -1
+        for file_index, fname, maps in self.__files(first, after):
+            for cnt, rpsm, geometry in maps:
+                t_min, t_max = Population.extractTimeInterval(rpsm);
+                offset = (last_pit - t_min) + delta
+                group = Grouping(f'{fname}:{cnt}', offset)  # track the inter-group time offset
+                #print(f'DEBUG: frame {cnt} interval: [{t_min}-{t_max}] last-pit: {last_pit} time_offset: {offset} ---> interval: [{t_min + offset}-{t_max + offset}]')
+
+                # the frame ends at t_max + offset on the joined timeline, the next one
+                # starts delta after it
+                self.position = InjestPosition(file_index, fname, cnt, t_max + offset)
+                yield(Frame(geometry, group, rpsm, self.ticks))
+                last_pit = t_max + offset
+
+
+def pulseMaps(reader, selection, fname, after=-1):
+    ''' iterate (cnt, rpsm, geometry) of a file, applying the selection
+
+        geometry is learned before channels are selected away, a partially
+        selected mDOM must not be taken for a DEGG
+
+        frames up to index after are skipped without decoding
+    '''
+    if selection is None and after < 0:
+        for cnt, rpsm in enumerate(reader.daqPulseMaps(fname)):
+            # dynamically learning the geometry
+            # this should come from a static source
+            yield (cnt, rpsm, Geometry.deduceGeometry(Population.extractPopulation(rpsm)))
+        return
+
+    want = lambda cnt: cnt > after and (selection is None or selection.acceptsFrame(fname, cnt))
+    for cnt, rpsm in enumerate(reader.daqPulseMaps(fname, want)):
+        if selection is not None and selection.doneWith(fname, cnt):
+            return
+        if rpsm is None or cnt <= after:
+            continue
+        geometry = Geometry.deduceGeometry(Population.extractPopulation(rpsm))
+        if selection is not None:
+            rpsm = selection.select(rpsm)
+        if rpsm is not None:                # nothing selected in this frame
+            yield (cnt, rpsm, geometry)
+
+
+def decodeFile(reader, selection, fname, after=-1):
+    ''' decoder process body: the pulse maps of a file as a list '''
+    return list(pulseMaps(reader, selection, fname, after))
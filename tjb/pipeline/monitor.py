@@ -0,0 +1,246 @@
+#
+# Per-channel rate and LC fraction monitoring over long runs
+#
+# Channels get dense ids from a ChannelIndex, the counters are arrays indexed by id so
+# a hit costs a dict lookup and a few array increments. Rates are folded once per
+# stream-time interval into exponentially decayed per-channel rates. The decay is
+# applied lazily, a fold only touches the channels hit in the interval, the hot/dead
+# checks and the per-module sums are only done for snapshots and reports.
+#
+import math
+import os
+import pickle
+import statistics
+
+from array import array
+
+from pipeline.injest import ModuleKey
+from pipeline.injest import toTicks
+
+
+class ChannelIndex:
+    ''' dense ids for channels (omkeys) and their modules, grows as channels are added '''
+
+    def __init__(self, omkeys=()):
+        self.ids = {}               # omkey -> channel id
+        self.keys = []              # channel id -> (string, om, pmt)
+        self.module = array('I')    # channel id -> module id
+        self.module_ids = {}        # ModuleKey -> module id
+        self.modules = []           # module id -> (string, om)
+        self.add(omkeys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, omkeys):
+        ''' assign ids to the channels not indexed yet, in a stable order '''
+        for omkey in sorted(omkeys, key=lambda k: (k.string, k.om, k.pmt)):
+            self.id(omkey)
+
+    def id(self, omkey):
+        i = self.ids.get(omkey)
+        if i is None:
+            i = self.ids[omkey] = len(self.keys)
+            self.keys.append((omkey.string, omkey.om, omkey.pmt))
+            module_key = ModuleKey.extractOMKey(omkey)
+            m = self.module_ids.get(module_key)
+            if m is None:
+                m = self.module_ids[module_key] = len(self.modules)
+                self.modules.append((omkey.string, omkey.om))
+            self.module.append(m)
+        return i
+
+
+class RateMonitor:
+    ''' Passes the hits through unchanged, counting hits, SMLC and MMLC hits per channel
+
+        interval:  stream time between rate updates, ns, keep it well below a frame length, an
+                   isolated frame restarts the interval clock and its last partial interval is
+                   not folded until the next frame's first
+        tau:       decay time of the rates, ns
+        hot:       a channel is hot above this multiple of the median rate
+        dead:      a channel is dead after this many intervals without a hit
+        snapshot:  path of the snapshot file, rewritten every snapshot_every intervals and at eos
+        index:     a ChannelIndex shared with other monitors, or built from the population
+
+        A monitor can serve a sequence of pipelines (isolated frames), use rebind() to
+        point it at the next pipeline's sink. A stream time that jumps back (the next
+        isolated frame) restarts the interval clock without a rate update.
+    '''
+
+    def __init__(self, sink=None, omkeys=(), interval=1e6, tau=1e8, hot=5.0, dead=100,
+                 snapshot=None, snapshot_every=100, index=None, ticks=False):
+        self.sink = sink
+        self.index = index if index is not None else ChannelIndex()
+        self.interval = toTicks(interval) if ticks else interval
+        self.interval_s = interval * 1e-9
+        self.decay = math.exp(-interval / tau)
+        self.hot = hot
+        self.dead = dead
+        self.snapshot_path = snapshot
+        self.snapshot_every = snapshot_every
+
+        self.hits = array('Q')              # since the start
+        self.smlc = array('Q')
+        self.mmlc = array('Q')
+        self.current = array('Q')           # in the current interval
+        self.touched = []                   # ids hit in the current interval
+        self.rate = array('d')              # decayed, Hz, as of the interval the channel was last seen
+        self.last_seen = array('q')         # interval number of the latest hit, -1 never
+        self.grow()
+        self.add(omkeys)
+
+        self.next_fold = None               # stream time closing the current interval
+        self.intervals = 0
+        self.snapshots = 0
+
+    def rebind(self, sink, omkeys=()):
+        ''' reuse for another pipeline '''
+        self.sink = sink
+        self.add(omkeys)
+        self.next_fold = None
+
+    def reset(self):
+        ''' another stream follows on the same pipeline, its times start over '''
+        self.next_fold = None
+
+    def add(self, omkeys):
+        self.index.add(omkeys)
+        self.grow()
+
+    def grow(self):
+        ''' extend the counters to channels indexed since '''
+        missing = len(self.index) - len(self.hits)
+        if missing > 0:
+            for counter in (self.hits, self.smlc, self.mmlc, self.current):
+                counter.extend(array('Q', [0]) * missing)
+            self.rate.extend(array('d', [0.0]) * missing)
+            self.last_seen.extend(array('q', [-1]) * missing)
+
+    def enque(self, hit):
+        t = hit.resolveTime()
+        if self.next_fold is None or t >= self.next_fold or t < self.next_fold - self.interval:
+            self.advance(t)     # the hit counts in the interval it opens
+
+        i = self.index.ids.get(hit.omkey)
+        if i is None:
+            i = self.index.id(hit.omkey)
+            self.grow()
+        self.hits[i] += 1
+        current = self.current
+        if not current[i]:
+            self.touched.append(i)
+        current[i] += 1
+        if hit.smlc:
+            self.smlc[i] += 1
+        if hit.mmlc:
+            self.mmlc[i] += 1
+        self.sink.enque(hit)
+
+    def watermark(self, t):
+        if self.next_fold is not None and t >= self.next_fold:
+            self.advance(t)
+        self.sink.watermark(t)
+
+    def eos(self):
+        if self.snapshot_path is not None:
+            self.snapshot()
+        self.sink.eos()
+
+    def advance(self, t):
+        ''' close the intervals up to t, restart the clock if t jumped back '''
+        if self.next_fold is None or t < self.next_fold - self.interval:
+            self.next_fold = t + self.interval
+            return
+        while t >= self.next_fold:
+            self.fold()
+            self.next_fold += self.interval
+
+    def fold(self):
+        ''' fold the current interval into the decayed rates '''
+        decay = self.decay
+        gain = (1.0 - decay) / self.interval_s
+        rate = self.rate
+        current = self.current
+        last_seen = self.last_seen
+        k = self.intervals
+        for i in self.touched:
+            rate[i] = rate[i] * decay ** (k - last_seen[i]) + current[i] * gain if last_seen[i] >= 0 else current[i] * gain
+            last_seen[i] = k
+            current[i] = 0
+        self.touched = []
+        self.intervals += 1
+        if self.snapshot_path is not None and self.intervals % self.snapshot_every == 0:
+            self.snapshot()
+
+    def rates(self):
+        ''' the decayed rates as of the last interval closed '''
+        k = self.intervals - 1
+        decay = self.decay
+        return array('d', (r * decay ** (k - seen) if seen >= 0 else 0.0 for r, seen in zip(self.rate, self.last_seen)))
+
+    def hotChannels(self, rates=None):
+        ''' ids of the channels above hot times the median rate '''
+        rates = rates if rates is not None else self.rates()
+        if not rates:
+            return []
+        limit = self.hot * statistics.median(rates)
+        return [i for i, r in enumerate(rates) if r > limit]
+
+    def deadChannels(self):
+        ''' ids of the channels quiet for the last dead intervals (or never seen) '''
+        if self.intervals < self.dead:
+            return []
+        since = self.intervals - self.dead
+        return [i for i, seen in enumerate(self.last_seen) if seen < since]
+
+    def moduleSums(self, counter):
+        sums = array(counter.typecode, [0]) * len(self.index.modules)
+        for i, m in enumerate(self.index.module):
+            sums[m] += counter[i]
+        return sums
+
+    def state(self):
+        ''' the snapshot content '''
+        rates = self.rates()
+        return {
+            'intervals': self.intervals,
+            'interval_ns': self.interval_s * 1e9,
+            'channels': list(self.index.keys),
+            'module': self.index.module,
+            'modules': list(self.index.modules),
+            'hits': self.hits,
+            'smlc': self.smlc,
+            'mmlc': self.mmlc,
+            'rate': rates,
+            'module_hits': self.moduleSums(self.hits),
+            'module_smlc': self.moduleSums(self.smlc),
+            'module_mmlc': self.moduleSums(self.mmlc),
+            'module_rate': self.moduleSums(rates),
+            'hot': self.hotChannels(rates),
+            'dead': self.deadChannels(),
+        }
+
+    def snapshot(self):
+        ''' rewrite the snapshot file atomically '''
+        tmp = f'{self.snapshot_path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.state(), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.snapshot_path)
+        self.snapshots += 1
+
+    def load(path):
+        ''' a snapshot written by RateMonitor.snapshot '''
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def report(self):
+        hits = sum(self.hits)
+        fraction = lambda n: f'{n / hits:.2%}' if hits else '-'
+        lines = [f'monitor: channels: {len(self.index)} modules: {len(self.index.modules)} hits: {hits} '
+                 f'SMLC: {fraction(sum(self.smlc))} MMLC: {fraction(sum(self.mmlc))} intervals: {self.intervals}']
+        for label, ids in (('hot', self.hotChannels()), ('dead', self.deadChannels())):
+            if ids:
+                shown = ' '.join(str(self.index.keys[i]) for i in ids[:10])
+                lines.append(f'  {label}: {len(ids)} {shown}{" ..." if len(ids) > 10 else ""}')
+        return lines
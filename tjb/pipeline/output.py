@@ -0,0 +1,239 @@
+#
+# Output of the LC results: the input DAQ frames written back out with their SMLC/MMLC
+# flags added
+#
+# A FrameWriter walks the input files again alongside the delivered FrameResults, the
+# result of frame "file:n" goes with the n-th upgrade DAQ frame of the file, and writes
+# every input frame in order. Frames with a result get two keys next to the pulse map,
+# {key}_SMLC and {key}_MMLC, in one of two styles:
+#
+#   mask     a pulse-series mask of the map, set for the pulses carrying the flag
+#   pulses   a new pulse map holding just those pulses
+#
+# Frames without a result (not selected) are written as they are, so are input files
+# without any result. Backends:
+#
+#   JsonWriter            a JSON line per DAQ frame, pulse times and the two keys, needs
+#                         only an Injest reader, the stand-in for tests and synthetic input
+#   i3writer.I3Writer     an I3File, every frame of the input files (needs icetray)
+#
+# The writing runs on a thread of its own behind a bounded queue, OutputWriter, so the
+# frame encoding and the file I/O overlap the processing.
+#
+import json
+import threading
+import time
+
+from pipeline.util import SpscQueue
+from pipeline.util import hitKey
+
+
+STYLES = ('mask', 'pulses')
+
+STOP = object()         # queue item ending the writer thread
+
+
+def lcFlags(result):
+    ''' (string, om, pmt, raw time) -> (smlc, mmlc) of the hits of a FrameResult '''
+    return {hitKey(hit): (hit.smlc, hit.mmlc) for hit in result.hits}
+
+
+class FrameWriter:
+    ''' writes the frames of the input files in order, the LC flags added to those with a result
+
+        files: the input files of the run, in processing order
+
+        subclasses provide
+            frames(fname)      iterate (n, frame) of an input file, n the index of the upgrade
+                               DAQ frames as Injest counts them, None for any other frame
+            write(frame, flags)  flags None for a frame without result
+            close()
+    '''
+
+    def __init__(self, files, key='I3RecoPulseSeriesMapUpgrade', style='mask'):
+        if style not in STYLES:
+            raise RuntimeError(f'Unknown output style {style}, one of {", ".join(STYLES)}')
+        self.files = list(files)
+        self.next_file = 0          # index of the first file not opened yet
+        self.key = key
+        self.style = style
+        self.smlc_key = f'{key}_SMLC'
+        self.mmlc_key = f'{key}_MMLC'
+        self.fname = None
+        self.input = None
+        self.cnt = -1
+        self.frames_written = 0
+
+    def add(self, result):
+        fname, _, cnt = result.frame_id.rpartition(':')
+        cnt = int(cnt)
+        if fname != self.fname:
+            self.finishFile()
+            self.openFile(fname, result.frame_id)
+        elif cnt <= self.cnt:
+            raise RuntimeError(f'frame {result.frame_id} out of order, frame {self.cnt} of {fname} already written')
+
+        for n, frame in self.input:
+            if n == cnt:
+                self.write(frame, lcFlags(result))
+                self.frames_written += 1
+                self.cnt = cnt
+                return
+            self.write(frame, None)
+            self.frames_written += 1
+        raise RuntimeError(f'frame {result.frame_id} not found in {fname}')
+
+    def openFile(self, fname, frame_id):
+        ''' open fname for writing, the files before it without any result are written as they are '''
+        while self.next_file < len(self.files):
+            name = self.files[self.next_file]
+            self.next_file += 1
+            self.input = self.frames(name)
+            if name == fname:
+                self.fname = fname
+                self.cnt = -1
+                return
+            self.finishFile()
+        raise RuntimeError(f'frame {frame_id} is not from an input file after {self.fname}')
+
+    def finishFile(self):
+        ''' write the rest of the current input file '''
+        if self.input is not None:
+            for _, frame in self.input:
+                self.write(frame, None)
+                self.frames_written += 1
+            self.input = None
+
+    def finish(self):
+        ''' write the rest of the input files '''
+        self.finishFile()
+        while self.next_file < len(self.files):
+            self.input = self.frames(self.files[self.next_file])
+            self.next_file += 1
+            self.finishFile()
+        self.close()
+
+
+class JsonWriter(FrameWriter):
+    ''' stand-in backend, a JSON line per DAQ frame of the input files
+
+            {"frame_id": "file:n", "pulses": [[string, om, pmt, [times]], ...],
+             "{key}_SMLC": [[string, om, pmt, [mask bits | times]], ...], "{key}_MMLC": ...}
+
+        the LC keys only for frames with a result, in the style's form: a 0/1 per pulse
+        of the channel (mask) or the flagged pulse times (pulses), channels in pulse map order
+        reader: the Injest reader of the input, e.g. a SyntheticSource
+    '''
+
+    def __init__(self, path, files, reader, key='I3RecoPulseSeriesMapUpgrade', style='mask'):
+        super().__init__(files, key, style)
+        self.path = path
+        self.reader = reader
+        self.file = open(path, 'w')
+
+    def frames(self, fname):
+        for cnt, rpsm in enumerate(self.reader.daqPulseMaps(fname)):
+            yield cnt, (f'{fname}:{cnt}', rpsm)
+
+    def write(self, frame, flags):
+        frame_id, rpsm = frame
+        record = {'frame_id': frame_id,
+                  'pulses': [[k.string, k.om, k.pmt, [p.time for p in pulses]] for k, pulses in rpsm.items()]}
+        if flags is not None:
+            for i, name in enumerate((self.smlc_key, self.mmlc_key)):
+                record[name] = self.channels(rpsm, flags, i)
+        self.file.write(json.dumps(record))
+        self.file.write('\n')
+
+    def channels(self, rpsm, flags, i):
+        no = (False, False)
+        channels = []
+        for k, pulses in rpsm.items():
+            marked = [flags.get((k.string, k.om, k.pmt, p.time), no)[i] for p in pulses]
+            if self.style == 'mask':
+                channels.append([k.string, k.om, k.pmt, [int(m) for m in marked]])
+            elif any(marked):
+                channels.append([k.string, k.om, k.pmt, [p.time for p, m in zip(pulses, marked) if m]])
+        return channels
+
+    def close(self):
+        self.file.close()
+
+    def load(path):
+        ''' iterate the records of a JsonWriter file '''
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class OutputWriter:
+    ''' consumer handing the frames to a FrameWriter on a writer thread
+
+        depth: results queued before consume() blocks, bounds how far the output may
+               fall behind the processing
+        close() writes the rest of the input and raises a failure of the writer thread,
+        a failure is also raised by the next consume()
+    '''
+
+    DEPTH = 16
+
+    def __init__(self, writer, depth=None):
+        self.writer = writer
+        self.queue = SpscQueue(depth if depth is not None else OutputWriter.DEPTH)
+        self.error = None
+        self.results = 0
+        self.closed = False
+        self.write_s = 0.0          # writer thread busy
+        self.blocked_s = 0.0        # consume() waiting for a free slot
+        self.thread = threading.Thread(target=self.run, name='output-writer', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        failed = False
+        while True:
+            result = self.queue.get()
+            if failed:
+                if result is STOP:
+                    return
+                continue            # keep draining so consume() never blocks
+            try:
+                t0 = time.perf_counter()
+                if result is STOP:
+                    self.writer.finish()
+                    self.write_s += time.perf_counter() - t0
+                    return
+                self.writer.add(result)
+                self.write_s += time.perf_counter() - t0
+            except Exception as e:
+                failed = True
+                self.error = e
+                try:
+                    self.writer.close()
+                except Exception:
+                    pass
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError(f'output writer failed: {self.error}') from self.error
+
+    def consume(self, result):
+        self.check()
+        t0 = time.perf_counter()
+        self.queue.put(result)
+        self.blocked_s += time.perf_counter() - t0
+        self.results += 1
+
+    def resume(self, delivered):
+        if delivered > 0:
+            raise RuntimeError('output writing does not resume from a checkpoint, the frames delivered before it are not in the output')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(STOP)
+            self.thread.join()
+        self.check()
+
+    def report(self):
+        return [f'output: {self.results} results, {self.writer.frames_written} frames written, '
+                f'writer busy {self.write_s:.3f} s, processing blocked {self.blocked_s:.3f} s']
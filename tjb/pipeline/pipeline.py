@@ -1,5 +1,7 @@
 # processing pipeline to route hits into upgrade LC code modules hit-by-hit in a pdaq compatible way 
 
+import copy
+import heapq
 import time
 
 from collections import deque
@@ -8,14 +10,18 @@ from pipeline.injest import Geometry
 from pipeline.injest import Population
 from pipeline.injest import ModuleKey
 from pipeline.injest import MyHit
+from pipeline.injest import toTicks
 from uglc.smlc import SMLC
 from uglc.mmlc import MMLC
+from pipeline.monitor import RateMonitor
+from trigger.eventbuilder import EventBuilder
+from trigger.majority import MajorityTrigger
 
 
 class Pipeline:
     '''Builds a processing pipeline to iterate RecoPulsSeriesMap(s) in pdaq-order and and mark UGLC status'''
 
-    def __init__(self, sink, all_omkeys):
+    def __init__(self, sink, all_omkeys, geometry=None, topology=None, budget=None, ticks=False):
         # builds up a Sorter-->Demuxer-->SMLC->Sorter pipeline that will drive
         # hits from rpsm to smlc instances in time order then to supplied sink in
         # time order
@@ -25,28 +31,52 @@ class Pipeline:
         # rpsm is not stored, used to dynamically learn the omkey population
         # needed to plumb the pipeline
         #
+        # geometry may be supplied when all_omkeys is a selection of the
+        # channels and would not reveal the device types on its own
+        #
+        # topology describes the stage choices and debug/instrumentation taps,
+        # the default is the plain pipeline with adjacent stateless stages fused
+        #
+        # budget is an optional spill.MemoryBudget capping the hits buffered by
+        # the sorters, excess is spilled to disk
+        #
+        # ticks: hits are timed in int64 DAQ ticks (injest.TickHit), the window
+        # lengths are converted up front
+        #
 
 
         # dynamically learning the geometry
         # this should come from a static source
-        geometry = Geometry.deduceGeometry(all_omkeys)
+        if geometry is None:
+            geometry = Geometry.deduceGeometry(all_omkeys)
 
 
         # om_keys: overall  channel population
         # by_module: omkeys grouped by module
         self.om_keys = all_omkeys
+        self.device_type = {}                                                                       # device_type: module -> device type its SMLC is configured for
+        self.smlcs = {}                                                                             # smlcs:       module -> SMLC
         self.by_module = Population.byModule(self.om_keys)
         self.byString = Population.byString(self.om_keys)
 
         # assemble the processing pipeline
         self.sink = sink                                                                            # sink:        The terminal node: receives the processed hits in time order
-
-        # for delaney's data management
+        self.topology = topology if topology is not None else Topology()
+        self.nodes = []                                                                             # nodes:       every stage built, in build order
+        self.taps = {}                                                                              # taps:        boundary -> tap stages, e.g. to read counters
+        self.budget = budget
+        self.ticks = ticks
+        self.trigger = None                                                                         # trigger:     the MajorityTrigger after the final merge, when configured
+        self.events = None                                                                          # events:      the EventBuilder after the trigger, when configured
+        self.monitor = None                                                                         # monitor:     the RateMonitor before the output taps, when configured
+
+        # for delaney's data management (printed once per build, a reset pipeline is quiet)
         degg_smlc = SMLC.SMLCConfig.lookup(Geometry.DeviceType.DEGG)
         mdom_smlc = SMLC.SMLCConfig.lookup(Geometry.DeviceType.MDOM)
         print(f'SMLC: device_type: DEGG, window: {degg_smlc.window_len}, multiplicity: {degg_smlc.window_len}')
         print(f'SMLC: device_type: MDOM, window: {mdom_smlc.window_len}, multiplicity: {mdom_smlc.window_len}')
 
+        topo = self.topology
 
        ########################################################
        # Build the pipeline, working back to front
@@ -60,27 +90,29 @@ class Pipeline:
         # build an input map that feeds each omkey stream to a per-string MMLC instance             # to_mmlc:  Receives the processed (after SMLC/SORT), demuxes on string, passes to mmlc node, join at sorter and then to terminal node
         string_to_mmlc = {}
 
-        # for k in self.byString.keys():
-             # print(f'[{k}]-->{len(self.byString[k])}')
-        
-        post_mmlc_sorter = PairHeapSorter(self.byString.keys(), sink)
+        output = self.buildOutput(sink)
+
+        post_mmlc_sorter = topo.merger(self, 'string_merge', self.byString.keys(), output)
         for k in self.byString.keys():
-            string_to_mmlc[k] = MMLC(k, MMLC.MMLCConfig(k), post_mmlc_sorter.inputFor(k))
+            mmlc_cfg = MMLC.MMLCConfig(k)
+            string_to_mmlc[k] = self.add(MMLC(k, mmlc_cfg.inTicks() if ticks else mmlc_cfg, topo.tapped(self, 'mmlc', k, post_mmlc_sorter.inputFor(k))))
 
-        to_mmlc = StringDemuxer(string_to_mmlc)
+        to_mmlc = self.add(StringDemuxer(string_to_mmlc))
 
 
        ########################################################
        # SORT -> SMLC - > SORT -> MMLC
        ########################################################
-        self.sorter_out = PairHeapSorter(self.by_module.keys(), to_mmlc)                                 # sorter_out:  Receives the processed hits from each SMLC, sorts on time and passes to mmlc node
+        self.sorter_out = topo.merger(self, 'module_merge', self.by_module.keys(), topo.tapped(self, 'merged', None, to_mmlc))    # sorter_out:  Receives the processed hits from each SMLC, sorts on time and passes to mmlc node
        
 
         # build an input map that feeds each omkey stream to a per-module SORT/SMLC pipeline        # a per-module SORT/SMLC pipeline with per-omkey inputs
         self.by_omkey_input = {}
         for k in self.by_module.keys():
             device_type= geometry.lookup(k)
-            modulesort = PairHeapSorter(self.by_module[k], SMLC(k, SMLC.SMLCConfig.lookup(device_type), self.sorter_out.inputFor(k)))
+            self.device_type[k] = device_type
+            smlc = self.smlcs[k] = self.add(SMLC(k, self.smlcConfig(device_type), topo.tapped(self, 'smlc', k, self.sorter_out.inputFor(k))))
+            modulesort = topo.merger(self, 'module_sort', self.by_module[k], topo.tapped(self, 'module_sort', k, smlc))
             for omk in self.by_module[k]:
                 self.by_omkey_input[omk] = modulesort.inputFor(omk);
 
@@ -89,16 +121,80 @@ class Pipeline:
        ########################################################
        # DEMUX(to omkey) -> SORT
        ########################################################
-        self.demux = OMKEYDemuxer(self.by_omkey_input)                                                    # demux:       Demuxes a stream by omkey, pushing hits to the correct OMKEY/SORT/SMLC pipelines
+        self.demux = self.add(OMKEYDemuxer(self.by_omkey_input))                                          # demux:       Demuxes a stream by omkey, pushing hits to the correct OMKEY/SORT/SMLC pipelines
         
-        self.input_node = self.demux                                                                 # input_node alias the demuxer as "input node" 
-
-
-
-        # Debugging examples
-        # self.input_node = OMFilter( EnforceOrdering(self.input_node, "stage-1"), 89, 66, 1)            # filter input to a single module
-        # self.input_node =PMTFilter( self.input_node, 1)                                                # filter input to a single channel
-
+        self.input_node = topo.tapped(self, 'input', None, self.demux)                              # input_node alias the demuxer (or its fused input taps) as "input node"
+
+        # skip the Pipeline.enque indirection
+        if topo.fuse:
+            self.enque = self.input_node.enque
+
+
+    def buildOutput(self, sink):
+        ''' the stages after the final merge: trigger, event builder, monitor and the output taps '''
+        topo = self.topology
+        output = self.output_taps = topo.tapped(self, 'output', None, sink)
+        if isinstance(topo.monitor, RateMonitor):
+            topo.monitor.rebind(output, self.om_keys)
+            self.monitor = output = topo.monitor
+        elif topo.monitor is not None:
+            settings = topo.monitor if isinstance(topo.monitor, dict) else {}
+            self.monitor = output = self.add(RateMonitor(output, self.om_keys, **settings, ticks=self.ticks))
+        records = topo.trigger_records
+        if topo.events is not None:
+            readout = topo.events if isinstance(topo.events, dict) else {}
+            self.events = output = self.add(EventBuilder(output, topo.event_sink, **readout, ticks=self.ticks))
+            records = self.events.triggers
+        if topo.trigger is not None:
+            configs = topo.trigger if isinstance(topo.trigger, dict) else None
+            self.trigger = output = self.add(MajorityTrigger(output, configs, records, ticks=self.ticks))
+        return output
+
+    def add(self, node):
+        ''' register a built stage '''
+        self.nodes.append(node)
+        return node
+
+    def smlcConfig(self, device_type):
+        smlc_cfg = SMLC.SMLCConfig.lookup(device_type)
+        return smlc_cfg.inTicks() if self.ticks else smlc_cfg
+
+    def reset(self, omkeys=None, geometry=None):
+        ''' ready the pipeline for another stream (the next isolated frame)
+
+            The stages drop what they buffer and their eos state, stats are kept.
+            omkeys:   the channels of the next stream, the other inputs are closed up front
+                      so they do not hold back the merges
+            geometry: the device types of the next stream, SMLCs of modules deduced as
+                      another type are reconfigured
+        '''
+        self.resetStages()
+        if geometry is not None:
+            for k, device_type in geometry.table.items():
+                if k in self.smlcs and self.device_type[k] != device_type:
+                    self.device_type[k] = device_type
+                    self.smlcs[k].configure(self.smlcConfig(device_type))
+        if omkeys is not None:
+            omkeys = omkeys if isinstance(omkeys, (set, frozenset)) else set(omkeys)
+            self.demux.close([k for k in self.by_omkey_input if k not in omkeys])
+
+    def resetStages(self):
+        for node in self.nodes:
+            if hasattr(node, 'reset'):
+                node.reset()
+        if self.monitor is not None and self.monitor is self.topology.monitor:
+            self.monitor.rebind(self.output_taps)       # carried across pipelines, not one of the nodes
+
+    def stageBudget(self, name):
+        ''' the buffer budget of a stage kind, None when unbounded '''
+        return self.budget.stage(name) if self.budget is not None else None
+
+    def tap(self, boundary, kind, key=None):
+        ''' the first tap stage of class kind at a boundary (and key for per-module/string boundaries) '''
+        for k, stage in self.taps.get(boundary, []):
+            if k == key and isinstance(stage, kind):
+                return stage
+        raise RuntimeError(f'No {kind.__name__} tap at {boundary} {key}')
 
     def enque(self, hit):
         ''' input a hit into the pipeline '''
@@ -108,6 +204,273 @@ class Pipeline:
         ''' signals the end of inputs, flushes pipeline '''
         self.input_node.eos()
 
+    def watermark(self, t):
+        ''' signals that no hit earlier than t will be input, lets the stages release
+            what they hold for quiet channels. Forwarded to the sink as the output advances.
+        '''
+        self.input_node.watermark(t)
+
+    def __getstate__(self):
+        # pickled mid-stream for checkpoints, the enque shortcut is rebound on load
+        state = self.__dict__.copy()
+        state.pop('enque', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.topology.fuse:
+            self.enque = self.input_node.enque
+
+
+class PipelineTemplate:
+    ''' One Pipeline serving a sequence of isolated frames, reset between them
+
+        The pipeline is plumbed for the union of the populations seen so far, a frame
+        with channels it is not plumbed for has it rebuilt for the grown union (rare
+        once the detector's channels have shown up). The channels a frame lacks are
+        closed when it starts.
+
+        engine: the Pipeline class built, e.g. threaded.ThreadedPipeline
+    '''
+
+    def __init__(self, sink, topology=None, budget=None, ticks=False, engine=None):
+        self.sink = sink
+        self.engine = engine if engine is not None else Pipeline
+        self.topology = topology
+        self.budget = budget
+        self.ticks = ticks
+        self.pipeline = None
+        self.omkeys = set()         # the population the pipeline is plumbed for
+        self.table = {}             # module -> device type, as last seen
+        self.builds = 0
+        self.resets = 0
+
+    def pipelineFor(self, omkeys, geometry=None):
+        ''' the pipeline ready for a frame with the channels omkeys '''
+        omkeys = omkeys if isinstance(omkeys, (set, frozenset)) else set(omkeys)
+        if geometry is None:
+            geometry = Geometry.deduceGeometry(omkeys)
+        if self.pipeline is None or not omkeys <= self.omkeys:
+            if self.pipeline is not None:
+                self.close()
+            self.omkeys = self.omkeys | omkeys
+            self.table.update(geometry.table)
+            self.pipeline = self.engine(self.sink, self.omkeys, Geometry(dict(self.table)), self.topology, self.budget, self.ticks)
+            self.builds += 1
+        else:
+            self.resets += 1
+        self.pipeline.reset(omkeys, geometry)
+        return self.pipeline
+
+    def close(self):
+        ''' done with the current pipeline: its buffers and threads '''
+        if self.budget is not None:
+            self.budget.release()
+        if hasattr(self.pipeline, 'close'):
+            self.pipeline.close()
+
+    def report(self):
+        return f'pipeline built {self.builds} times for {len(self.omkeys)} channels, reused {self.resets} times'
+
+
+class Topology:
+    ''' Declarative description of a Pipeline: stage choices and taps
+
+        Boundaries where taps can be inserted, per-module/per-string boundaries
+        get a tap chain per instance:
+
+            input        before the demux to omkey
+            module_sort  after each module sorter, before its SMLC
+            smlc         after each SMLC
+            merged       after the detector-wide merge, before the demux to string
+            mmlc         after each MMLC
+            output       after the final merge, before the sink
+
+        taps maps a boundary to a list of tap specs, a spec is a kind name or a
+        tuple (kind, *args), e.g.
+
+            Topology(taps={'input': ['count', ('om', 89, 66, 1), 'order', 'log'],
+                           'output': ['count']})
+
+        ('trace', tracer) taps stamp the hits sampled by a trace.Tracer, see Tracer.topology
+
+        mergers ('module_sort', 'module_merge', 'string_merge') pick the sorter:
+        'pairheap' (PairHeapSorter), 'sorter' (Sorter) or ('reorder', lateness_ns)
+        (ReorderBuffer, for streams that are only slightly out of order), e.g.
+
+            Topology(module_sort=('reorder', 50.0))
+
+        fuse: collapse runs of adjacent stateless stages (counters, filters, logging,
+              the demuxer they feed) into one generated callable and wire merges
+              of a single stream straight through
+
+        trigger: attach a MajorityTrigger after the final merge, True for the default
+                 configs or a dict of MajorityTrigger configs, e.g. {'string': TriggerConfig(1500, 5)}
+        trigger_records: the sink for its TriggerRecords, default a trigger.majority.TriggerLog
+        events: build events around the triggers with an EventBuilder after the trigger (implies
+                trigger), True for the default readout or a dict of its before/after/lookback
+        event_sink: the sink for the Events, default a trigger.eventbuilder.EventLog
+        monitor: count per-channel rates and LC fractions with a RateMonitor after the final
+                 merge, True for the defaults, a dict of its settings, or a RateMonitor
+                 instance to carry across the pipelines built from this topology
+    '''
+
+    TAPS = {
+        'count':  lambda sink, name: Counter(sink),
+        'order':  lambda sink, name: EnforceOrdering(sink, name),
+        'log':    lambda sink, name: LoggingStage(name, sink),
+        'pmt':    lambda sink, name, pmt: PMTFilter(sink, pmt),
+        'om':     lambda sink, name, string, om, pmt: OMFilter(sink, string, om, pmt),
+        'stop':   lambda sink, name: Stop(),
+        'trace':  lambda sink, name, tracer: tracer.tap(sink, name),
+    }
+
+    MERGERS = {
+        'pairheap': lambda keys, sink, budget, ticks: PairHeapSorter(keys, sink, budget),
+        'sorter':   lambda keys, sink, budget, ticks: Sorter(keys, sink, budget),
+        'reorder':  lambda keys, sink, budget, ticks, lateness=None: ReorderBuffer(keys, sink, lateness, ticks),
+    }
+
+    def __init__(self, taps=None, module_sort='pairheap', module_merge='pairheap', string_merge='pairheap', fuse=True,
+                 trigger=None, trigger_records=None, events=None, event_sink=None, monitor=None):
+        self.taps = taps or {}
+        self.mergers = {'module_sort': module_sort, 'module_merge': module_merge, 'string_merge': string_merge}
+        self.fuse = fuse
+        self.trigger = trigger if trigger is not False else None
+        self.trigger_records = trigger_records
+        self.events = events if events is not False else None
+        self.event_sink = event_sink
+        self.monitor = monitor if monitor is not False else None
+        if self.events is not None and self.trigger is None:
+            self.trigger = True
+
+        self.checkTaps()
+        for merge, spec in self.mergers.items():
+            kind = spec if isinstance(spec, str) else spec[0]
+            if kind not in Topology.MERGERS:
+                raise RuntimeError(f'Unknown {merge} merger {kind}')
+
+    def checkTaps(self):
+        for boundary, specs in self.taps.items():
+            for spec in specs:
+                kind = spec if isinstance(spec, str) else spec[0]
+                if kind not in Topology.TAPS:
+                    raise RuntimeError(f'Unknown tap {kind} at {boundary}')
+
+    def withTaps(self, taps):
+        ''' the same topology with other taps '''
+        topology = copy.copy(self)
+        topology.taps = taps
+        topology.checkTaps()
+        return topology
+
+    def merger(self, pipeline, merge, keys, sink):
+        ''' time-merge the streams for keys into sink '''
+        keys = list(keys)
+        if self.fuse and len(keys) == 1:
+            return Passthrough(keys[0], sink)
+        spec = self.mergers[merge]
+        kind, args = (spec, ()) if isinstance(spec, str) else (spec[0], tuple(spec[1:]))
+        return pipeline.add(Topology.MERGERS[kind](keys, sink, pipeline.stageBudget(merge), pipeline.ticks, *args))
+
+    def tapped(self, pipeline, boundary, key, sink):
+        ''' the node feeding sink through the taps configured at the boundary '''
+        specs = self.taps.get(boundary, [])
+        if not specs:
+            return sink
+
+        name = boundary if key is None else f'{boundary}[{key}]'
+        stages = []
+        node = sink
+        run = []            # fusable stages directly upstream of node, in stream order
+        for spec in reversed(specs):
+            kind, args = (spec, ()) if isinstance(spec, str) else (spec[0], tuple(spec[1:]))
+            stage = Topology.TAPS[kind](node if not run else None, name, *args)
+            stages.append(stage)
+            if self.fuse and hasattr(stage, 'fuse'):
+                run.insert(0, stage)
+                continue
+            if run:
+                stage.sink = pipeline.add(FusedStage(run, node))
+                run = []
+            node = pipeline.add(stage)
+        if run:
+            node = pipeline.add(FusedStage(run, node))
+
+        taps = pipeline.taps.setdefault(boundary, [])
+        for stage in reversed(stages):
+            taps.append((key, stage))
+        return node
+
+
+class Passthrough:
+    ''' merge of a single stream, the stream is wired straight to the sink '''
+
+    def __init__(self, key, sink):
+        self.key = key
+        self.sink = sink
+
+    def inputFor(self, key):
+        if key != self.key:
+            raise RuntimeError(f'Passthrough not plumbed for {key}')
+        return self.sink
+
+    def watermark(self, t):
+        self.sink.watermark(t)
+
+
+class FusedStage:
+    ''' adjacent stateless stages collapsed into one generated enque
+
+        The fused stages are kept as the holders of their state (counts) and for their
+        eos reporting, but are no longer on the data path. A sink that can be fused
+        (the demuxers) has its routing inlined as well.
+    '''
+
+    def __init__(self, stages, sink):
+        self.stages = stages
+        self.sink = sink
+        for stage in stages:
+            stage.sink = Stop()
+        self.__compile()
+
+    def __compile(self):
+        env = {'RuntimeError': RuntimeError}
+        lines = ['def enque(hit):']
+        for i, stage in enumerate(self.stages):
+            ref = f'stage{i}'
+            env[ref] = stage
+            lines.extend('    ' + line for line in stage.fuse(ref))
+        if hasattr(self.sink, 'fuseRoute'):
+            lines.extend('    ' + line for line in self.sink.fuseRoute('sink', env))
+        else:
+            env['sink_enque'] = self.sink.enque
+            lines.append('    sink_enque(hit)')
+        exec('\n'.join(lines), env)
+        self.enque = env['enque']
+
+    def eos(self):
+        for stage in self.stages:
+            stage.eos()         # detached, only their own reporting
+        self.sink.eos()
+
+    def watermark(self, t):
+        self.sink.watermark(t)  # fused stages are stateless
+
+    def reset(self):
+        for stage in self.stages:
+            if hasattr(stage, 'reset'):
+                stage.reset()   # their counts
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['enque']      # generated, rebuilt on load
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__compile()
+
 
 
 def ensureSink(obj):
@@ -124,6 +487,7 @@ class OMKEYDemuxer:
             for s in sinks.values():
                 ensureSink(s)
             self.sinks = sinks
+            self.closed = set()     # streams ended early with close()
 
 
     def enque(self, myhit):
@@ -135,12 +499,42 @@ class OMKEYDemuxer:
             self.sinks[myhit.omkey].enque(myhit)
         else:
             self.sinks[myhit.omkey].eos()
+
+    def fuseRoute(self, ref, env):
+        ''' enque inlined into a FusedStage '''
+        env[ref] = self
+        env[f'{ref}_route'] = {k: s.enque for k, s in self.sinks.items()}
+        return [f'route = {ref}_route.get(hit.omkey)',
+                'if route is None:',
+                f'    raise RuntimeError(f"OMKey {{hit.omkey}} not in sink dict")',
+                'if not hit.isEOS():',
+                '    route(hit)',
+                'else:',
+                f'    {ref}.sinks[hit.omkey].eos()']
             
 
     def eos(self):
         ''' Call eos on all sinks'''
-        for sink in self.sinks.values():
-           sink.eos()
+        closed = self.closed
+        for k, sink in self.sinks.items():
+           if k not in closed:
+               sink.eos()
+
+    def watermark(self, t):
+        ''' the watermark holds for every stream '''
+        closed = self.closed
+        for k, sink in self.sinks.items():
+           if k not in closed:
+               sink.watermark(t)
+
+    def close(self, keys):
+        ''' end the streams of channels known to stay quiet, ahead of the eos '''
+        for k in keys:
+            self.closed.add(k)
+            self.sinks[k].eos()
+
+    def reset(self):
+        self.closed = set()
 
 
 class StringDemuxer:
@@ -160,6 +554,18 @@ class StringDemuxer:
             self.sinks[myhit.omkey.string].enque(myhit)
         else:
             self.sinks[myhit.omkey.string].eos()
+
+    def fuseRoute(self, ref, env):
+        ''' enque inlined into a FusedStage '''
+        env[ref] = self
+        env[f'{ref}_route'] = {k: s.enque for k, s in self.sinks.items()}
+        return [f'route = {ref}_route.get(hit.omkey.string)',
+                'if route is None:',
+                f'    raise RuntimeError(f"String {{hit.omkey.string}} not in sink dict")',
+                'if not hit.isEOS():',
+                '    route(hit)',
+                'else:',
+                f'    {ref}.sinks[hit.omkey.string].eos()']
             
 
     def eos(self):
@@ -167,6 +573,11 @@ class StringDemuxer:
         for sink in self.sinks.values():
            sink.eos()
 
+    def watermark(self, t):
+        ''' the watermark holds for every stream '''
+        for sink in self.sinks.values():
+           sink.watermark(t)
+
 class Counter:
     '''Sanity check'''
 
@@ -184,6 +595,16 @@ class Counter:
         ''' Call at end of data stream to flush all remaining hits to the sink'''
         self.sink.eos()
 
+    def watermark(self, t):
+        self.sink.watermark(t)
+
+    def reset(self):
+        self.cnt = 0
+
+    def fuse(self, ref):
+        ''' enque as inline code for a FusedStage '''
+        return [f'{ref}.cnt += 1']
+
 class Stopwatch:
     '''stopwatch'''
 
@@ -217,6 +638,12 @@ class EnforceOrdering:
         ''' Call at end of data stream to flush all remaining hits to the sink'''
         self.sink.eos()
 
+    def watermark(self, t):
+        self.sink.watermark(t)
+
+    def reset(self):
+        self.last_hit = None
+
 class PMTFilter:
     '''filters pmts'''
 
@@ -240,6 +667,20 @@ class PMTFilter:
         print(f'PMTFilter: passed: {self.passed} Dropped Hits: {self.dropped}')
         self.sink.eos()
 
+    def watermark(self, t):
+        self.sink.watermark(t)
+
+    def reset(self):
+        self.passed = 0
+        self.dropped = 0
+
+    def fuse(self, ref):
+        ''' enque as inline code for a FusedStage '''
+        return [f'if hit.omkey.pmt != {ref}.pmt:',
+                f'    {ref}.dropped += 1',
+                '    return',
+                f'{ref}.passed += 1']
+
 
 class OMFilter:
     '''filters pmts'''
@@ -259,6 +700,14 @@ class OMFilter:
     def eos(self):
         ''' Call at end of data stream to flush all remaining hits to the sink'''
         self.sink.eos()
+
+    def watermark(self, t):
+        self.sink.watermark(t)
+
+    def fuse(self, ref):
+        ''' enque as inline code for a FusedStage '''
+        return [f'if not (hit.omkey.string == {ref}.string and hit.omkey.om == {ref}.om and hit.omkey.pmt == {ref}.pmt):',
+                '    return']
      
         
 class Stop:
@@ -273,6 +722,13 @@ class Stop:
     def eos(self):
         pass
 
+    def watermark(self, t):
+        pass
+
+    def fuse(self, ref):
+        ''' enque as inline code for a FusedStage '''
+        return ['return']
+
 class LoggingStage:
     '''Development utility to log hits at particular stage'''
 
@@ -281,13 +737,23 @@ class LoggingStage:
         self.sink = sink
 
     def enque(self, hit):
-        print(f'hit from {hit.omkey} time: {hit.resolveTime()} @ {self.name}')
+        self.log(hit)
         self.sink.enque(hit)
 
+    def log(self, hit):
+        print(f'hit from {hit.omkey} time: {hit.resolveTime()} @ {self.name}')
+
     def eos(self):
         print(f'EOS @ {self.name}')
         self.sink.eos()
 
+    def watermark(self, t):
+        self.sink.watermark(t)
+
+    def fuse(self, ref):
+        ''' enque as inline code for a FusedStage '''
+        return [f'{ref}.log(hit)']
+
 
 class Joiner:
     '''Join Demuxed streams'''
@@ -341,8 +807,9 @@ class Sorter:
         def __init__(self, sorter, key):
             self.key=key
             self.sorter=sorter
-            self.hits = deque()
+            self.hits = sorter.budget.buffer() if sorter.budget is not None else deque()
             self.iseos = False
+            self.mark = None        # watermark, no later hit is earlier
 
         def enque(self, hit):
             self.hits.append(hit);
@@ -357,6 +824,10 @@ class Sorter:
             self.iseos=True;
             self.sorter.eos(self.key)
 
+        def watermark(self, t):
+            self.mark = t
+            self.sorter.watermark()
+
         def earliest(self):
             # if(len(self.hits) > 0):
             if self.hits:
@@ -367,9 +838,16 @@ class Sorter:
         def pop(self):
             return self.hits.popleft();
 
+        def reset(self):
+            self.hits.clear()
+            self.iseos = False
+            self.mark = None
 
-    def __init__(self, keys, sink):
+
+    def __init__(self, keys, sink, budget=None):
         self.sink = sink
+        self.budget = budget            # optional spill.StageBudget for the input buffers
+        self.mark = None                # last watermark forwarded
         self.input_nodes = {}
         for k in keys:
            self.input_nodes[k] = Sorter.InputNode(self, k);
@@ -382,6 +860,11 @@ class Sorter:
         else:
             raise RuntimeError(f'Sorter not plumbed for {key}')
 
+    def reset(self):
+        for node in self.input_nodes.values():
+            node.reset()
+        self.mark = None
+
     def eos(self, key):
         ''' accept eos from an input node  '''
         # flush and propagate if all streams are eos
@@ -393,6 +876,24 @@ class Sorter:
         self.sink.eos()
         
      
+    def watermark(self):
+        ''' an input's watermark advanced, release and forward the merged watermark '''
+        self.releaseAvailable()
+        mark = None
+        for node in self.input_nodes.values():
+            if node.iseos:
+                continue
+            t = node.earliest()
+            if t is None:
+                t = node.mark
+                if t is None:
+                    return              # a quiet input without a watermark bounds nothing
+            if mark is None or t < mark:
+                mark = t
+        if mark is not None and (self.mark is None or mark > self.mark):
+            self.mark = mark
+            self.sink.watermark(mark)
+
     def releaseAvailable(self):
         ''' Release hits available hits in time-sorted order'''
         ''' return the earliest hit '''
@@ -400,6 +901,7 @@ class Sorter:
         while(True):
             t_min = None
             ch = None
+            bound = None
             for key, node in self.input_nodes.items():
                 t = node.earliest()
                 if t is not None:
@@ -407,12 +909,146 @@ class Sorter:
                        t_min = t
                        ch = key
                 elif not node.iseos:
-                    return;             # an in-flight empty node prevents release
+                    if node.mark is None:
+                        return;         # an in-flight empty node prevents release
+                    if bound is None or node.mark < bound:
+                        bound = node.mark   # ... unless its watermark is past the candidate
              
-            if(ch is not None):
+            if(ch is not None) and (bound is None or t_min <= bound):
                 self.sink.enque(self.input_nodes[ch].pop())
             else:
-                return                 # All nodes empty and EOS
+                return                 # All nodes empty and EOS, or held by a watermark
+
+
+# O(logn) in the hits held, which the lateness bounds
+class ReorderBuffer:
+    '''time sort streams that are at most lateness out of order into one time ordered stream
+
+       Hits are held in a heap and released once the newest hit seen (or the inputs'
+       watermark) is more than lateness past them. Unlike the sorters it does not wait
+       on quiet inputs. A hit arriving behind the released frontier violates the bound,
+       it is counted and dropped.
+
+       lateness is in ns, converted when the hits are timed in ticks
+    '''
+
+    LATENESS = 1000.0
+
+    class Input:
+        def __init__(self, buffer, key):
+            self.buffer = buffer
+            self.key = key
+            self.iseos = False
+            self.mark = None        # watermark, no later hit is earlier
+
+        def enque(self, hit):
+            self.buffer.push(hit)
+
+        def eos(self):
+            if self.iseos:
+                raise RuntimeError(f'duplicate eos({self.key})')
+            self.iseos = True
+            self.buffer.eos()
+
+        def watermark(self, t):
+            self.mark = t
+            self.buffer.watermark()
+
+        def reset(self):
+            self.iseos = False
+            self.mark = None
+
+
+    def __init__(self, keys, sink, lateness=None, ticks=False):
+        self.sink = sink
+        lateness = lateness if lateness is not None else ReorderBuffer.LATENESS
+        self.lateness = toTicks(lateness) if ticks else lateness
+        self.heap = []                  # (time, seq, hit), seq keeps arrival order among equal times
+        self.seq = 0
+        self.newest = float('-inf')     # latest hit time seen
+        self.frontier = float('-inf')   # released up to here, earlier arrivals are late
+        self.mark = None                # last watermark forwarded
+        self.input_nodes = {}
+        for k in keys:
+            self.input_nodes[k] = ReorderBuffer.Input(self, k)
+
+        # stats
+        self.late = 0                   # hits dropped for violating the bound
+        self.max_late = 0               # furthest a dropped hit was behind the frontier
+        self.high_water = 0             # most hits held
+
+    def inputFor(self, key):
+        if key in self.input_nodes.keys():
+            return self.input_nodes[key]
+        else:
+            raise RuntimeError(f'ReorderBuffer not plumbed for {key}')
+
+    def reset(self):
+        ''' empty for another stream, the stats are kept '''
+        self.heap = []
+        self.seq = 0
+        self.newest = float('-inf')
+        self.frontier = float('-inf')
+        self.mark = None
+        for node in self.input_nodes.values():
+            node.reset()
+
+    def push(self, hit):
+        t = hit.resolveTime()
+        if t < self.frontier:
+            self.late += 1
+            if self.frontier - t > self.max_late:
+                self.max_late = self.frontier - t
+            return
+
+        heapq.heappush(self.heap, (t, self.seq, hit))
+        self.seq += 1
+        if len(self.heap) > self.high_water:
+            self.high_water = len(self.heap)
+        if t > self.newest:
+            self.newest = t
+            self.release(t - self.lateness)
+
+    def release(self, bound):
+        ''' release the hits up to bound, it becomes the frontier '''
+        if bound <= self.frontier:
+            return
+        self.frontier = bound
+        heap = self.heap
+        while heap and heap[0][0] <= bound:
+            self.sink.enque(heapq.heappop(heap)[2])
+
+    def eos(self):
+        ''' accept eos from an input node, flush once all streams are eos '''
+        for input_node in self.input_nodes.values():
+            if not input_node.iseos:
+                return
+        while self.heap:
+            self.sink.enque(heapq.heappop(self.heap)[2])
+        self.frontier = float('inf')
+        if self.late > 0:
+            print(f'ReorderBuffer: {self.late} late hits dropped, up to {self.max_late} behind, lateness {self.lateness}')
+        self.sink.eos()
+
+    def watermark(self):
+        ''' an input's watermark advanced, release up to the earliest and forward it '''
+        mark = None
+        for node in self.input_nodes.values():
+            if node.iseos:
+                continue
+            if node.mark is None:
+                return
+            if mark is None or node.mark < mark:
+                mark = node.mark
+        if mark is None:
+            return
+        self.release(mark)
+        if self.mark is None or self.frontier > self.mark:
+            self.mark = self.frontier
+            self.sink.watermark(self.frontier)
+
+    def report(self):
+        return f'held: {len(self.heap)} high-water: {self.high_water} late: {self.late} max late: {self.max_late} lateness: {self.lateness}'
 
 
 # O(logn), better
@@ -438,14 +1074,19 @@ class PairHeapSorter:
 
             self.node.sort(PairHeapSorter.Item(float('inf'), None))
 
+        def watermark(self, t):
+            # travels the tree as a hit-less item, unblocking the peer of a quiet input
+            self.node.sort(PairHeapSorter.Item(t, None))
+
     class InputNode:
-        def __init__(self, id):
+        def __init__(self, id, hits=None):
             self.id=id
-            self.hits = deque()
+            self.hits = hits if hits is not None else deque()
             self.peer = None;
             self.sink = None;
             self.isTerminal = False;
             self.iseos = False
+            self.mark = float('-inf')   # last watermark item passed into this node
  
         def sort(self, item):
             # this is the terminal node
@@ -466,16 +1107,26 @@ class PairHeapSorter:
         def release(self):
             while self.hits and self.peer.hits:
                 if self.hits[0].time < self.peer.hits[0].time:
-                    self.sink.sort(self.pop())
+                    item = self.pop()
                 else:
-                    self.sink.sort(self.peer.pop())
+                    item = self.peer.pop()
+                if item.hit is None and item.time <= self.sink.mark:
+                    continue            # watermark the merged stream is already past, one per round moves up
+                if item.hit is None and item.time != float('inf'):
+                    self.sink.mark = item.time
+                self.sink.sort(item)
 
         def pop(self):
             return self.hits.popleft();
 
+        def reset(self):
+            self.hits.clear()       # the eos items left behind
+            self.iseos = False
+            self.mark = float('-inf')
 
 
-        def __makePairTree__(nodes):
+
+        def __makePairTree__(nodes, budget=None):
             ''' link a set of input nodes into a pair heap sort tree
                 returns the topmost node
             '''
@@ -502,7 +1153,7 @@ class PairHeapSorter:
                     acc = acc[:-1]
 
 
-                sink = PairHeapSorter.InputNode(f'{a.id}-{b.id}')
+                sink = PairHeapSorter.InputNode(f'{a.id}-{b.id}', budget.buffer() if budget is not None else None)
                 a.peer = b
                 b.peer = a
                 a.sink = sink
@@ -510,23 +1161,30 @@ class PairHeapSorter:
                 acc.append(sink)
 
 
-            return PairHeapSorter.InputNode.__makePairTree__(acc)
+            return PairHeapSorter.InputNode.__makePairTree__(acc, budget)
 
 
     class OutputAdapter:
         def __init__(self, sink):
             self.sink = sink;
+            self.mark = None        # last watermark forwarded
 
         def enque(self, item):
             if item.time == float('inf'):
                 self.sink.eos()
+            elif item.hit is None:
+                # every input's watermark arrives, forward the advances only
+                if self.mark is None or item.time > self.mark:
+                    self.mark = item.time
+                    self.sink.watermark(item.time)
             else:
                 self.sink.enque(item.hit)
  
 
 
-    def __init__(self, keys, sink):
+    def __init__(self, keys, sink, budget=None):
         self.sink = sink
+        self.budget = budget            # optional spill.StageBudget for the node buffers
     
         self.inn = 0;
         self.out = 0;
@@ -536,16 +1194,26 @@ class PairHeapSorter:
         # make the sort tree
         tmp = {}
         for k in keys:
-           tmp[k] = PairHeapSorter.InputNode(f'{k}');
-        output = PairHeapSorter.InputNode.__makePairTree__(list(tmp.values()))
+           tmp[k] = PairHeapSorter.InputNode(f'{k}', budget.buffer() if budget is not None else None);
+        output = PairHeapSorter.InputNode.__makePairTree__(list(tmp.values()), budget)
 
         # adapt the input/output nodes of the sorter to operate
         # with hits/eos rather that "items""
         output.sink = PairHeapSorter.OutputAdapter(self.sink);  #forward sorted hits to sink
+        self.output = output.sink
         self.input_nodes = {}
         for k, node in tmp.items():
            self.input_nodes[k] = PairHeapSorter.InputAdapter(node)
 
+        # every node of the tree, for reset
+        self.tree = []
+        known = set()
+        for node in tmp.values():
+            while isinstance(node, PairHeapSorter.InputNode) and id(node) not in known:
+                known.add(id(node))
+                self.tree.append(node)
+                node = node.sink
+
 
 
     def inputFor(self, key):
@@ -556,3 +1224,9 @@ class PairHeapSorter:
 
    
 
+    def reset(self):
+        for node in self.tree:
+            node.reset()
+        for adapter in self.input_nodes.values():
+            adapter.iseos = False
+        self.output.mark = None
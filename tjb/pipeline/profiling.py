@@ -0,0 +1,173 @@
+#
+# Per-stage profiling and memory tracing for production-sized runs
+#
+# Profiler samples and allocation sites are attributed to the pipeline stage classes
+# (PairHeapSorter, SMLC, MMLC, Accumulator, ...) by mapping code locations to the class
+# whose method they are in, everything else is reported by module.
+#
+import cProfile
+import inspect
+import os
+import pstats
+import signal
+import sys
+import tracemalloc
+
+from collections import Counter
+
+
+# modules whose classes are the stages
+STAGE_MODULES = [
+    'pipeline.pipeline', 'pipeline.driver', 'pipeline.injest', 'pipeline.batch', 'pipeline.spill',
+    'pipeline.monitor', 'pipeline.trace', 'pipeline.shm', 'pipeline.threaded', 'pipeline.fusedlc', 'pipeline.shadow', 'pipeline.adaptive', 'pipeline.output', 'pipeline.util', 'pipeline.synthetic', 'pipeline.i3reader',
+    'uglc.smlc', 'uglc.mmlc', 'uglc.stringlc', 'uglc.slidingwindow', 'uglc.kernels',
+    'trigger.majority', 'trigger.eventbuilder',
+]
+
+
+class StageMap:
+    ''' code location -> stage (class) name '''
+
+    def __init__(self):
+        self.ranges = {}        # filename -> [(first line, last line, class name)]
+        for name in STAGE_MODULES:
+            module = sys.modules.get(name)
+            if module is not None:
+                self.addModule(module)
+
+    def addModule(self, module):
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ == module.__name__:
+                self.addClass(cls, cls.__name__)
+
+    def addClass(self, cls, name):
+        try:
+            lines, first = inspect.getsourcelines(cls)
+        except (OSError, TypeError):
+            return
+        filename = os.path.abspath(inspect.getsourcefile(cls))
+        self.ranges.setdefault(filename, []).append((first, first + len(lines) - 1, name))
+        for _, inner in inspect.getmembers(cls, inspect.isclass):
+            if inner.__qualname__.startswith(cls.__qualname__ + '.'):
+                self.addClass(inner, f'{name}.{inner.__name__}')
+
+    def stage(self, filename, lineno):
+        ''' the innermost class around filename:lineno, else the module file '''
+        if filename == '<string>':
+            return 'FusedStage'         # the generated enque
+        best = None
+        for first, last, name in self.ranges.get(os.path.abspath(filename), ()):
+            if first <= lineno <= last and (best is None or first > best[0]):
+                best = (first, name)
+        return best[1] if best is not None else os.path.basename(filename)
+
+
+class StageProfile:
+    ''' cProfile or sampling profile of a callable, aggregated per stage
+
+        kind: 'cprofile' (deterministic, own time per function) or 'sample' (statistical,
+              the innermost stage on the stack every interval seconds of CPU time)
+    '''
+
+    def __init__(self, kind='cprofile', interval=0.001):
+        if kind not in ('cprofile', 'sample'):
+            raise RuntimeError(f'Unsupported profile {kind}')
+        self.kind = kind
+        self.interval = interval
+        self.stats = None
+        self.samples = Counter()        # innermost (filename, lineno) -> samples
+
+    def run(self, fn):
+        if self.kind == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(fn)
+            finally:
+                self.stats = pstats.Stats(profile)
+        previous = signal.signal(signal.SIGPROF, self.__sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            return fn()
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, previous)
+
+    def __sample(self, signum, frame):
+        if frame is not None:
+            self.samples[(frame.f_code.co_filename, frame.f_lineno or frame.f_code.co_firstlineno)] += 1
+
+    def byStage(self):
+        ''' stage -> seconds (cprofile) or samples, with the top functions per stage '''
+        stages = StageMap()
+        totals = Counter()
+        functions = {}
+        if self.kind == 'cprofile':
+            for (filename, lineno, func), (cc, nc, tt, ct, callers) in self.stats.stats.items():
+                stage = stages.stage(filename, lineno) if filename != '~' else 'builtins'
+                totals[stage] += tt
+                functions.setdefault(stage, Counter())[func] += tt
+        else:
+            for (filename, lineno), n in self.samples.items():
+                stage = stages.stage(filename, lineno)
+                totals[stage] += n
+                functions.setdefault(stage, Counter())[f'{os.path.basename(filename)}:{lineno}'] += n
+        return totals, functions
+
+    def report(self, top=15):
+        totals, functions = self.byStage()
+        overall = sum(totals.values()) or 1
+        unit = 's' if self.kind == 'cprofile' else ' samples'
+        lines = [f'profile ({self.kind}) by stage, own time:']
+        for stage, v in totals.most_common(top):
+            hot = ', '.join(f'{f}' for f, _ in functions[stage].most_common(3))
+            shown = f'{v:.3f}' if self.kind == 'cprofile' else f'{v}'
+            lines.append(f'{stage:>32}: {shown}{unit} {v / overall:6.1%}  {hot}')
+        return lines
+
+
+class MemoryTrace:
+    ''' tracemalloc peak and the allocation sites of the largest snapshot, per stage
+
+        checkpoint() is called at frame boundaries, the snapshot with the most traced
+        memory is kept
+    '''
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.snapshot = None
+        self.snapshot_size = 0
+        self.peak = 0
+
+    def start(self):
+        tracemalloc.start(self.frames)
+
+    def checkpoint(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.snapshot_size:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = current
+
+    def stop(self):
+        self.checkpoint()
+        _, self.peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def report(self, top=10):
+        lines = [f'memory: peak traced {self.peak / 2**20:.1f} MiB, largest frame-boundary snapshot {self.snapshot_size / 2**20:.1f} MiB']
+        if self.snapshot is None:
+            return lines
+        stages = StageMap()
+        totals = Counter()
+        sites = self.snapshot.statistics('lineno')
+        for stat in sites:
+            frame = stat.traceback[0]
+            totals[stages.stage(frame.filename, frame.lineno)] += stat.size
+        lines.append('  by stage:')
+        for stage, size in totals.most_common(top):
+            lines.append(f'{stage:>32}: {size / 2**20:8.2f} MiB')
+        lines.append('  top allocators:')
+        for stat in sites[:top]:
+            frame = stat.traceback[0]
+            lines.append(f'{stages.stage(frame.filename, frame.lineno):>32}: {stat.size / 2**20:8.2f} MiB {stat.count:>8} blocks  '
+                         f'{os.path.basename(frame.filename)}:{frame.lineno}')
+        return lines
@@ -0,0 +1,152 @@
+#
+# Shadow runs: a candidate engine checked against the reference on a sample of frames
+#
+# Every `every`-th frame ingested is decoded twice more and run through the reference
+# and the candidate engine on their own, away from the production pipeline and its
+# consumer. The outputs are compared hit by hit, keyed by (channel, raw time):
+#
+#   flags    SMLC/MMLC flags of the hits both engines released
+#   missing  hits the reference released and the candidate did not
+#   extra    hits only the candidate released
+#   order    positions where the release orders of the hits both released differ,
+#            hits at equal times count as ordered by channel
+#
+# The enque/eos time of each engine is summed for the relative speed, construction
+# is not timed.
+#
+import contextlib
+import io
+import time
+
+from pipeline.engines import Engine
+from pipeline.engines import REFERENCE
+from pipeline.injest import Population
+from pipeline.util import hitKey
+
+
+class Collect:
+    ''' sink keeping the released hits in order '''
+
+    def __init__(self):
+        self.hits = []
+
+    def enque(self, hit):
+        self.hits.append(hit)
+
+    def eos(self):
+        pass
+
+    def watermark(self, t):
+        pass
+
+
+def releaseOrder(hits):
+    ''' hit keys in release order, runs of equal times in key order '''
+    order = []
+    run = []
+    t_run = None
+    for hit in hits:
+        t = hit.resolveTime()
+        if t != t_run:
+            order.extend(sorted(run))
+            run = []
+            t_run = t
+        run.append(hitKey(hit))
+    order.extend(sorted(run))
+    return order
+
+
+class Shadow:
+    ''' runs candidate beside the reference engine on one in every frames
+
+        candidate, reference: engine names, see engines.Engine
+        examples:  mismatching hits kept for the report
+    '''
+
+    def __init__(self, candidate, reference=REFERENCE, every=10, examples=10, ticks=False):
+        self.candidate = Engine.lookup(candidate)
+        self.reference = Engine.lookup(reference)
+        self.every = every
+        self.examples = examples
+        self.ticks = ticks              # set by the Driver
+        self.seen = 0
+        self.next_sample = 1
+        self.frames = 0                 # frames shadowed
+        self.hits = 0
+        self.flags = 0
+        self.missing = 0
+        self.extra = 0
+        self.order = 0
+        self.failed = []                # (frame id, (key, reference flags, candidate flags)), the first examples
+        self.reference_s = 0.0
+        self.candidate_s = 0.0
+
+    def watch(self, frames):
+        ''' pass the frames through, shadowing the sampled ones '''
+        for frame in frames:
+            self.seen += 1
+            if self.seen >= self.next_sample:
+                self.next_sample += self.every
+                self.shadow(frame)
+            yield frame
+
+    def shadow(self, frame):
+        omkeys = Population.extractPopulation(frame.rpsm)
+        expected, t_reference = self.run(self.reference, frame, omkeys)
+        got, t_candidate = self.run(self.candidate, frame, omkeys)
+        self.reference_s += t_reference
+        self.candidate_s += t_candidate
+        self.frames += 1
+        self.hits += len(expected)
+        self.compare(frame.frame_id, expected, got)
+
+    def run(self, engine, frame, omkeys):
+        ''' (released hits, seconds) of engine on fresh hits of the frame '''
+        hits = list(frame.hits())
+        sink = Collect()
+        with contextlib.redirect_stdout(io.StringIO()):     # the stages print their configuration
+            pipeline = engine.build(sink, omkeys, frame.geometry, None, None, self.ticks)
+        t0 = time.perf_counter()
+        for hit in hits:
+            pipeline.enque(hit)
+        pipeline.eos()
+        elapsed = time.perf_counter() - t0
+        if hasattr(pipeline, 'close'):
+            pipeline.close()
+        return sink.hits, elapsed
+
+    def compare(self, frame_id, expected, got):
+        flags = {hitKey(h): (h.smlc, h.mmlc) for h in got}
+        for hit in expected:
+            key = hitKey(hit)
+            candidate = flags.pop(key, None)
+            if candidate is None:
+                self.missing += 1
+                self.example(frame_id, key, (hit.smlc, hit.mmlc), None)
+            elif candidate != (hit.smlc, hit.mmlc):
+                self.flags += 1
+                self.example(frame_id, key, (hit.smlc, hit.mmlc), candidate)
+        for key, candidate in flags.items():
+            self.extra += 1
+            self.example(frame_id, key, None, candidate)
+
+        common = set(hitKey(h) for h in expected) & set(hitKey(h) for h in got)
+        expected_order = [k for k in releaseOrder(expected) if k in common]
+        got_order = [k for k in releaseOrder(got) if k in common]
+        self.order += sum(a != b for a, b in zip(expected_order, got_order))
+
+    def example(self, frame_id, key, expected, got):
+        if len(self.failed) < self.examples:
+            self.failed.append((frame_id, (key, expected, got)))
+
+    def mismatches(self):
+        return self.flags + self.missing + self.extra + self.order
+
+    def report(self):
+        speedup = f'x{self.reference_s / self.candidate_s:.2f}' if self.candidate_s > 0 else '-'
+        lines = [f'shadow {self.candidate.name} vs {self.reference.name}: {self.frames} of {self.seen} frames, one in {self.every}, '
+                 f'hits: {self.hits} mismatches flags: {self.flags} missing: {self.missing} extra: {self.extra} order: {self.order}',
+                 f'  time {self.reference.name}: {self.reference_s:.3f} s {self.candidate.name}: {self.candidate_s:.3f} s speedup: {speedup}']
+        for frame_id, (key, expected, got) in self.failed:
+            lines.append(f'  {frame_id} {key} (smlc, mmlc) {self.reference.name}: {expected} {self.candidate.name}: {got}')
+        return lines
@@ -0,0 +1,267 @@
+#
+# Shared-memory hit transport between the ingest process and pipeline worker processes.
+#
+# Hits travel as fixed-width records in a multiprocessing.shared_memory ring of frame
+# slots. Ingest writes each frame once, a worker builds its pipeline over views of the
+# records (nothing is pickled or copied) and marks SMLC/MMLC by setting flag bits in
+# place, ingest then reads the flags back.
+#
+#   ring header:  | stop u32 | pad u32 |
+#   slot:         | state u32 | n_hits u32 | seq u64 | record * slot_hits |
+#   record:       | time f64 | channel u32 | flags u8 | pad * 3 |
+#
+# Slot s is owned by worker s % n_workers, so every slot has a single producer (ingest)
+# and a single consumer (its worker); the state word is written after the payload.
+#
+import multiprocessing
+import struct
+
+from collections import deque
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from pipeline.injest import Geometry
+from pipeline.injest import ModuleKey
+from pipeline.pipeline import PipelineTemplate
+from pipeline.pipeline import Stop
+from uglc.kernels import MMLC_BIT
+from uglc.kernels import SMLC_BIT
+
+
+HIT_RECORD = struct.Struct('<dIB3x')
+FLAGS_OFFSET = 12                       # offset of the flags byte in a record
+SLOT_HEADER = struct.Struct('<IIQ')
+RING_HEADER = struct.Struct('<I4x')
+
+# flag bits past the kernels' SMLC_BIT and MMLC_BIT
+FLAG_MDOM = 4   # device type travels with the hit
+
+# slot states
+FREE = 0
+READY = 1
+DONE = 2
+
+
+# worker side channel key, carries what the pipeline needs from an OMKey
+ChannelKey = namedtuple('ChannelKey', ['string', 'om', 'pmt'])
+
+
+def packChannel(omkey):
+    ''' fixed-width channel id, no lookup table to share between processes '''
+    if omkey.om > 0xfff or omkey.pmt > 0xff or omkey.string > 0xfff:
+        raise RuntimeError(f'Channel {omkey} does not fit the hit record')
+    return (omkey.string << 20) | (omkey.om << 8) | omkey.pmt
+
+
+def unpackChannel(channel):
+    return ChannelKey(channel >> 20, (channel >> 8) & 0xfff, channel & 0xff)
+
+
+class HitRing:
+    ''' ring of frame slots in shared memory '''
+
+    def __init__(self, shm, n_slots, slot_hits, owner):
+        self.shm = shm
+        self.buf = shm.buf
+        self.n_slots = n_slots
+        self.slot_hits = slot_hits
+        self.slot_size = SLOT_HEADER.size + slot_hits * HIT_RECORD.size
+        self.owner = owner
+
+    def create(n_slots, slot_hits):
+        size = RING_HEADER.size + n_slots * (SLOT_HEADER.size + slot_hits * HIT_RECORD.size)
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        ring = HitRing(shm, n_slots, slot_hits, True)
+        RING_HEADER.pack_into(ring.buf, 0, 0)
+        for slot in range(n_slots):
+            ring.setState(slot, FREE)
+        return ring
+
+    def attach(name, n_slots, slot_hits):
+        return HitRing(shared_memory.SharedMemory(name=name), n_slots, slot_hits, False)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def slotOffset(self, slot):
+        return RING_HEADER.size + slot * self.slot_size
+
+    def recordOffset(self, slot, i):
+        return self.slotOffset(slot) + SLOT_HEADER.size + i * HIT_RECORD.size
+
+    def state(self, slot):
+        return struct.unpack_from('<I', self.buf, self.slotOffset(slot))[0]
+
+    def setState(self, slot, state):
+        struct.pack_into('<I', self.buf, self.slotOffset(slot), state)
+
+    def header(self, slot):
+        ''' (state, n_hits, seq) '''
+        return SLOT_HEADER.unpack_from(self.buf, self.slotOffset(slot))
+
+    def stopped(self):
+        return RING_HEADER.unpack_from(self.buf, 0)[0] != 0
+
+    def stop(self):
+        RING_HEADER.pack_into(self.buf, 0, 1)
+
+    def writeFrame(self, slot, seq, hits):
+        ''' write a frame's hits into a FREE slot and mark it READY '''
+        if len(hits) > self.slot_hits:
+            raise RuntimeError(f'Frame of {len(hits)} hits exceeds the ring slot capacity {self.slot_hits}')
+        off = self.slotOffset(slot) + SLOT_HEADER.size
+        for hit in hits:
+            flags = FLAG_MDOM if hit.device_type == Geometry.DeviceType.MDOM else 0
+            HIT_RECORD.pack_into(self.buf, off, hit.resolveTime(), packChannel(hit.omkey), flags)
+            off += HIT_RECORD.size
+        SLOT_HEADER.pack_into(self.buf, self.slotOffset(slot), FREE, len(hits), seq)
+        self.setState(slot, READY)
+
+    def flags(self, slot, n):
+        ''' iterate the flag bytes of the first n records of a slot '''
+        off = self.recordOffset(slot, 0) + FLAGS_OFFSET
+        for _ in range(n):
+            yield self.buf[off]
+            off += HIT_RECORD.size
+
+
+class ShmHit:
+    ''' pipeline hit backed by a record in the ring, marks are written in place '''
+
+    __slots__ = ('buf', 'flag_off', 'time', 'omkey', 'device_type')
+
+    def __init__(self, buf, off, omkeys):
+        t, channel, flags = HIT_RECORD.unpack_from(buf, off)
+        self.buf = buf
+        self.flag_off = off + FLAGS_OFFSET
+        self.time = t
+        omkey = omkeys.get(channel)
+        if omkey is None:
+            omkey = omkeys[channel] = unpackChannel(channel)
+        self.omkey = omkey
+        self.device_type = Geometry.DeviceType.MDOM if flags & FLAG_MDOM else Geometry.DeviceType.DEGG
+
+    def resolveTime(self):
+        return self.time
+
+    def rawTime(self):
+        return self.time
+
+    def isEOS(self):
+        return False
+
+    def markSMLC(self):
+        self.buf[self.flag_off] |= SMLC_BIT
+
+    def markMMLC(self):
+        self.buf[self.flag_off] |= MMLC_BIT
+
+    @property
+    def smlc(self):
+        return bool(self.buf[self.flag_off] & SMLC_BIT)
+
+    @property
+    def mmlc(self):
+        return bool(self.buf[self.flag_off] & MMLC_BIT)
+
+
+def ringWorker(name, n_slots, slot_hits, worker, n_workers, ready, done, ticks=False):
+    ''' worker process body: run a Pipeline (reset per frame) over each READY slot it owns '''
+    ring = HitRing.attach(name, n_slots, slot_hits)
+    omkeys = {}
+    template = PipelineTemplate(Stop(), ticks=ticks)
+    slot = worker
+    try:
+        while True:
+            ready.acquire()
+            if ring.stopped():
+                return
+            state, n, seq = ring.header(slot)
+            if state != READY:
+                raise RuntimeError(f'worker {worker}: slot {slot} not ready ({state})')
+
+            hits = [ShmHit(ring.buf, ring.recordOffset(slot, i), omkeys) for i in range(n)]
+            population = {h.omkey for h in hits}
+            geometry = Geometry({ModuleKey.extractOMKey(h.omkey): h.device_type for h in hits})
+
+            pipeline = template.pipelineFor(population, geometry)
+            for hit in hits:
+                pipeline.enque(hit)
+            pipeline.eos()
+            hits = None
+
+            ring.setState(slot, DONE)
+            done.release()
+            slot = (slot + n_workers) % n_slots
+    finally:
+        ring.close()
+
+
+class RingWorkers:
+    ''' farm isolated frames out to worker processes over a HitRing
+
+        process(frames, collect) calls collect(frame, hits) in frame order once
+        the frame's hits carry their SMLC/MMLC marks
+    '''
+
+    def __init__(self, n_workers, slots_per_worker=2, slot_hits=1 << 18, ticks=False):
+        self.n_workers = n_workers
+        self.ticks = ticks          # hits are timed in DAQ ticks, exact in the f64 record
+        self.n_slots = n_workers * slots_per_worker
+        self.slot_hits = slot_hits
+
+    def process(self, frames, collect):
+        ring = HitRing.create(self.n_slots, self.slot_hits)
+        ready = [multiprocessing.Semaphore(0) for _ in range(self.n_workers)]
+        done = multiprocessing.Semaphore(0)
+        workers = [multiprocessing.Process(target=ringWorker,
+                                           args=(ring.shm.name, self.n_slots, self.slot_hits, w, self.n_workers, ready[w], done, self.ticks),
+                                           daemon=True)
+                   for w in range(self.n_workers)]
+        for p in workers:
+            p.start()
+
+        in_flight = deque()     # (seq, slot, frame, hits) in frame order
+        try:
+            seq = 0
+            for frame in frames:
+                slot = seq % self.n_slots
+                if len(in_flight) == self.n_slots:
+                    self.__collectOldest(ring, in_flight, done, workers, collect)
+
+                hits = list(frame.hits())
+                ring.writeFrame(slot, seq, hits)
+                ready[slot % self.n_workers].release()
+                in_flight.append((seq, slot, frame, hits))
+                seq += 1
+
+            while in_flight:
+                self.__collectOldest(ring, in_flight, done, workers, collect)
+        finally:
+            ring.stop()
+            for sem in ready:
+                sem.release()
+            for p in workers:
+                p.join(timeout=5)
+                if p.is_alive():
+                    p.terminate()
+            ring.close()
+
+    def __collectOldest(self, ring, in_flight, done, workers, collect):
+        seq, slot, frame, hits = in_flight.popleft()
+        while ring.state(slot) != DONE:
+            if not done.acquire(timeout=1.0):
+                for p in workers:
+                    if not p.is_alive():
+                        raise RuntimeError(f'pipeline worker exited with {p.exitcode}')
+
+        for hit, flags in zip(hits, ring.flags(slot, len(hits))):
+            if flags & SMLC_BIT:
+                hit.markSMLC()
+            if flags & MMLC_BIT:
+                hit.markMMLC()
+        ring.setState(slot, FREE)
+        collect(frame, hits)
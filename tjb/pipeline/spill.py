@@ -0,0 +1,233 @@
+#
+# Bounded-memory buffers for the stages that hold hits while waiting on a lagging input
+# (sorter input nodes). The MMLC buffers are not capped, they span MAX_WINDOW and are
+# scanned whole for every window closed, spilled runs would be re-read each time.
+#
+# A SpillDeque keeps at most `cap` items in memory. Past the cap the oldest run of the
+# in-memory tail is pickled to a temporary segment file, segments are read back in
+# order as the head drains, so the buffer stays FIFO:
+#
+#   | head (memory) | segment | segment | ... | tail (memory) |
+#     popleft/[0]      spilled runs, oldest first      append
+#
+import pickle
+import tempfile
+
+from collections import deque
+
+
+class SpillDeque:
+    ''' FIFO with the deque subset the stages use: append, popleft, [0], len, iteration '''
+
+    def __init__(self, cap, spill_dir=None, run=None):
+        if cap < 1:
+            raise RuntimeError(f'Buffer cap must be at least 1, got {cap}')
+        self.cap = cap
+        self.run = run if run is not None else max(1, cap // 2)     # items per spilled segment
+        self.spill_dir = spill_dir
+        self.head = deque()
+        self.tail = deque()
+        self.segments = deque()     # (offset, count) of spilled runs in the file, oldest first
+        self.n_spilled = 0          # items currently on disk
+        self.file = None
+
+        # stats
+        self.high_water = 0         # most items buffered, memory + disk
+        self.memory_high_water = 0  # most items held in memory
+        self.spilled = 0            # items written to disk
+        self.spills = 0             # segments written
+
+    def __len__(self):
+        return len(self.head) + self.n_spilled + len(self.tail)
+
+    def __bool__(self):
+        return len(self.head) > 0   # head only drains empty with everything else
+
+    def __getitem__(self, i):
+        if i == 0:
+            return self.head[0]
+        if i == -1:
+            return self.tail[-1] if self.tail else self.head[-1]
+        raise IndexError('SpillDeque only supports [0] and [-1]')
+
+    def __iter__(self):
+        ''' oldest first, spilled segments are read but not consumed '''
+        yield from self.head
+        for offset, count in list(self.segments):
+            yield from self.__read(offset)
+        yield from self.tail
+
+    def append(self, item):
+        if not self.head:
+            self.head.append(item)  # empty, everything else is too
+        else:
+            self.tail.append(item)
+
+        n = len(self)
+        if n > self.high_water:
+            self.high_water = n
+        in_memory = len(self.head) + len(self.tail)
+        if in_memory > self.cap:
+            self.__spill()
+            in_memory = len(self.head) + len(self.tail)
+        if in_memory > self.memory_high_water:
+            self.memory_high_water = in_memory
+
+    def popleft(self):
+        item = self.head.popleft()
+        if not self.head:
+            self.__refill()
+        return item
+
+    def clear(self):
+        ''' empty, the stats are kept '''
+        self.head.clear()
+        self.tail.clear()
+        self.segments.clear()
+        self.n_spilled = 0
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __getstate__(self):
+        # spilled segments are read back in, the file is not part of the state
+        state = self.__dict__.copy()
+        state['items'] = list(self)
+        for k in ('head', 'tail', 'segments', 'n_spilled', 'file'):
+            del state[k]
+        return state
+
+    def __setstate__(self, state):
+        items = state.pop('items')
+        self.__dict__.update(state)
+        self.head = deque()
+        self.tail = deque()
+        self.segments = deque()
+        self.n_spilled = 0
+        self.file = None
+        stats = (self.high_water, self.memory_high_water, self.spilled, self.spills)
+        for item in items:
+            self.append(item)
+        self.high_water, self.memory_high_water, self.spilled, self.spills = stats
+
+    def __spill(self):
+        ''' move the oldest run of the tail to a segment, it follows the segments already written '''
+        k = min(self.run, len(self.tail))
+        if k == 0:
+            return
+        items = [self.tail.popleft() for _ in range(k)]
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.spill_dir, prefix='tjb-spill-')
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        pickle.dump(items, self.file, pickle.HIGHEST_PROTOCOL)
+        self.segments.append((offset, k))
+        self.n_spilled += k
+        self.spilled += k
+        self.spills += 1
+
+    def __read(self, offset):
+        self.file.seek(offset)
+        return pickle.load(self.file)
+
+    def __refill(self):
+        ''' the head drained, load the oldest segment or take over the tail '''
+        if self.segments:
+            offset, count = self.segments.popleft()
+            self.head.extend(self.__read(offset))
+            self.n_spilled -= count
+            if not self.segments:
+                self.file.seek(0)
+                self.file.truncate()
+            while len(self.head) + len(self.tail) > self.cap and self.tail:
+                self.__spill()
+        else:
+            self.head, self.tail = self.tail, self.head
+
+
+class StageBudget:
+    ''' the buffers of one stage kind, all instances share the cap and the report line '''
+
+    def __init__(self, name, cap, spill_dir):
+        self.name = name
+        self.cap = cap
+        self.spill_dir = spill_dir
+        self.buffers = []
+
+        # stats folded in from released buffers
+        self.n_buffers = 0
+        self.high_water = 0
+        self.memory_high_water = 0
+        self.spilled = 0
+        self.spills = 0
+
+    def buffer(self):
+        ''' a new buffer for an instance of the stage, a plain deque if the stage is uncapped '''
+        if self.cap is None:
+            return deque()
+        buf = SpillDeque(self.cap, self.spill_dir)
+        self.buffers.append(buf)
+        return buf
+
+    def release(self):
+        ''' fold the stats of the current buffers in and let go of them '''
+        for buf in self.buffers:
+            self.n_buffers += 1
+            self.high_water = max(self.high_water, buf.high_water)
+            self.memory_high_water = max(self.memory_high_water, buf.memory_high_water)
+            self.spilled += buf.spilled
+            self.spills += buf.spills
+            buf.close()
+        self.buffers = []
+
+    def report(self):
+        if self.cap is None:
+            return f'{self.name:>12}: uncapped'
+        live = self.buffers
+        high_water = max([self.high_water] + [b.high_water for b in live])
+        memory = max([self.memory_high_water] + [b.memory_high_water for b in live])
+        spilled = self.spilled + sum(b.spilled for b in live)
+        spills = self.spills + sum(b.spills for b in live)
+        return (f'{self.name:>12}: cap: {self.cap} buffers: {self.n_buffers + len(live)} high-water: {high_water} '
+                f'in memory: {memory} spilled hits: {spilled} segments: {spills}')
+
+
+class MemoryBudget:
+    ''' caps on buffered hits per stage kind
+
+        cap:       per-buffer cap applied to every stage kind, None leaves them uncapped
+        caps:      per stage kind overrides, e.g. {'module_sort': 10000, 'string_merge': None}
+                   stage kinds: module_sort, module_merge, string_merge
+        spill_dir: directory for the segment files, defaults to the system temp dir
+
+        One budget can serve a sequence of pipelines (isolated frames), the report
+        then covers all of them.
+    '''
+
+    STAGES = ('module_sort', 'module_merge', 'string_merge')
+
+    def __init__(self, cap=None, caps=None, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.stages = {}
+        caps = caps or {}
+        for name in caps:
+            if name not in MemoryBudget.STAGES:
+                raise RuntimeError(f'Unknown stage {name}, expected one of {MemoryBudget.STAGES}')
+        for name in MemoryBudget.STAGES:
+            self.stages[name] = StageBudget(name, caps.get(name, cap), spill_dir)
+
+    def stage(self, name):
+        return self.stages[name]
+
+    def release(self):
+        ''' done with the current pipeline's buffers, their stats are kept for the report '''
+        for stage in self.stages.values():
+            stage.release()
+
+    def report(self):
+        return [stage.report() for stage in self.stages.values()]
@@ -0,0 +1,362 @@
+#
+# Live-stream front end: hits arrive over a local socket as time ordered per-channel
+# packets, pDAQ style, and are fed to a Pipeline as they come. Quiet channels would
+# stall the sorters, so the feed interleaves watermarks ("no hit earlier than t follows")
+# which the stages use to release what they hold.
+#
+# ReplayServer is a stand-in for the hit source, it replays I3 files or synthetic noise
+# at real time or an accelerated rate.
+#
+#   cd tjb
+#   python -m pipeline.stream demo --speed 10
+#   python -m pipeline.stream serve --unix /tmp/tjb.sock --speed 1 &
+#   python -m pipeline.stream ingest --unix /tmp/tjb.sock
+#
+# Wire format, little endian:
+#
+#   packet:   | kind u8 | pad u8 | string u16 | om u16 | pmt u16 | count u32 | sent f64 |
+#   'C':      count * | string u16 | om u16 | pmt u16 | device u8 |     channel population
+#   'H':      count * | time f64 |                                     one channel's hits
+#   'W':      | watermark f64 |
+#   'E':      end of stream
+#
+# sent is the server's wall clock (time.time()) when the packet was written, hit latency
+# is measured from it to the hit leaving the pipeline.
+#
+import argparse
+import asyncio
+import bisect
+import os
+import struct
+import sys
+import tempfile
+import time
+
+from array import array
+from collections import namedtuple
+
+from pipeline.injest import Geometry
+from pipeline.injest import Injest
+from pipeline.injest import ModuleKey
+from pipeline.injest import Population
+from pipeline.pipeline import Pipeline
+from pipeline.pipeline import Stop
+
+
+PACKET = struct.Struct('<BxHHHId')
+CHANNEL = struct.Struct('<HHHB')
+WATERMARK = struct.Struct('<d')
+
+CONFIG = ord('C')
+HITS = ord('H')
+MARK = ord('W')
+END = ord('E')
+
+
+# channel key of streamed hits, carries what the pipeline needs from an OMKey
+StreamKey = namedtuple('StreamKey', ['string', 'om', 'pmt'])
+
+
+class StreamHit:
+    ''' hit received from the stream '''
+
+    __slots__ = ('omkey', 'device_type', 'time', 't_sent', 'smlc', 'mmlc')
+
+    def __init__(self, omkey, device_type, time, t_sent):
+        self.omkey = omkey
+        self.device_type = device_type
+        self.time = time
+        self.t_sent = t_sent
+        self.smlc = False
+        self.mmlc = False
+
+    def resolveTime(self):
+        return self.time
+
+    def rawTime(self):
+        return self.time
+
+    def isEOS(self):
+        return False
+
+    def markSMLC(self):
+        self.smlc = True
+
+    def markMMLC(self):
+        self.mmlc = True
+
+
+class ReplayServer:
+    ''' serves frames as a hit stream, every client gets a full replay
+
+        injest: Injest over the files (or synthetic source) to replay, frames are laid
+                end to end on one timeline separated by gap ns
+        speed:  data time per wall time, 1.0 is real time, None is as fast as possible
+        tick:   ns of data time per round of channel packets, each round is closed by
+                a watermark
+    '''
+
+    def __init__(self, injest, speed=1.0, tick=100000.0, gap=1000.0):
+        self.injest = injest
+        self.speed = speed
+        self.tick = tick
+        self.gap = gap
+
+    async def serve(self, path=None, host='127.0.0.1', port=0):
+        ''' start listening on a unix socket path, or tcp host/port, returns the asyncio server '''
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path=path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        try:
+            await self.replay(writer)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def replay(self, writer):
+        # learn the population up front, the way a run configuration would provide it
+        peek = []
+        geometries = []
+        for frame in self.injest.upgradePulseFrames(join=False):
+            peek.append(frame.rpsm)
+            geometries.append(frame.geometry)
+        omkeys = Population.extractPopulation(*peek)
+        geometry = Geometry.merge(*geometries)
+        peek = None
+
+        body = b''.join(CHANNEL.pack(k.string, k.om, k.pmt, geometry.lookup(k).value) for k in omkeys)
+        writer.write(PACKET.pack(CONFIG, 0, 0, 0, len(omkeys), time.time()) + body)
+        await writer.drain()
+
+        t_data = None       # timeline position, the end of the last replayed frame
+        t_origin = None     # timeline start ...
+        t_wall = None       # ... and the wall clock it was replayed at
+        for frame in self.injest.upgradePulseFrames(join=False):
+            t_min, t_max = Population.extractTimeInterval(frame.rpsm)
+            if t_data is None:
+                offset = 0.0
+                t_data = t_origin = t_min
+                t_wall = time.time()
+            else:
+                offset = t_data - t_min + self.gap
+            channels = [(k, [p.time + offset for p in pulses]) for k, pulses in frame.rpsm.items() if len(pulses) > 0]
+
+            t = t_min + offset
+            t_end = t_max + offset
+            while t <= t_end:
+                t_next = t + self.tick
+                sent = time.time()
+                for k, times in channels:
+                    lo = bisect.bisect_left(times, t)
+                    hi = bisect.bisect_left(times, t_next)
+                    if hi > lo:
+                        writer.write(PACKET.pack(HITS, k.string, k.om, k.pmt, hi - lo, sent)
+                                     + struct.pack(f'<{hi - lo}d', *times[lo:hi]))
+                writer.write(PACKET.pack(MARK, 0, 0, 0, 1, sent) + WATERMARK.pack(t_next))
+                await writer.drain()
+                t = t_next
+
+                if self.speed is not None:
+                    delay = t_wall + (t - t_origin) * 1e-9 / self.speed - time.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            t_data = t
+
+        writer.write(PACKET.pack(END, 0, 0, 0, 0, time.time()))
+        await writer.drain()
+
+
+class LatencySink:
+    ''' pipeline output stage, measures the hit latency from the server's send time '''
+
+    def __init__(self, sink=None):
+        self.sink = sink if sink is not None else Stop()
+        self.latency = array('d')   # seconds, per hit
+        self.cnt = 0
+        self.smlc_cnt = 0
+        self.mmlc_cnt = 0
+        self.mark = None            # last watermark out of the pipeline
+
+    def enque(self, hit):
+        self.latency.append(time.time() - hit.t_sent)
+        self.cnt += 1
+        if hit.smlc:
+            self.smlc_cnt += 1
+        if hit.mmlc:
+            self.mmlc_cnt += 1
+        self.sink.enque(hit)
+
+    def watermark(self, t):
+        self.mark = t
+        self.sink.watermark(t)
+
+    def eos(self):
+        self.sink.eos()
+
+    def percentiles(self, ps=(50, 90, 99, 100)):
+        ''' latency percentiles in seconds '''
+        if not self.latency:
+            return {p: None for p in ps}
+        ordered = sorted(self.latency)
+        return {p: ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] for p in ps}
+
+
+class StreamIngest:
+    ''' asyncio client feeding a hit stream to a Pipeline
+
+        sink: receives the processed hits, in time order, and watermarks
+        topology/budget: handed to the Pipeline
+    '''
+
+    def __init__(self, sink=None, topology=None, budget=None):
+        self.out = LatencySink(sink)
+        self.topology = topology
+        self.budget = budget
+        self.device = None          # channel -> device type, from the CONFIG packet
+        self.pipeline = None
+
+        # keep-up accounting
+        self.cnt = 0
+        self.busy = 0.0             # seconds spent in the pipeline
+        self.t_first = None         # data time span seen
+        self.t_last = None
+        self.wall_start = None
+        self.wall_end = None
+
+    async def connect(self, path=None, host='127.0.0.1', port=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        try:
+            await self.run(reader)
+        finally:
+            writer.close()
+
+    async def run(self, reader):
+        while True:
+            kind, string, om, pmt, count, sent = PACKET.unpack(await reader.readexactly(PACKET.size))
+            if kind in (HITS, MARK, END) and self.pipeline is None:
+                raise RuntimeError(f'Stream protocol error: {chr(kind)!r} packet before the channel population (CONFIG)')
+            if kind == HITS:
+                payload = await reader.readexactly(count * 8)
+                omkey = StreamKey(string, om, pmt)
+                device_type = self.device[omkey]
+                t0 = time.perf_counter()
+                enque = self.pipeline.enque
+                for t in struct.unpack(f'<{count}d', payload):
+                    enque(StreamHit(omkey, device_type, t, sent))
+                self.busy += time.perf_counter() - t0
+                self.cnt += count
+            elif kind == MARK:
+                t, = WATERMARK.unpack(await reader.readexactly(WATERMARK.size))
+                t0 = time.perf_counter()
+                self.pipeline.watermark(t)
+                self.busy += time.perf_counter() - t0
+                if self.t_first is None:
+                    self.t_first = t
+                self.t_last = t
+            elif kind == CONFIG:
+                self.configure(await reader.readexactly(count * CHANNEL.size), count)
+            elif kind == END:
+                t0 = time.perf_counter()
+                self.pipeline.eos()
+                self.busy += time.perf_counter() - t0
+                self.wall_end = time.time()
+                return
+            else:
+                raise RuntimeError(f'Unknown packet kind {kind}')
+
+    def configure(self, body, count):
+        ''' channel population received, plumb the pipeline '''
+        self.device = {}
+        table = {}
+        for i in range(count):
+            string, om, pmt, device = CHANNEL.unpack_from(body, i * CHANNEL.size)
+            omkey = StreamKey(string, om, pmt)
+            self.device[omkey] = Geometry.DeviceType(device)
+            table[ModuleKey.extractOMKey(omkey)] = Geometry.DeviceType(device)
+        self.pipeline = Pipeline(self.out, list(self.device.keys()), Geometry(table), self.topology, self.budget)
+        self.wall_start = time.time()
+
+    def report(self):
+        ''' summary lines: counts, latency percentiles and keep-up margin '''
+        lines = [f'hits: in: {self.cnt} out: {self.out.cnt} smlc: {self.out.smlc_cnt} mmlc: {self.out.mmlc_cnt}']
+        pct = self.out.percentiles()
+        if pct[50] is not None:
+            lines.append('latency ms: ' + ' '.join(f'p{p}: {v*1e3:.2f}' for p, v in pct.items()))
+        if self.t_first is not None and self.wall_end is not None:
+            data = (self.t_last - self.t_first) * 1e-9
+            wall = self.wall_end - self.wall_start
+            lines.append(f'data time: {data:.3f} s wall time: {wall:.3f} s busy: {self.busy:.3f} s ({self.busy / wall:.0%} of wall)')
+            if self.busy > 0 and data > 0:
+                # capacity: data seconds per busy second, live rates need > x1
+                # idle: headroom at the rate the stream was actually fed, 0% is falling behind
+                capacity = data / self.busy
+                lines.append(f'keep-up margin: capacity x{capacity:.2f} real time, fed at x{data / wall:.2f}, idle {max(0.0, 1 - self.busy / wall):.0%}')
+        return lines
+
+
+def replaySource(args):
+    ''' the Injest a server replays: the files given, or synthetic noise '''
+    if args.files:
+        return Injest(args.files)
+    from pipeline.synthetic import SyntheticSource
+    config = SyntheticSource.NoiseConfig(frame_len=args.frame_len)
+    source = SyntheticSource(config, args.seed, args.frames)
+    return Injest(source.files(1), source)
+
+
+async def serveMain(args):
+    server = ReplayServer(replaySource(args), args.speed or None, args.tick)
+    srv = await server.serve(args.unix, args.host, args.port)
+    print(f'serving on {args.unix or srv.sockets[0].getsockname()}')
+    async with srv:
+        await srv.serve_forever()
+
+
+async def ingestMain(args):
+    ingest = StreamIngest()
+    await ingest.connect(args.unix, args.host, args.port)
+    for line in ingest.report():
+        print(line)
+
+
+async def demoMain(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'hits.sock')
+        srv = await ReplayServer(replaySource(args), args.speed or None, args.tick).serve(path)
+        async with srv:
+            ingest = StreamIngest()
+            await ingest.connect(path)
+        for line in ingest.report():
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='live hit stream ingest and replay server')
+    parser.add_argument('command', choices=['serve', 'ingest', 'demo'])
+    parser.add_argument('files', nargs='*', help='i3 files to replay, synthetic noise if none')
+    parser.add_argument('--unix', help='unix socket path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--speed', type=float, default=1.0, help='replay rate, x real time, 0 as fast as possible')
+    parser.add_argument('--tick', type=float, default=100000.0, help='ns of data per watermark round')
+    parser.add_argument('--frames', type=int, default=10, help='synthetic frames')
+    parser.add_argument('--frame-len', type=float, default=1e6, help='synthetic frame length, ns')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == 'ingest' and args.unix is None and args.port == 0:
+        parser.error('ingest needs --unix or --port')
+
+    run = {'serve': serveMain, 'ingest': ingestMain, 'demo': demoMain}[args.command]
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+#
+# Synthetic upgrade random-noise pulse maps, a stand-in for the RandomNoise I3 files
+# so the pipeline can be exercised and benchmarked without icetray or the /data/sim tree.
+#
+# The generated maps quack like I3RecoPulseSeriesMap: a dict of omkey -> time ordered
+# pulse list, where omkeys carry string/om/pmt and pulses carry time/charge/width.
+#
+import hashlib
+import random
+
+from collections import namedtuple
+
+from pipeline.injest import Geometry
+
+
+# stand-ins for icetray OMKey and I3RecoPulse, only the fields the pipeline touches
+SynthOMKey = namedtuple('SynthOMKey', ['string', 'om', 'pmt'])
+SynthPulse = namedtuple('SynthPulse', ['time', 'charge', 'width'])
+
+
+class SyntheticSource:
+    ''' Generates upgrade-like noise frames, usable as the reader of Injest/Driver
+
+        "files" are just names, each one seeds an independent reproducible
+        sequence of frames, e.g.
+
+            source = SyntheticSource(SyntheticSource.NoiseConfig(), seed=7)
+            Driver(consumer, 0, source).process_all_files(source.files(3))
+    '''
+
+    class NoiseConfig:
+        ''' detector layout and noise model '''
+
+        def __init__(self,
+                     strings=(87, 88, 89, 90, 91, 92, 93),
+                     modules_per_string=20,
+                     device_cycle=(Geometry.DeviceType.MDOM, Geometry.DeviceType.MDOM, Geometry.DeviceType.DEGG),
+                     degg_pmts=2,
+                     mdom_pmts=24,
+                     degg_rate=1000.0,
+                     mdom_rate=300.0,
+                     pmt_rates=None,
+                     burst_rate=0.0,
+                     burst_size=4,
+                     burst_span=50.0,
+                     frame_len=1000000.0,
+                     t_start=0.0,
+                     emit_empty=True):
+            self.strings = tuple(strings)
+            self.modules_per_string = modules_per_string
+            self.device_cycle = tuple(device_cycle)     # device type of om n is device_cycle[(n-1) % len]
+            self.degg_pmts = degg_pmts
+            self.mdom_pmts = mdom_pmts
+            self.degg_rate = degg_rate                  # Hz per PMT
+            self.mdom_rate = mdom_rate                  # Hz per PMT
+            self.pmt_rates = pmt_rates or {}            # per-PMT overrides, (string, om, pmt) -> Hz
+            self.burst_rate = burst_rate                # Hz per module, correlated bursts
+            self.burst_size = burst_size                # mean hits per burst
+            self.burst_span = burst_span                # ns, burst hits are spread over this interval
+            self.frame_len = frame_len                  # ns
+            self.t_start = t_start                      # ns, raw time of the frame start
+            self.emit_empty = emit_empty                # keep silent channels in the map so geometry deduction sees every PMT
+
+            if degg_pmts > 3:
+                # Geometry.deduceGeometry treats any pmt > 2 as an mDOM
+                raise RuntimeError(f'DEGG with {degg_pmts} PMTs would be deduced as MDOM')
+
+        def deviceFor(self, om):
+            return self.device_cycle[(om - 1) % len(self.device_cycle)]
+
+        def pmtCount(self, device_type):
+            match device_type:
+                case Geometry.DeviceType.DEGG:
+                    return self.degg_pmts
+                case Geometry.DeviceType.MDOM:
+                    return self.mdom_pmts
+                case _:
+                    raise RuntimeError(f'Unsupported device: {device_type}');
+
+        def rateFor(self, omkey, device_type):
+            ''' noise rate of a PMT in Hz '''
+            rate = self.pmt_rates.get((omkey.string, omkey.om, omkey.pmt))
+            if rate is not None:
+                return rate
+            match device_type:
+                case Geometry.DeviceType.DEGG:
+                    return self.degg_rate
+                case Geometry.DeviceType.MDOM:
+                    return self.mdom_rate
+                case _:
+                    raise RuntimeError(f'Unsupported device: {device_type}');
+
+        def modules(self):
+            ''' iterate (string, om, device_type, [omkeys]) over the layout '''
+            for string in self.strings:
+                for om in range(1, self.modules_per_string + 1):
+                    device_type = self.deviceFor(om)
+                    omkeys = [SynthOMKey(string, om, pmt) for pmt in range(self.pmtCount(device_type))]
+                    yield (string, om, device_type, omkeys)
+
+        def channelCount(self):
+            return sum(len(omkeys) for _, _, _, omkeys in self.modules())
+
+        def expectedHits(self):
+            ''' mean number of hits per frame '''
+            hits = 0.0
+            for _, _, device_type, omkeys in self.modules():
+                for omkey in omkeys:
+                    hits += self.rateFor(omkey, device_type) * self.frame_len * 1e-9
+                hits += self.burst_rate * self.frame_len * 1e-9 * self.burst_size
+            return hits
+
+        def __repr__(self):
+            return repr(sorted(vars(self).items(), key=lambda kv: kv[0]))
+
+
+    def __init__(self, config=None, seed=0, frames_per_file=10):
+        self.config = config if config is not None else SyntheticSource.NoiseConfig()
+        self.seed = seed
+        self.frames_per_file = frames_per_file
+
+    def fingerprint(self, fname):
+        ''' stands in for a content hash, a "file" is fully determined by the generator settings '''
+        return hashlib.sha256(repr((self.config, self.seed, self.frames_per_file, fname)).encode()).hexdigest()
+
+    def files(self, n, prefix='synthetic'):
+        ''' names for n synthetic "files" '''
+        return [f'{prefix}-{i}' for i in range(n)]
+
+    def daqPulseMaps(self, fname, want=None):
+        ''' iterate the pulse maps of a synthetic file, each reproducible from (seed, fname, frame)
+
+            frames rejected by want(cnt) are yielded as None without being generated
+        '''
+        for cnt in range(self.frames_per_file):
+            if want is None or want(cnt):
+                yield self.makeFrame(random.Random(f'{self.seed}:{fname}:{cnt}'))
+            else:
+                yield None
+
+    def makeFrame(self, rng):
+        ''' generate a single pulse map '''
+        cfg = self.config
+        t_start = cfg.t_start
+        t_end = cfg.t_start + cfg.frame_len
+
+        rpsm = {}
+        for string, om, device_type, omkeys in cfg.modules():
+            module_pulses = {}
+            for omkey in omkeys:
+                module_pulses[omkey] = self.__poisson(rng, cfg.rateFor(omkey, device_type), t_start, t_end)
+
+            # correlated bursts, a cluster of hits spread across the PMTs of one module
+            if cfg.burst_rate > 0:
+                for t_burst in self.__poisson(rng, cfg.burst_rate, t_start, t_end):
+                    n = 1 + int(rng.expovariate(1.0 / cfg.burst_size))
+                    for _ in range(n):
+                        t = t_burst.time + rng.uniform(0.0, cfg.burst_span)
+                        if t < t_end:
+                            omkey = omkeys[rng.randrange(len(omkeys))]
+                            module_pulses[omkey].append(SyntheticSource.__pulse(rng, t))
+                for pulses in module_pulses.values():
+                    pulses.sort(key=lambda p: p.time)
+
+            for omkey, pulses in module_pulses.items():
+                if pulses or cfg.emit_empty:
+                    rpsm[omkey] = pulses
+
+        return rpsm
+
+    def __poisson(self, rng, rate, t_start, t_end):
+        ''' time ordered pulses of a poisson process with rate in Hz over [t_start, t_end) ns'''
+        pulses = []
+        if rate <= 0:
+            return pulses
+        per_ns = rate * 1e-9
+        t = t_start + rng.expovariate(per_ns)
+        while t < t_end:
+            pulses.append(SyntheticSource.__pulse(rng, t))
+            t += rng.expovariate(per_ns)
+        return pulses
+
+    def __pulse(rng, t):
+        return SynthPulse(t, rng.uniform(0.5, 1.5), 5.0)
@@ -0,0 +1,265 @@
+#
+# Thread-per-string execution of the SMLC/MMLC chains
+#
+# Past the demux to string the strings share no state until the final merge, so each
+# string's module sorters, SMLCs, module merge and MMLC run as a Pipeline of their own
+# on a thread of their own:
+#
+#   input -> batch by string =SPSC=> [string 87 Pipeline] =\
+#                            =SPSC=> [string 88 Pipeline] ==> outbox -> string merge -> output
+#                            ...                            /
+#
+# Hits cross the threads in batches, a batch costs a semaphore round trip, the hits in
+# it nothing. The string merge, trigger, event builder, monitor and the input/output taps
+# run on the calling thread, which drains the outbox as it feeds the strings.
+#
+# On free-threaded CPython (3.13t and later) the strings run in parallel. With the GIL
+# they interleave and the threads only add overhead, see bench.stages ThreadedPipeline.
+#
+import sys
+import threading
+
+from collections import deque
+
+from pipeline.injest import Geometry
+from pipeline.injest import Population
+from pipeline.pipeline import Pipeline
+from pipeline.pipeline import Topology
+from pipeline.util import SpscQueue
+
+
+# outbox item kinds
+HITS = 0
+WATERMARK = 1
+EOS = 2
+FAILED = 3
+
+STOP = object()         # inbox item ending a worker thread
+
+
+def gilEnabled():
+    ''' False on a free-threaded build running without the GIL '''
+    is_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_enabled() if is_enabled is not None else True
+
+
+class Outbox:
+    ''' unbounded multi-producer single-consumer queue of (string, kind, payload) '''
+
+    def __init__(self):
+        self.items = deque()
+        self.filled = threading.Semaphore(0)
+
+    def put(self, item):
+        self.items.append(item)
+        self.filled.release()
+
+    def get(self, block=True):
+        ''' the next item, None when not blocking and there is none '''
+        if not self.filled.acquire(block):
+            return None
+        return self.items.popleft()
+
+
+class StringOutput:
+    ''' sink of a string's Pipeline, batches its output into the outbox (worker thread) '''
+
+    def __init__(self, string, outbox, batch):
+        self.string = string
+        self.outbox = outbox
+        self.batch = batch
+        self.hits = []
+
+    def enque(self, hit):
+        self.hits.append(hit)
+        if len(self.hits) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self.hits:
+            self.outbox.put((self.string, HITS, self.hits))
+            self.hits = []
+
+    def watermark(self, t):
+        self.flush()
+        self.outbox.put((self.string, WATERMARK, t))
+
+    def eos(self):
+        # the EOS item is posted by the StringWorker once the string pipeline's eos()
+        # has returned, stages upstream may still be unwinding here
+        self.flush()
+
+
+class StringWorker:
+    ''' a string's Pipeline on its own thread, fed batches of hits, watermarks and eos (None) '''
+
+    def __init__(self, string, pipeline, outbox, depth):
+        self.string = string
+        self.pipeline = pipeline
+        self.outbox = outbox
+        self.inbox = SpscQueue(depth)
+        self.thread = threading.Thread(target=self.run, name=f'string-{string}', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        failed = False
+        while True:
+            item = self.inbox.get()
+            if item is STOP:
+                return
+            if failed:
+                continue            # keep draining so the feeder never blocks
+            try:
+                if type(item) is list:
+                    enque = self.pipeline.enque
+                    for hit in item:
+                        enque(hit)
+                elif item is None:
+                    self.pipeline.eos()
+                    self.outbox.put((self.string, EOS, None))     # the pipeline is idle, reset() may follow
+                else:
+                    self.pipeline.watermark(item)
+            except Exception as e:
+                failed = True
+                self.outbox.put((self.string, FAILED, e))
+
+
+class StringFeeder:
+    ''' the demux to string on the calling thread, batches the hits per string '''
+
+    def __init__(self, owner, strings, batch):
+        self.owner = owner
+        self.batch = batch
+        self.buffers = {k: [] for k in strings}
+
+    def enque(self, hit):
+        buffer = self.buffers.get(hit.omkey.string)
+        if buffer is None:
+            raise RuntimeError(f"String {hit.omkey.string} not in sink dict")
+        buffer.append(hit)
+        if len(buffer) >= self.batch:
+            self.send(hit.omkey.string)
+
+    def send(self, string):
+        self.owner.workers[string].inbox.put(self.buffers[string])
+        self.buffers[string] = []
+        self.owner.drain(block=False)
+
+    def eos(self):
+        self.owner.broadcast(None)
+
+    def watermark(self, t):
+        self.owner.broadcast(t)
+
+
+class ThreadedPipeline(Pipeline):
+    ''' Pipeline running each string's SMLC/MMLC chain on its own thread
+
+        Same sink interface, topology and taps as Pipeline. The per-module/per-string
+        boundaries (module_sort, smlc, merged, mmlc) are tapped in the string pipelines,
+        'merged' is then each string's module merge. The input and output taps, string
+        merge, trigger, event builder and monitor run on the calling thread.
+
+        batch: hits per hand-over between threads
+        depth: batches queued per string before the input blocks
+
+        The threads serve every stream of a reset() pipeline, close() ends them.
+    '''
+
+    BATCH = 512
+    DEPTH = 64
+
+    def __init__(self, sink, all_omkeys, geometry=None, topology=None, budget=None, ticks=False, batch=None, depth=None):
+        if geometry is None:
+            geometry = Geometry.deduceGeometry(all_omkeys)
+
+        self.om_keys = all_omkeys
+        self.byString = Population.byString(self.om_keys)
+        self.sink = sink
+        self.topology = topology if topology is not None else Topology()
+        self.nodes = []
+        self.taps = {}
+        self.budget = budget
+        self.ticks = ticks
+        self.trigger = None
+        self.events = None
+        self.monitor = None
+        self.batch = batch if batch is not None else ThreadedPipeline.BATCH
+        topo = self.topology
+
+        output = self.buildOutput(sink)
+        self.merge = topo.merger(self, 'string_merge', self.byString.keys(), output)
+        self.merge_inputs = {k: self.merge.inputFor(k) for k in self.byString.keys()}
+
+        # the string pipelines: the per-string taps and mergers, one string so no string merge
+        inner = Topology(taps={b: specs for b, specs in topo.taps.items() if b not in ('input', 'output')},
+                         module_sort=topo.mergers['module_sort'], module_merge=topo.mergers['module_merge'], fuse=topo.fuse)
+        self.outbox = Outbox()
+        self.workers = {}
+        for k, omkeys in self.byString.items():
+            pipeline = Pipeline(StringOutput(k, self.outbox, self.batch), omkeys, geometry, inner, budget, ticks)
+            self.workers[k] = StringWorker(k, pipeline, self.outbox, depth if depth is not None else ThreadedPipeline.DEPTH)
+        self.running = len(self.workers)        # strings yet to deliver their eos
+
+        self.feeder = self.add(StringFeeder(self, self.byString.keys(), self.batch))
+        self.input_node = topo.tapped(self, 'input', None, self.feeder)
+        if topo.fuse:
+            self.enque = self.input_node.enque
+
+    def tap(self, boundary, kind, key=None):
+        ''' the first tap stage of class kind at a boundary, here or in a string pipeline '''
+        for pipeline in [self] + [w.pipeline for w in self.workers.values()]:
+            for k, stage in pipeline.taps.get(boundary, []):
+                if k == key and isinstance(stage, kind):
+                    return stage
+        raise RuntimeError(f'No {kind.__name__} tap at {boundary} {key}')
+
+    def broadcast(self, item):
+        ''' flush the batches and send item (a watermark or None for eos) to every string '''
+        feeder = self.feeder
+        for k, worker in self.workers.items():
+            if feeder.buffers[k]:
+                worker.inbox.put(feeder.buffers[k])
+                feeder.buffers[k] = []
+            worker.inbox.put(item)
+        self.drain(block=item is None)
+
+    def drain(self, block):
+        ''' move the string outputs into the string merge, blocking: until every string's eos '''
+        outbox = self.outbox
+        inputs = self.merge_inputs
+        while self.running > 0:
+            item = outbox.get(block)
+            if item is None:
+                return
+            string, kind, payload = item
+            node = inputs[string]
+            if kind == HITS:
+                for hit in payload:
+                    node.enque(hit)
+            elif kind == WATERMARK:
+                node.watermark(payload)
+            elif kind == EOS:
+                self.running -= 1
+                node.eos()
+            else:
+                raise RuntimeError(f'string {string} failed: {payload!r}') from payload
+
+    def reset(self, omkeys=None, geometry=None):
+        ''' ready for another stream, see Pipeline.reset '''
+        if omkeys is not None and not isinstance(omkeys, (set, frozenset)):
+            omkeys = set(omkeys)
+        self.resetStages()
+        for worker in self.workers.values():
+            worker.pipeline.reset(omkeys, geometry)     # the threads are idle between streams
+        self.running = len(self.workers)
+
+    def close(self):
+        ''' end the worker threads '''
+        for worker in self.workers.values():
+            worker.inbox.put(STOP)
+        for worker in self.workers.values():
+            worker.thread.join()
+
+    def __getstate__(self):
+        raise RuntimeError('a ThreadedPipeline cannot be checkpointed')
@@ -0,0 +1,187 @@
+#
+# Sampled hit latency tracing through the pipeline stages
+#
+# Every `every`-th hit entering the pipeline is tagged, 'trace' taps at the stage
+# boundaries stamp the tagged hits with the wall clock and the stream time (latest hit
+# time input so far) as they pass, the Accumulator stamps them on delivery to the
+# consumer. The stamps travel on the hit (its trace attribute), so they follow it
+# through a spill to disk. In isolated mode the stream clock restarts with each frame.
+# The time between consecutive stamps is the hit's residence in the stage between the
+# boundaries, collected in log2 histograms per stage:
+#
+#   input -> module_sort     module sorter
+#   module_sort -> smlc      SMLC sliding window
+#   smlc -> merged           module merge
+#   merged -> mmlc           MMLC held/pending
+#   mmlc -> output           string merge
+#   output -> delivered      Accumulator, until the frame completes
+#
+# Untagged hits cost an attribute lookup per boundary.
+#
+import time
+
+from array import array
+
+
+STAGES = {
+    ('input', 'module_sort'): 'module sorter',
+    ('module_sort', 'smlc'): 'SMLC',
+    ('smlc', 'merged'): 'module merge',
+    ('merged', 'mmlc'): 'MMLC',
+    ('mmlc', 'output'): 'string merge',
+    ('output', 'delivered'): 'Accumulator',
+}
+
+
+class LatencyHistogram:
+    ''' log2 buckets, bucket k counts values in [2^(k-1), 2^k) '''
+
+    def __init__(self):
+        self.buckets = array('Q', [0]) * 65
+        self.n = 0
+        self.max = 0
+
+    def add(self, v):
+        v = int(v) if v > 0 else 0
+        self.buckets[v.bit_length()] += 1
+        self.n += 1
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        ''' upper bound of the bucket holding the q quantile '''
+        if self.n == 0:
+            return 0
+        rank = q * self.n
+        seen = 0
+        for k, c in enumerate(self.buckets):
+            seen += c
+            if seen >= rank:
+                return min(1 << k, self.max) if k > 0 else 0
+        return self.max
+
+
+class Tracer:
+    ''' latency tracing of a sample of the hits
+
+        every:      tag one in every hits at ingest
+        boundaries: the boundaries stamped, default all
+    '''
+
+    BOUNDARIES = ('input', 'module_sort', 'smlc', 'merged', 'mmlc', 'output')
+
+    class Tap:
+        ''' stamps the tagged hits passing a boundary '''
+
+        def __init__(self, tracer, sink, boundary):
+            self.tracer = tracer
+            self.sink = sink
+            self.boundary = boundary
+
+        def enque(self, hit):
+            stamps = getattr(hit, 'trace', None)
+            if stamps is not None:
+                stamps.append((self.boundary, time.perf_counter_ns(), self.tracer.now))
+            self.sink.enque(hit)
+
+        def eos(self):
+            self.sink.eos()
+
+        def watermark(self, t):
+            self.sink.watermark(t)
+
+    class InputTap(Tap):
+        ''' samples the hits and keeps the stream clock '''
+
+        def enque(self, hit):
+            tracer = self.tracer
+            t = hit.resolveTime()
+            if t > tracer.now:
+                tracer.now = t
+            tracer.seen += 1
+            if tracer.seen >= tracer.next_sample:
+                tracer.next_sample += tracer.every
+                tracer.tagged += 1
+                hit.trace = [('input', time.perf_counter_ns(), tracer.now)]
+            self.sink.enque(hit)
+
+
+    def __init__(self, every=1000, boundaries=None, ticks=False):
+        self.every = every
+        self.boundaries = tuple(boundaries) if boundaries is not None else Tracer.BOUNDARIES
+        self.ticks = ticks                  # stream times in DAQ ticks, reported in ns
+        self.now = float('-inf')
+        self.seen = 0
+        self.next_sample = 1
+        self.wall = {}                      # stage -> LatencyHistogram of wall ns
+        self.stream = {}                    # stage -> LatencyHistogram of stream ns
+        self.tagged = 0
+        self.traced = 0                     # tagged hits delivered
+
+    def tap(self, sink, name):
+        ''' the tap stage for a boundary, name is the boundary with an optional [key] '''
+        boundary = name.split('[')[0]
+        if boundary == 'input':
+            return Tracer.InputTap(self, sink, boundary)
+        return Tracer.Tap(self, sink, boundary)
+
+    def topology(self, base):
+        ''' base with trace taps first at the traced boundaries '''
+        taps = {b: list(specs) for b, specs in base.taps.items()}
+        for boundary in self.boundaries:
+            taps[boundary] = [('trace', self)] + taps.get(boundary, [])
+        return base.withTaps(taps)
+
+    def restart(self):
+        ''' a new independent stream follows, its times start over '''
+        self.now = float('-inf')
+
+    def delivered(self, hits):
+        ''' the hits reached the consumer '''
+        now = time.perf_counter_ns()
+        for hit in hits:
+            stamps = getattr(hit, 'trace', None)
+            if stamps is not None:
+                del hit.trace
+                stamps.append(('delivered', now, self.now))
+                self.record(stamps)
+
+    def resume(self, pipeline):
+        ''' take over the taps of a pipeline resumed from a checkpoint, they hold the
+            checkpointed tracer, its hits in flight are still to be delivered
+        '''
+        saved = None
+        for taps in pipeline.taps.values():
+            for _, stage in taps:
+                if isinstance(stage, Tracer.Tap) and stage.tracer is not self:
+                    saved = stage.tracer
+                    stage.tracer = self
+        if saved is not None:
+            self.now = saved.now
+            self.seen = saved.seen
+            self.next_sample = saved.next_sample
+            self.tagged += saved.tagged - saved.traced
+
+    def record(self, stamps):
+        self.traced += 1
+        scale = 0.1 if self.ticks else 1.0
+        for (a, wall_a, stream_a), (b, wall_b, stream_b) in zip(stamps, stamps[1:]):
+            stage = STAGES.get((a, b), f'{a} -> {b}')
+            if stage not in self.wall:
+                self.wall[stage] = LatencyHistogram()
+                self.stream[stage] = LatencyHistogram()
+            self.wall[stage].add(wall_b - wall_a)
+            self.stream[stage].add((stream_b - stream_a) * scale)
+
+    def report(self):
+        lines = [f'latency of {self.traced} traced hits, one in {self.every}, wall us p50/p90/p99/max | stream ns p50/p99/max']
+        if self.tagged > self.traced:
+            lines.append(f'{self.tagged - self.traced} tagged hits never delivered')
+        order = list(STAGES.values())
+        for stage in sorted(self.wall, key=lambda s: order.index(s) if s in order else len(order)):
+            wall = self.wall[stage]
+            stream = self.stream[stage]
+            us = lambda q: f'{wall.quantile(q) / 1000:.1f}'
+            lines.append(f'{stage:>14}: n: {wall.n:>7} wall: {us(0.5)}/{us(0.9)}/{us(0.99)}/{wall.max / 1000:.1f} '
+                         f'| stream: {stream.quantile(0.5)}/{stream.quantile(0.99)}/{stream.max}')
+        return lines
@@ -0,0 +1,35 @@
+#
+# Small pieces shared by the pipeline modules
+#
+import threading
+
+from collections import deque
+
+
+def hitKey(hit):
+    ''' identifies a hit across engines and runs: (string, om, pmt, raw time) '''
+    return (hit.omkey.string, hit.omkey.om, hit.omkey.pmt, hit.rawTime())
+
+
+class SpscQueue:
+    ''' bounded single-producer single-consumer queue
+
+        deque append and popleft are atomic, the semaphores only count the queued
+        items and the free slots so either side can block
+    '''
+
+    def __init__(self, depth):
+        self.items = deque()
+        self.filled = threading.Semaphore(0)
+        self.free = threading.Semaphore(depth)
+
+    def put(self, item):
+        self.free.acquire()
+        self.items.append(item)
+        self.filled.release()
+
+    def get(self):
+        self.filled.acquire()
+        item = self.items.popleft()
+        self.free.release()
+        return item
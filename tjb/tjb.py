@@ -1,7 +1,336 @@
 #
-# control script for running ad-hoc tasks from the work folder
+# run control for upgrade LC processing
 #
+#   cd tjb
+#   python tjb.py /data/sim/.../RandomNoise_IceCubeUpgrade_v58.23221.0.i3.zst
+#   python tjb.py 'RandomNoise_*.i3.zst' --mode joined --trigger --events --monitor
+#   python tjb.py --synthetic 4 --workers 4 --sink counts
+#   python tjb.py --synthetic 2 --profile sample --trace-memory
+#   python tjb.py --synthetic 2 --shadow batch --shadow-every 5
+#   python tjb.py --synthetic 4 --adaptive --calibration engines.json
+#   python tjb.py 'RandomNoise_*.i3.zst' --write lc.i3.zst --write-style pulses
+#   python tjb.py --work test_pipeline         # ad-hoc task from the work folder
 #
-from work import test_pipeline
+import argparse
+import glob
+import importlib
+import os
+import pickle
+import sys
 
-test_pipeline.run()
\ No newline at end of file
+from pipeline.cache import FrameRecord
+from pipeline.driver import Driver
+from pipeline.engines import Engine
+from pipeline.pipeline import Stopwatch
+from pipeline.pipeline import Topology
+from trigger.eventbuilder import EventLog
+from trigger.majority import MajorityTrigger
+from trigger.majority import TriggerLog
+
+
+class FrameSummary:
+    ''' prints a line per completed frame '''
+
+    def consume(self, frame):
+        print(f'COMPLETED FRAME: {frame.frame_id} [{frame.t_start} - {frame.t_end}] '
+              f'hits: {len(frame.hits)} SMLC: {frame.smlc_cnt} MMLC: {frame.mmlc_cnt}')
+
+
+class FrameTotals:
+    ''' totals over the run '''
+
+    def __init__(self):
+        self.frames = 0
+        self.hits = 0
+        self.smlc = 0
+        self.mmlc = 0
+
+    def consume(self, frame):
+        self.frames += 1
+        self.hits += len(frame.hits)
+        self.smlc += frame.smlc_cnt
+        self.mmlc += frame.mmlc_cnt
+
+    def report(self):
+        return [f'frames: {self.frames} hits: {self.hits} SMLC: {self.smlc} MMLC: {self.mmlc}']
+
+
+class FrameSaver:
+    ''' writes each frame as a pickled cache.FrameRecord, read back with load() '''
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+
+    def consume(self, frame):
+        pickle.dump(FrameRecord(frame), self.file, pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        self.file.close()
+
+    def load(path):
+        with open(path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+
+class Consumers:
+    ''' fans frames out to several consumers, a hook runs at every frame boundary '''
+
+    def __init__(self, consumers, hook=None):
+        self.consumers = consumers
+        self.hook = hook
+
+    def consume(self, frame):
+        for consumer in self.consumers:
+            consumer.consume(frame)
+        if self.hook is not None:
+            self.hook()
+
+    def resume(self, delivered):
+        for consumer in self.consumers:
+            if hasattr(consumer, 'resume'):
+                consumer.resume(delivered)
+
+
+def expandFiles(patterns):
+    ''' files and globs, in order, a pattern matching nothing is an error '''
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise RuntimeError(f'No input matches {pattern}')
+        files.extend(matches)
+    return files
+
+
+def merger(kind, lateness):
+    return ('reorder', lateness) if kind == 'reorder' else kind
+
+
+class Recorders:
+    ''' the trigger log, event log and rate monitor the topology feeds, None when not asked for '''
+
+    def __init__(self):
+        self.trigger_log = None
+        self.event_log = None
+        self.rate_monitor = None
+
+    def report(self):
+        lines = []
+        if self.trigger_log is not None:
+            lines.append(f'triggers: {len(self.trigger_log.records)}')
+        if self.event_log is not None:
+            lines.append(f'events: {len(self.event_log.events)} hits: {sum(len(e) for e in self.event_log.events)}')
+        if self.rate_monitor is not None:
+            lines += self.rate_monitor.report()
+        return lines
+
+
+def buildTopology(args):
+    ''' (the Topology the options ask for, None for the default pipeline, its Recorders) '''
+    recorders = Recorders()
+    topo = {}
+    if (args.module_sort, args.module_merge, args.string_merge) != ('pairheap',) * 3:
+        topo.update(module_sort=merger(args.module_sort, args.lateness),
+                    module_merge=merger(args.module_merge, args.lateness),
+                    string_merge=merger(args.string_merge, args.lateness))
+    if args.trigger or args.string_trigger or args.events:
+        topo['trigger'] = {'string': MajorityTrigger.TriggerConfig.lookup('string')} if args.string_trigger else True
+        topo['trigger_records'] = recorders.trigger_log = TriggerLog()
+    if args.events:
+        topo['events'] = True
+        topo['event_sink'] = recorders.event_log = EventLog()
+    if args.monitor is not None:
+        from pipeline.monitor import RateMonitor
+        topo['monitor'] = recorders.rate_monitor = RateMonitor(snapshot=args.monitor or None, ticks=args.ticks)
+    return (Topology(**topo) if topo else None), recorders
+
+
+def buildDriver(args, consumer):
+    reader = None
+    files = None
+    if args.synthetic:
+        from pipeline.synthetic import SyntheticSource
+        config = SyntheticSource.NoiseConfig(frame_len=args.frame_len)
+        reader = SyntheticSource(config, args.seed, args.frames_per_file)
+        files = reader.files(args.synthetic)
+    else:
+        files = expandFiles(args.files)
+
+    budget = None
+    if args.budget is not None:
+        from pipeline.spill import MemoryBudget
+        budget = MemoryBudget(args.budget, spill_dir=args.spill_dir)
+    cache = None
+    if args.cache is not None:
+        from pipeline.cache import ResultCache
+        cache = ResultCache(args.cache)
+    trace = None
+    if args.trace:
+        from pipeline.trace import Tracer
+        trace = Tracer(every=args.trace)
+    shadow = None
+    if args.shadow is not None:
+        from pipeline.shadow import Shadow
+        shadow = Shadow(args.shadow, every=args.shadow_every)
+    adaptive = None
+    if args.adaptive:
+        from pipeline.adaptive import EngineChooser
+        if args.calibration is not None and os.path.exists(args.calibration):
+            adaptive = EngineChooser.load(args.calibration, log=args.choice_log)
+        else:
+            adaptive = EngineChooser(log=args.choice_log).tune(ticks=args.ticks)
+            if args.calibration is not None and adaptive.degenerate is not None:
+                print(f'calibration not saved to {args.calibration}, degenerate: every tuning frame went to {adaptive.degenerate}')
+            elif args.calibration is not None:
+                adaptive.save(args.calibration)
+
+    topology, recorders = buildTopology(args)
+    driver = Driver(consumer, 1 if args.mode == 'joined' else 0, reader,
+                    workers=args.workers, budget=budget,
+                    checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every,
+                    cache=cache, ticks=args.ticks, trace=trace, topology=topology, engine=args.engine, decoders=args.decoders, shadow=shadow, adaptive=adaptive)
+    return driver, files, recorders
+
+
+def buildOutput(args, reader, files):
+    ''' the OutputWriter of --write, a .jsonl path takes the stand-in format '''
+    from pipeline.output import OutputWriter
+    if args.write.endswith('.jsonl'):
+        from pipeline.output import JsonWriter
+        if reader is None:
+            from pipeline.i3reader import I3Reader
+            reader = I3Reader()
+        writer = JsonWriter(args.write, files, reader, style=args.write_style)
+    else:
+        from pipeline.i3writer import I3Writer
+        writer = I3Writer(args.write, files, style=args.write_style)
+    return OutputWriter(writer, args.write_depth)
+
+
+def parser():
+    p = argparse.ArgumentParser(description='upgrade LC processing of i3 files or synthetic noise')
+    p.add_argument('files', nargs='*', help='input i3 files or globs')
+    p.add_argument('--synthetic', type=int, default=0, metavar='N', help='process N synthetic noise files instead')
+    p.add_argument('--frames-per-file', type=int, default=10, help='synthetic frames per file')
+    p.add_argument('--frame-len', type=float, default=1e7, help='synthetic frame length, ns')
+    p.add_argument('--seed', type=int, default=0, help='synthetic noise seed')
+
+    run = p.add_argument_group('processing')
+    run.add_argument('--mode', choices=['isolated', 'joined'], default='isolated',
+                     help='frames as independent units or joined into one stream')
+    run.add_argument('--workers', type=int, default=0, help='isolated mode: worker processes')
+    run.add_argument('--ticks', action='store_true', help='carry hit times as int64 DAQ ticks')
+    run.add_argument('--engine', choices=Engine.names(), default='pipeline',
+                     help=', '.join(f'{n}: {Engine.lookup(n).summary}' for n in Engine.names()))
+    run.add_argument('--threads', action='store_const', dest='engine', const='threaded', help='same as --engine threaded')
+    run.add_argument('--adaptive', action='store_true', help='isolated mode: pick the streaming or batch engine per frame')
+    run.add_argument('--calibration', default=None, metavar='PATH', help='adaptive: engine choice thresholds, tuned and saved there when missing')
+    run.add_argument('--choice-log', default=None, metavar='PATH', help='adaptive: log a line per frame choice')
+    run.add_argument('--decoders', type=int, default=0, metavar='N', help='decode input files ahead on N processes')
+    for name in ('module-sort', 'module-merge', 'string-merge'):
+        run.add_argument(f'--{name}', choices=sorted(Topology.MERGERS), default='pairheap', help=f'{name} merger')
+    run.add_argument('--lateness', type=float, default=None, help='reorder merger max lateness, ns')
+    run.add_argument('--budget', type=int, default=None, metavar='HITS', help='cap buffered hits per stage buffer, spill the rest')
+    run.add_argument('--spill-dir', default=None)
+    run.add_argument('--checkpoint', default=None, metavar='PATH', help='joined mode: checkpoint/resume file')
+    run.add_argument('--checkpoint-every', type=int, default=10, metavar='FRAMES')
+    run.add_argument('--cache', default=None, metavar='DIR', help='result cache directory')
+
+    out = p.add_argument_group('outputs')
+    out.add_argument('--sink', choices=['summary', 'counts', 'none'], default='summary', help='per-frame lines, run totals or nothing')
+    out.add_argument('--save', default=None, metavar='PATH', help='write the frames as pickled FrameRecords')
+    out.add_argument('--write', default=None, metavar='PATH', help='write the input frames with the LC results added, .jsonl: stand-in format, else an I3File')
+    out.add_argument('--write-style', choices=['mask', 'pulses'], default='mask', help='LC results as pulse-series masks or new pulse maps')
+    out.add_argument('--write-depth', type=int, default=None, metavar='FRAMES', help='results queued for the writer thread before processing blocks')
+    out.add_argument('--trigger', action='store_true', help='majority trigger after the final merge')
+    out.add_argument('--string-trigger', action='store_true', help='add the string trigger')
+    out.add_argument('--events', action='store_true', help='build events around the triggers')
+    out.add_argument('--monitor', nargs='?', const='', default=None, metavar='SNAPSHOT', help='channel rate monitor, optional snapshot path')
+
+    diag = p.add_argument_group('diagnostics')
+    diag.add_argument('--profile', choices=['cprofile', 'sample'], default=None, help='profile, aggregated per stage')
+    diag.add_argument('--profile-out', default=None, metavar='PATH', help='cprofile: also dump the raw stats')
+    diag.add_argument('--trace-memory', action='store_true', help='tracemalloc peak and top allocators per stage')
+    diag.add_argument('--trace', type=int, default=0, metavar='N', help='latency trace one in N hits')
+    diag.add_argument('--shadow', choices=Engine.names(), default=None, metavar='ENGINE', help='check ENGINE against the reference on a sample of frames')
+    diag.add_argument('--shadow-every', type=int, default=10, metavar='N', help='shadow one in N frames')
+
+    p.add_argument('--work', default=None, metavar='MODULE', help='run work.MODULE.run() instead')
+    return p
+
+
+def main(argv=None):
+    p = parser()
+    args = p.parse_args(argv)
+
+    if args.work is not None:
+        importlib.import_module(f'work.{args.work}').run()
+        return 0
+    if not args.files and not args.synthetic:
+        p.error('no input, give files or --synthetic N')
+    if args.write is not None and args.synthetic and not args.write.endswith('.jsonl'):
+        p.error('synthetic input has no I3 frames to write, give a .jsonl path')
+
+    consumers = []
+    totals = FrameTotals()
+    if args.sink == 'summary':
+        consumers.append(FrameSummary())
+    if args.sink != 'none':
+        consumers.append(totals)
+    saver = FrameSaver(args.save) if args.save else None
+    if saver is not None:
+        consumers.append(saver)
+
+    memory = None
+    if args.trace_memory:
+        from pipeline.profiling import MemoryTrace
+        memory = MemoryTrace()
+        memory.start()
+
+    consumer = Consumers(consumers, memory.checkpoint if memory is not None else None)
+    driver, files, recorders = buildDriver(args, consumer)
+    output = buildOutput(args, driver.reader, files) if args.write is not None else None
+    if output is not None:
+        consumers.append(output)
+
+    sw = Stopwatch()
+    try:
+        if args.profile is not None:
+            from pipeline.profiling import StageProfile
+            profile = StageProfile(args.profile)
+            profile.run(lambda: driver.process_all_files(files))
+            if args.profile_out and profile.stats is not None:
+                profile.stats.dump_stats(args.profile_out)
+        else:
+            profile = None
+            driver.process_all_files(files)
+    finally:
+        if saver is not None:
+            saver.close()
+        if output is not None:
+            output.close()
+        if memory is not None:
+            memory.stop()
+
+    print(f'run: {len(files)} files in {sw.elapsed():.2f} s')
+    reports = []
+    if args.sink != 'none':
+        reports += totals.report()
+    reports += recorders.report()
+    if output is not None:
+        reports += output.report()
+    if profile is not None:
+        reports += profile.report()
+    if memory is not None:
+        reports += memory.report()
+    for line in reports:
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
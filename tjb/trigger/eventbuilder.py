@@ -0,0 +1,218 @@
+#
+# Event builder: cuts readout windows around the triggers out of the time ordered hit
+# stream leaving the final merge
+#
+# A trigger's readout window is [t_start - before, t_end + after], overlapping windows
+# merge into one event. The hits pass through to the sink, a look-back buffer keeps
+# the recent ones for windows that open behind the stream (a trigger closes after its
+# hits went by). The buffer holds at most `lookback` of stream time plus the pending
+# events, a window reaching behind what was kept is cut short and counted.
+#
+# An event is emitted once the stream is `lookback` past its end, no later trigger can
+# reach it then.
+#
+import time
+
+from array import array
+from collections import deque
+
+from pipeline.injest import toTicks
+from uglc.kernels import MMLC_BIT
+from uglc.kernels import SMLC_BIT
+
+
+class Event:
+    ''' a built event, hits as compact arrays
+
+        channels: (string, om, pmt) table, channel indexes into it
+        times:    resolved hit times
+        flags:    SMLC_BIT | MMLC_BIT per hit
+    '''
+
+    def __init__(self, event_id, t_start, t_end, triggers, hits, ticks=False):
+        self.event_id = event_id
+        self.t_start = t_start
+        self.t_end = t_end
+        self.triggers = triggers            # TriggerRecords read out
+        self.channels = []
+        self.channel = array('I')
+        self.times = array('q' if ticks else 'd')
+        self.flags = bytearray()
+
+        index = {}
+        for hit in hits:
+            omkey = hit.omkey
+            key = (omkey.string, omkey.om, omkey.pmt)
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(self.channels)
+                self.channels.append(key)
+            self.channel.append(i)
+            self.times.append(hit.resolveTime())
+            self.flags.append((SMLC_BIT if hit.smlc else 0) | (MMLC_BIT if hit.mmlc else 0))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return f'Event({self.event_id}, {self.t_start}, {self.t_end}, {len(self.triggers)} triggers, {len(self)} hits)'
+
+
+class EventLog:
+    ''' default event sink, keeps the events '''
+
+    def __init__(self):
+        self.events = []
+
+    def enque(self, event):
+        self.events.append(event)
+
+    def eos(self):
+        pass
+
+
+class EventBuilder:
+    ''' Passes the hits through unchanged, emits Events to events
+
+        Sits downstream of a MajorityTrigger, which sends its records to triggers.
+        before/after/lookback are in ns, converted when the hits are timed in ticks.
+    '''
+
+    BEFORE = 4000.0
+    AFTER = 6000.0
+    LOOKBACK = 50000.0
+
+    class TriggerInput:
+        ''' record sink handed to the trigger '''
+
+        def __init__(self, builder):
+            self.builder = builder
+
+        def enque(self, record):
+            self.builder.readout(record)
+
+        def eos(self):
+            pass
+
+
+    def __init__(self, sink, events=None, before=None, after=None, lookback=None, ticks=False):
+        def convert(ns, default):
+            ns = ns if ns is not None else default
+            return toTicks(ns) if ticks else ns
+
+        self.sink = sink
+        self.events = events if events is not None else EventLog()
+        self.before = convert(before, EventBuilder.BEFORE)
+        self.after = convert(after, EventBuilder.AFTER)
+        self.lookback = convert(lookback, EventBuilder.LOOKBACK)
+        self.ticks = ticks
+        self.triggers = EventBuilder.TriggerInput(self)
+
+        self.times = deque()                # look-back buffer, resolved times ...
+        self.hits = deque()                 # ... and the hits
+        self.kept_from = float('-inf')      # hits before this were let go
+        self.now = float('-inf')            # stream time, latest hit or watermark
+        self.pending = []                   # [t_start, t_end, records], disjoint, by time
+
+        # stats
+        self.built = 0
+        self.event_hits = 0
+        self.truncated = 0                  # windows cut short by the look-back bound
+        self.high_water = 0                 # most hits buffered
+        self.t_first = None                 # wall clock of the first hit, for events/s
+        self.elapsed = 0.0
+        self.t_span = None                  # (first, last) stream time
+
+    def enque(self, hit):
+        t = hit.resolveTime()
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+            self.t_span = (t, t)
+        self.times.append(t)
+        self.hits.append(hit)
+        if len(self.times) > self.high_water:
+            self.high_water = len(self.times)
+        self.advance(t)
+        self.sink.enque(hit)
+
+    def watermark(self, t):
+        self.advance(t)
+        self.sink.watermark(t)
+
+    def eos(self):
+        while self.pending:
+            self.emit(self.pending.pop(0))
+        if self.t_first is not None:
+            self.elapsed = time.perf_counter() - self.t_first
+            self.t_span = (self.t_span[0], self.now)
+        self.events.eos()
+        self.sink.eos()
+
+    def reset(self):
+        ''' empty for another stream, the stats and event numbering carry on '''
+        self.times.clear()
+        self.hits.clear()
+        self.kept_from = float('-inf')
+        self.now = float('-inf')
+        self.pending = []
+
+    def readout(self, record):
+        ''' open or extend the event reading out a trigger '''
+        start = record.t_start - self.before
+        end = record.t_end + self.after
+        if start <= self.kept_from:
+            self.truncated += 1
+            start = self.kept_from
+
+        # merge with the pending events it overlaps, they are disjoint and in order
+        records = [record]
+        keep = []
+        for event in self.pending:
+            if event[0] <= end and start <= event[1]:
+                start = min(start, event[0])
+                end = max(end, event[1])
+                records = event[2] + records
+            else:
+                keep.append(event)
+        keep.append([start, end, records])
+        keep.sort(key=lambda e: e[0])
+        self.pending = keep
+
+    def advance(self, t):
+        ''' the stream reached t, emit the events no trigger can reach anymore and trim the buffer '''
+        self.now = t
+        horizon = t - self.lookback
+        while self.pending and self.pending[0][1] < horizon:
+            self.emit(self.pending.pop(0))
+
+        limit = horizon if not self.pending else min(horizon, self.pending[0][0])
+        times = self.times
+        while times and times[0] < limit:
+            self.kept_from = times.popleft()
+            self.hits.popleft()
+
+    def emit(self, event):
+        start, end, records = event
+        hits = []
+        for t, hit in zip(self.times, self.hits):
+            if t > end:
+                break
+            if t >= start:
+                hits.append(hit)
+        self.events.enque(Event(self.built, start, end, records, hits, self.ticks))
+        self.built += 1
+        self.event_hits += len(hits)
+
+        # nothing up to the end is read out again
+        times = self.times
+        while times and times[0] <= end:
+            self.kept_from = times.popleft()
+            self.hits.popleft()
+
+    def report(self):
+        rate = f'{self.built / self.elapsed:.0f}' if self.elapsed > 0 else '-'
+        span = (self.t_span[1] - self.t_span[0]) if self.t_span is not None else 0
+        per_s = span / (1e10 if self.ticks else 1e9)
+        detector_rate = f'{self.built / per_s:.1f}' if per_s > 0 else '-'
+        return (f'events: {self.built} hits: {self.event_hits} truncated: {self.truncated} '
+                f'events/s: {rate} processing, {detector_rate} detector time, buffer high-water: {self.high_water}')
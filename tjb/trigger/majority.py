@@ -0,0 +1,209 @@
+#
+# Streaming simple-majority trigger over the LC hits leaving the MMLC merge
+#
+# A trigger fires when `multiplicity` LC hits fall within `window_len` of each other,
+# counted per device type and, optionally, per string. It stays open while the window
+# keeps the multiplicity, later hits extend it, and is emitted as a TriggerRecord once
+# a hit (or watermark) shows it cannot extend any further.
+#
+# Each counted hit is appended to and popped from one window per trigger kind, so the
+# work per hit is constant amortized.
+#
+from collections import deque
+
+from pipeline.injest import Geometry
+from pipeline.injest import toTicks
+
+
+class TriggerRecord:
+    ''' a fired trigger: kind, the span of its hits, their count and the modules they came from '''
+
+    __slots__ = ('kind', 't_start', 't_end', 'multiplicity', 'modules')
+
+    def __init__(self, kind, t_start, t_end, multiplicity, modules):
+        self.kind = kind                    # 'DEGG', 'MDOM' or 'STRING <n>'
+        self.t_start = t_start
+        self.t_end = t_end
+        self.multiplicity = multiplicity    # hits contributing
+        self.modules = modules              # (string, om) -> None, in contribution order
+
+    def __repr__(self):
+        return f'TriggerRecord({self.kind}, {self.t_start}, {self.t_end}, {self.multiplicity}, {len(self.modules)} modules)'
+
+
+class TriggerLog:
+    ''' default record sink, keeps the records '''
+
+    def __init__(self):
+        self.records = []
+
+    def enque(self, record):
+        self.records.append(record)
+
+    def eos(self):
+        pass
+
+
+class MajorityTrigger:
+    ''' Passes the hits through unchanged, emits TriggerRecords to records as triggers close '''
+
+    class TriggerConfig:
+        def __init__(self, window_len, multiplicity):
+            self.window_len = window_len
+            self.multiplicity = multiplicity
+
+        def inTicks(self):
+            ''' the config for hits timed in DAQ ticks '''
+            return MajorityTrigger.TriggerConfig(toTicks(self.window_len), self.multiplicity)
+
+        def lookup(kind):
+            match kind:
+                case Geometry.DeviceType.DEGG:
+                    return MajorityTrigger.TriggerConfig(5000, 8)
+                case Geometry.DeviceType.MDOM:
+                    return MajorityTrigger.TriggerConfig(5000, 8)
+                case 'string':
+                    return MajorityTrigger.TriggerConfig(1500, 5)
+                case _:
+                    raise RuntimeError(f'Unsupported trigger: {kind}');
+
+
+    class Window:
+        ''' the counted hits of one trigger kind within window_len of the latest '''
+
+        def __init__(self, kind, config, records):
+            self.kind = kind
+            self.window_len = config.window_len
+            self.multiplicity = config.multiplicity
+            self.records = records
+            self.times = deque()
+            self.modules = deque()
+            self.open = None        # TriggerRecord being extended
+            self.fired = 0
+
+        def enque(self, t, module):
+            times = self.times
+            while times and t - times[0] > self.window_len:
+                times.popleft()
+                self.modules.popleft()
+            times.append(t)
+            self.modules.append(module)
+
+            if len(times) >= self.multiplicity:
+                if self.open is None:
+                    self.open = TriggerRecord(self.kind, times[0], t, len(times), dict.fromkeys(self.modules))
+                else:
+                    self.open.t_end = t
+                    self.open.multiplicity += 1
+                    self.open.modules[module] = None
+            elif self.open is not None:
+                self.close()
+
+        def watermark(self, t):
+            times = self.times
+            while times and t - times[0] > self.window_len:
+                times.popleft()
+                self.modules.popleft()
+            if self.open is not None and len(times) + 1 < self.multiplicity:
+                self.close()        # the next hit cannot restore the multiplicity
+
+        def close(self):
+            self.records.enque(self.open)
+            self.open = None
+            self.fired += 1
+
+        def eos(self):
+            if self.open is not None:
+                self.close()
+
+        def reset(self):
+            self.times.clear()
+            self.modules.clear()
+            self.open = None
+
+
+    def __init__(self, sink, configs=None, records=None, lc='mmlc', ticks=False):
+        # configs maps Geometry.DeviceType and 'string' to a TriggerConfig, None disables a
+        # kind, missing kinds take TriggerConfig.lookup, the string trigger is off by default
+        #
+        # lc: the hit flag counted, 'mmlc' or 'smlc'
+        if lc not in ('mmlc', 'smlc'):
+            raise RuntimeError(f'Unsupported LC flag {lc}')
+        configs = configs if configs is not None else {}
+        self.sink = sink
+        self.records = records if records is not None else TriggerLog()
+        self.lc = lc
+
+        def resolve(kind, default):
+            config = configs.get(kind, default)
+            return config.inTicks() if config is not None and ticks else config
+
+        self.by_type = {}
+        for device_type in Geometry.DeviceType:
+            config = resolve(device_type, MajorityTrigger.TriggerConfig.lookup(device_type))
+            if config is not None:
+                self.by_type[device_type] = MajorityTrigger.Window(device_type.name, config, self.records)
+        self.string_config = resolve('string', None)
+        self.by_string = {}         # string -> Window, made as strings are seen
+        self.opened = {}            # windows with an open trigger (dict for a stable order), every hit's time may close them
+
+        # stats
+        self.inn = 0
+        self.counted = 0
+
+    def enque(self, hit):
+        self.inn += 1
+        if getattr(hit, self.lc):
+            self.counted += 1
+            t = hit.resolveTime()
+            omkey = hit.omkey
+            module = (omkey.string, omkey.om)
+            window = self.by_type.get(hit.device_type)
+            if window is not None:
+                window.enque(t, module)
+                if window.open is not None:
+                    self.opened[window] = None
+            if self.string_config is not None:
+                window = self.by_string.get(omkey.string)
+                if window is None:
+                    window = self.by_string[omkey.string] = MajorityTrigger.Window(f'STRING {omkey.string}', self.string_config, self.records)
+                window.enque(t, module)
+                if window.open is not None:
+                    self.opened[window] = None
+        if self.opened:
+            self.close(hit.resolveTime())
+        self.sink.enque(hit)
+
+    def close(self, t):
+        ''' the stream reached t, emit the open triggers that can no longer extend '''
+        for window in list(self.opened):
+            window.watermark(t)
+            if window.open is None:
+                del self.opened[window]
+
+    def eos(self):
+        for window in self.windows():
+            window.eos()
+        self.opened.clear()
+        self.records.eos()
+        self.sink.eos()
+
+    def watermark(self, t):
+        for window in self.windows():
+            window.watermark(t)
+        self.opened = {w: None for w in self.opened if w.open is not None}
+        self.sink.watermark(t)
+
+    def reset(self):
+        ''' empty for another stream, the stats are kept '''
+        for window in self.windows():
+            window.reset()
+        self.opened = {}
+
+    def windows(self):
+        yield from self.by_type.values()
+        yield from self.by_string.values()
+
+    def report(self):
+        fired = ' '.join(f'{w.kind}: {w.fired}' for w in self.windows())
+        return f'trigger: hits: {self.inn} counted ({self.lc}): {self.counted} fired: {fired}'
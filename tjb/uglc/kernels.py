@@ -0,0 +1,106 @@
+#
+# Compiled kernels for the SMLC/MMLC inner loops over array-backed hit buffers.
+#
+# The kernels are plain python loops over flat arrays (times, oms, per-hit window
+# parameters). When numba is installed they are JIT compiled, otherwise they run
+# as-is, so results are identical either way.
+#
+from array import array
+
+try:
+    import numpy
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def jit(fn):
+    ''' nopython compile when numba is available, identity otherwise '''
+    if HAVE_NUMBA:
+        return numba.njit(cache=True, nogil=True)(fn)
+    return fn
+
+
+def asKernelArray(buf):
+    ''' view an array.array as something the kernels accept, zero copy '''
+    if HAVE_NUMBA:
+        return numpy.frombuffer(buf, dtype=buf.typecode)
+    return buf
+
+
+SMLC_BIT = 1
+MMLC_BIT = 2
+
+
+@jit
+def smlcFlags(times, window_len, multiplicity, flags):
+    ''' SMLC.multiplicity_algo over a whole time ordered module stream
+
+        sets SMLC_BIT in flags for every hit the streaming SMLC would mark
+    '''
+    start = 0
+    marked = 0      # hits below this index are already flagged
+    for i in range(len(times)):
+        t = times[i]
+        while t - times[start] > window_len:
+            start += 1
+        if i - start + 1 >= multiplicity:
+            j = start if start > marked else marked
+            while j <= i:
+                flags[j] |= SMLC_BIT
+                j += 1
+            marked = i + 1
+
+
+@jit
+def mmlcFlags(times, oms, t_back, t_fwd, multiplicity, flags):
+    ''' MMLC windows over a whole time ordered string stream
+
+        per-hit window parameters (they depend on device type), sets MMLC_BIT
+        when at least multiplicity hits from other modules fall in the window
+    '''
+    n = len(times)
+    for i in range(n):
+        t = times[i]
+        t_start = t - t_back[i]
+        t_end = t + t_fwd[i]
+
+        # window starts differ by device type, so search rather than slide
+        a = 0
+        b = i
+        while a < b:
+            m = (a + b) // 2
+            if times[m] < t_start:
+                a = m + 1
+            else:
+                b = m
+
+        om = oms[i]
+        cnt = 0
+        j = a
+        while j < n and times[j] <= t_end:
+            if oms[j] != om:
+                cnt += 1
+                if cnt >= multiplicity[i]:
+                    flags[i] |= MMLC_BIT
+                    break
+            j += 1
+
+
+class HitArrays:
+    ''' array-backed view of a time ordered list of hits
+
+        ticks: times are int64 DAQ ticks, the kernels then run on integer compares
+    '''
+
+    def __init__(self, hits, ticks=False):
+        self.hits = hits
+        self.times = array('q' if ticks else 'd', [h.resolveTime() for h in hits])
+        self.oms = array('q', [h.omkey.om for h in hits])
+
+    def __len__(self):
+        return len(self.hits)
+
+    def newFlags(self):
+        return array('b', bytes(len(self.hits)))
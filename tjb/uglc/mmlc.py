@@ -1,5 +1,8 @@
+import copy
+
 from collections import deque
 from pipeline.injest import Geometry
+from pipeline.injest import toTicks
 
 class MMLC:
     ''' Synthesizes MMLC for hits.
@@ -57,6 +60,9 @@ class MMLC:
                     self.span_down = span_down
                     self.multiplicity = multiplicity
 
+            def inTicks(self):
+                return MMLC.MMLCConfig.ModuleConfig(toTicks(self.t_back), toTicks(self.t_fwd), self.span_up, self.span_down, self.multiplicity)
+
         def __init__(self, string):
             self.MAX_WINDOW=500; #must be >= the longest module window
             self.string = string
@@ -67,6 +73,14 @@ class MMLC:
             print(f'MMLC: device_type: DEGG, string: {self.string}, window: {self.degg_cfg.t_back + self.degg_cfg.t_fwd}, span_up: {self.degg_cfg.span_up} span_down: {self.degg_cfg.span_down} multiplicity: {self.degg_cfg.multiplicity}')
             print(f'MMLC: device_type: MDOM, string: {self.string}, window: {self.mdom_cfg.t_back + self.mdom_cfg.t_fwd}, span_up: {self.mdom_cfg.span_up} span_down: {self.mdom_cfg.span_down} multiplicity: {self.mdom_cfg.multiplicity}')
 
+        def inTicks(self):
+            ''' the config for hits timed in DAQ ticks '''
+            cfg = copy.copy(self)
+            cfg.MAX_WINDOW = toTicks(self.MAX_WINDOW)
+            cfg.degg_cfg = self.degg_cfg.inTicks()
+            cfg.mdom_cfg = self.mdom_cfg.inTicks()
+            return cfg
+
 
     class MMLCWindow:
         def __init__(self, hit, t_back, t_fwd, span_up, span_down, multiplicity):
@@ -94,6 +108,8 @@ class MMLC:
 
 
     def __init__(self, string, config, sink):
+        # held/pending stay in memory, they span MAX_WINDOW and examine() scans them
+        # whole for every window it closes, a spilled run would be re-read each time
         self.string = string
         self.config = config
         self.pending = deque()
@@ -155,3 +171,22 @@ class MMLC:
         self.examine(float('inf'))
         self.release(float('inf'))
         self.sink.eos()
+
+    def watermark(self, t):
+        ''' no later hit is earlier than t: windows ending before t are complete and
+            held hits out of reach of any later window are released
+        '''
+        self.examine(t)
+        pit = min(t, self.pending[0].t_hit) if self.pending else t
+        self.release(pit - self.config.MAX_WINDOW)
+
+        mark = t
+        if self.pending:
+            mark = min(mark, self.pending[0].t_hit)
+        if self.held:
+            mark = min(mark, self.held[0].t_hit)
+        self.sink.watermark(mark)
+
+    def reset(self):
+        self.pending.clear()
+        self.held.clear()
@@ -54,3 +54,15 @@ class SlidingWindow:
         # sink.enque(kicked out hit)
 
         # yields window of hits
+
+    def watermark(self, t):
+        ''' no later hit is earlier than t, release the hits a later hit cannot reach '''
+        while len(self.hits) != 0 and t - self.hits[0].resolveTime() > self.window_length:
+            self.sink.enque(self.hits.popleft())
+        self.sink.watermark(min(t, self.hits[0].resolveTime()) if self.hits else t)
+
+    def reset(self):
+        ''' empty for another stream, its times start over '''
+        self.hits.clear()
+        self.curr_time = None
+        self.prev_hit = None
@@ -1,6 +1,7 @@
 
 from uglc.slidingwindow import SlidingWindow
 from pipeline.injest import Geometry
+from pipeline.injest import toTicks
 
 class SMLC:
     ''' Only marks the hits, does not release hits or move the window'''
@@ -10,6 +11,10 @@ class SMLC:
             self.window_len = window_len
             self.multiplicity = multiplicity
 
+        def inTicks(self):
+            ''' the config for hits timed in DAQ ticks '''
+            return SMLC.SMLCConfig(toTicks(self.window_len), self.multiplicity)
+
         def lookup(device_type):
             match device_type:
                 case Geometry.DeviceType.DEGG:
@@ -39,6 +44,17 @@ class SMLC:
         # print(f'SMLC:eos: [{self.modulekey.string}-{self.modulekey.om}]')
         self.sw.eos()
 
+    def watermark(self, t):
+        self.sw.watermark(t)
+
+    def configure(self, config):
+        ''' another device type's config, between streams '''
+        self.config = config
+        self.sw.window_length = config.window_len
+
+    def reset(self):
+        self.sw.reset()
+
 
     def multiplicity_algo(self, multiplicity, window_hits):
         if len(window_hits) >= multiplicity:
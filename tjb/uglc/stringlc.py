@@ -0,0 +1,65 @@
+from collections import deque
+
+
+class StringLC:
+    ''' SMLC of a string's modules on the string's time ordered stream
+
+        Feeds the string's MMLC directly, no per-module release and no re-sort. The
+        SMLC windows only mark, the hits wait in one string-wide line until the stream
+        is more than delay (the longest SMLC window) past them, their SMLC flags are
+        then final, and leave in time order.
+    '''
+
+    class Module:
+        ''' a module's SMLC sliding window, marks the hits but does not release them '''
+
+        def __init__(self, config):
+            self.hits = deque()
+            self.configure(config)
+
+        def configure(self, config):
+            self.window_len = config.window_len
+            self.multiplicity = config.multiplicity
+
+        def reset(self):
+            self.hits.clear()
+
+
+    def __init__(self, modules, delay, sink):
+        # modules: om -> StringLC.Module, sink: the string's MMLC
+        self.modules = modules
+        self.delay = delay
+        self.sink = sink
+        self.held = deque()
+
+    def enque(self, hit):
+        t = hit.resolveTime()
+        held = self.held
+        while held and t - held[0].resolveTime() > self.delay:
+            self.sink.enque(held.popleft())
+
+        module = self.modules[hit.omkey.om]
+        window = module.hits
+        while window and t - window[0].resolveTime() > module.window_len:
+            window.popleft()
+        window.append(hit)
+        if len(window) >= module.multiplicity:
+            for h in window:
+                h.markSMLC()
+        held.append(hit)
+
+    def eos(self):
+        while self.held:
+            self.sink.enque(self.held.popleft())
+        self.sink.eos()
+
+    def watermark(self, t):
+        held = self.held
+        while held and t - held[0].resolveTime() > self.delay:
+            self.sink.enque(held.popleft())
+        self.sink.watermark(min(t, held[0].resolveTime()) if held else t)
+
+    def reset(self):
+        self.held.clear()
+        for module in self.modules.values():
+            module.reset()
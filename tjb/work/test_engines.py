@@ -0,0 +1,121 @@
+#
+# Regression check of the engines against the reference on dense synthetic noise
+#
+#   python tjb.py --work test_engines
+#
+# - every registered engine shadowed on every frame, no mismatch allowed
+# - the Driver's reused (reset) pipelines of every engine, isolated and joined, and the
+#   per-frame engine choice deliver the reference frames
+# - a joined run interrupted and resumed from its checkpoint delivers the reference
+#   frames, with and without a memory budget
+# - a default rate monitor over the tjb.py default synthetic frames closes intervals
+#
+# Raises on the first failure.
+#
+import contextlib
+import io
+import os
+import tempfile
+
+from pipeline.adaptive import EngineChooser
+from pipeline.driver import Driver
+from pipeline.engines import Engine
+from pipeline.injest import Injest
+from pipeline.monitor import RateMonitor
+from pipeline.pipeline import Topology
+from pipeline.shadow import Shadow
+from pipeline.shadow import releaseOrder
+from pipeline.spill import MemoryBudget
+from pipeline.synthetic import SyntheticSource
+
+
+class Frames:
+    ''' keeps (frame id, hit keys in release order, flags) of the delivered frames '''
+
+    def __init__(self, interrupt_at=None):
+        self.frames = []
+        self.interrupt_at = interrupt_at
+
+    def consume(self, frame):
+        if self.interrupt_at is not None and len(self.frames) == self.interrupt_at:
+            raise Interrupted()
+        flags = sorted((h.omkey.string, h.omkey.om, h.omkey.pmt, h.rawTime(), h.smlc, h.mmlc) for h in frame.hits)
+        self.frames.append((frame.frame_id, releaseOrder(frame.hits), flags))
+
+    def resume(self, delivered):
+        del self.frames[delivered:]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def source():
+    # 2 strings of 10 modules at 20x the nominal noise with correlated bursts, plenty of LC
+    config = SyntheticSource.NoiseConfig(strings=(87, 88), modules_per_string=10, degg_rate=20000.0, mdom_rate=6000.0,
+                                         burst_rate=5000.0, frame_len=2e5)
+    return SyntheticSource(config, seed=3, frames_per_file=4)
+
+
+def process(src, mode, consumer=None, **kwargs):
+    consumer = consumer if consumer is not None else Frames()
+    with contextlib.redirect_stdout(io.StringIO()):
+        Driver(consumer, mode, src, **kwargs).process_all_files(src.files(2))
+    return consumer.frames
+
+
+def check(what, ok):
+    print(f'{what:<60} {"ok" if ok else "FAILED"}')
+    if not ok:
+        raise RuntimeError(f'engine regression: {what}')
+
+
+def run():
+    src = source()
+
+    for ticks in (False, True):
+        for name in Engine.names():
+            shadow = Shadow(name, every=1)
+            process(src, 0, ticks=ticks, shadow=shadow)
+            check(f'shadow {name}{" ticks" if ticks else ""}: {shadow.frames} frames {shadow.hits} hits',
+                  shadow.frames > 0 and shadow.mismatches() == 0)
+
+    for mode in (0, 1):
+        reference = process(src, mode)
+        for name in Engine.names():
+            if mode == 1 and not Engine.lookup(name).streaming:
+                continue
+            check(f'{"joined" if mode else "isolated"} {name}', process(src, mode, engine=name) == reference)
+
+    reference = process(src, 0)
+    stats = sorted(frame.stats().hits for frame in Injest(src.files(2), src).upgradePulseFrames())
+    chooser = EngineChooser(min_hits=stats[len(stats) // 2], min_occupancy=0.0, min_density=0.0)
+    check('adaptive, frames on both engines', process(src, 0, adaptive=chooser) == reference
+          and all(chooser.frames.values()))
+
+    reference = process(src, 1)
+    for name in Engine.names():
+        engine = Engine.lookup(name)
+        if not (engine.checkpoints and engine.streaming):
+            continue
+        for budget in (None, 4):
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'checkpoint')
+                consumer = Frames(interrupt_at=3)
+                try:
+                    process(src, 1, consumer, engine=name, checkpoint=path, checkpoint_every=2,
+                            budget=MemoryBudget(budget) if budget else None)
+                except Interrupted:
+                    pass
+                resumed = os.path.exists(path)
+                consumer.interrupt_at = None
+                process(src, 1, consumer, engine=name, checkpoint=path, checkpoint_every=2,
+                        budget=MemoryBudget(budget) if budget else None)
+            check(f'checkpoint resume {name}{f" budget {budget}" if budget else ""}', resumed and consumer.frames == reference)
+
+    for mode in (0, 1):
+        monitor = RateMonitor()
+        src = SyntheticSource(SyntheticSource.NoiseConfig(frame_len=1e7), seed=0, frames_per_file=2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            Driver(Frames(), mode, src, topology=Topology(monitor=monitor)).process_all_files(src.files(1))
+        check(f'default monitor {"joined" if mode else "isolated"}: {monitor.intervals} intervals', monitor.intervals > 0)
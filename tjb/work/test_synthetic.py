@@ -0,0 +1,23 @@
+#
+# Test the pipeline mechanics on synthetic noise, no icetray or sim files needed
+#
+#
+#
+
+from pipeline.driver import Driver
+from pipeline.synthetic import SyntheticSource
+from work.test_pipeline import FrameConsumer
+
+
+def run():
+
+    # 2 strings of 10 modules, mDOM/DEGG mix, with some correlated bursts
+    config = SyntheticSource.NoiseConfig(strings=(87, 88), modules_per_string=10, burst_rate=2000.0)
+    source = SyntheticSource(config, seed=1, frames_per_file=3)
+
+    # Initiate the driver
+    driver = Driver(FrameConsumer(), 0, source) # independent frames
+    # driver = Driver(FrameConsumer(), 1, source) # frames joined into a cohesive monotonic time sequenece
+
+    # Process the synthetic files
+    driver.process_all_files(source.files(2))